@@ -0,0 +1,75 @@
+from collections import defaultdict
+
+from avito import AvitoClient
+from chat_index import ChatChangeIndex
+from followups import FollowupQueue
+from storage import PersistentDict, PersistentSet
+
+# Аккаунт, чье состояние хранится под прежними (однопользовательскими) именами
+DEFAULT_ACCOUNT = "default"
+
+
+class Account:
+    """Аккаунт Avito в общем процессе: свой клиент API (и токен) и состояние чатов.
+
+    Хранилище, лимиты апстримов и очереди фоновых заданий общие для всех
+    аккаунтов; здесь только то, что относится к чатам одного аккаунта.
+    """
+
+    def __init__(self, name, client, store):
+        self.name = name
+        self.client = client
+        # Хранилище состояния чатов (chat_id -> dialog_history)
+        self.chat_states = defaultdict(list)
+        # Отслеживание обработанных сообщений (chat_id -> last_message_timestamp)
+        self.processed_messages = PersistentDict(store, self.namespace("processed_messages"))
+        # Завершенные диалоги (чтобы не обрабатывать повторно)
+        self.completed_chats = PersistentSet(store, self.namespace("completed_chats"))
+        # Этапы диалогов (chat_id -> stage)
+        self.chat_stages = PersistentDict(store, self.namespace("chat_stages"))
+        # Follow-up состояния (chat_id -> {last_client_activity, next_followup_time, followup_stage})
+        self.followup_states = PersistentDict(store, self.namespace("followup_states"))
+        # Данные объявлений для чатов (chat_id -> item_data)
+        self.chat_items = PersistentDict(store, self.namespace("chat_items"))
+        # Очередь follow-up по времени отправки (восстанавливается из состояния)
+        self.followup_queue = FollowupQueue()
+        for chat_id, state in self.followup_states.items():
+            self.followup_queue.schedule(chat_id, state["next_followup_time"])
+        # Индекс изменений чатов: сообщения загружаются только для изменившихся
+        self.chat_index = ChatChangeIndex()
+        # Кэш сообщений и окно контекста задает бот (параметры общие)
+        self.message_cache = None
+        self.context_window = None
+        self.stats = {"answered": 0}
+
+    @property
+    def user_id(self):
+        return self.client.user_id
+
+    def namespace(self, name):
+        """Имя пространства состояния в StateStore"""
+        return name if self.name == DEFAULT_ACCOUNT else f"{self.name}/{name}"
+
+    def chat_key(self, chat_id):
+        """Ключ блокировки чата: id чатов разных аккаунтов не пересекаются"""
+        return self.name, chat_id
+
+
+def create_accounts(configs, store, refresh_margin=300):
+    """Аккаунты из настроек AVITO_ACCOUNTS: [{"name", "user_id", "client_id", "client_secret"}, ...]"""
+    accounts = []
+    names = set()
+    for config in configs:
+        name = config.get("name") or DEFAULT_ACCOUNT
+        if name in names:
+            raise ValueError(f"Аккаунт Avito {name!r} указан дважды")
+        names.add(name)
+        client = AvitoClient(
+            config["user_id"], config["client_id"], config["client_secret"],
+            token_cache_file=config.get("token_cache_file"),
+            refresh_margin=refresh_margin
+        )
+        accounts.append(Account(name, client, store))
+    if not accounts:
+        raise ValueError("Не задан ни один аккаунт Avito (AVITO_ACCOUNTS)")
+    return accounts
@@ -1,7 +1,15 @@
 import asyncio
 import aiohttp
+import json
+import logging
+import os
+import time
 from datetime import datetime, timedelta
 
+from metrics import track, upstream_errors
+
+logger = logging.getLogger(__name__)
+
 # ================== CONFIG ==================
 AVITO_USER_ID = 123456789  # <-- подставь свой ID
 AVITO_CLIENT_ID = "your_client_id"
@@ -14,25 +22,85 @@ TIME_WINDOW_HOURS = 3  # новые сообщения за последние N
 
 
 class AvitoClient:
-    def __init__(self, user_id, client_id, client_secret):
+    def __init__(self, user_id, client_id, client_secret,
+                 token_cache_file=None, refresh_margin=300):
         self.user_id = user_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.access_token = None
+        self.token_expires_at = 0
+        self.token_cache_file = token_cache_file
+        self.refresh_margin = refresh_margin
         self.session = None
         self.base_url = "https://api.avito.ru"
+        self._token_lock = None
+        self._refresh_task = None
 
     async def __aenter__(self):
-        await self._get_token()
-        self.session = aiohttp.ClientSession(headers={
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
-        })
+        await self.start()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def start(self):
+        """Открыть сессию и получить токен (повторный вызов ничего не делает)"""
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        if self.access_token is None:
+            self._load_cached_token()
+        if not self._token_is_fresh():
+            await self._refresh_token(self.access_token)
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
         if self.session:
             await self.session.close()
+            self.session = None
+
+    def _token_is_fresh(self):
+        return bool(self.access_token) and time.time() < self.token_expires_at - self.refresh_margin
+
+    def _load_cached_token(self):
+        """Подхватить токен, сохраненный предыдущим запуском"""
+        if not self.token_cache_file or not os.path.exists(self.token_cache_file):
+            return
+        try:
+            with open(self.token_cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать кэш токена Avito: {e}")
+            return
+        if cached.get("client_id") != self.client_id:
+            return
+        self.access_token = cached.get("access_token")
+        self.token_expires_at = cached.get("expires_at", 0)
+
+    def _save_cached_token(self):
+        if not self.token_cache_file:
+            return
+        tmp_path = f"{self.token_cache_file}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({
+                    "client_id": self.client_id,
+                    "access_token": self.access_token,
+                    "expires_at": self.token_expires_at
+                }, f)
+            os.replace(tmp_path, self.token_cache_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш токена Avito: {e}")
 
     async def _get_token(self):
         data = {
@@ -40,28 +108,112 @@ class AvitoClient:
             "client_id": self.client_id,
             "client_secret": self.client_secret
         }
-        async with aiohttp.ClientSession() as temp:
-            async with temp.post(f"{self.base_url}/token", data=data) as res:
-                res.raise_for_status()
-                result = await res.json()
-                self.access_token = result["access_token"]
+        async with self.session.post(f"{self.base_url}/token", data=data) as res:
+            res.raise_for_status()
+            result = await res.json()
+            self.access_token = result["access_token"]
+            self.token_expires_at = time.time() + result.get("expires_in", 24 * 60 * 60)
+        self._save_cached_token()
+
+    async def _refresh_token(self, stale_token):
+        """Обновить токен, если его еще не обновил параллельный запрос"""
+        async with self._token_lock:
+            if self.access_token != stale_token and self._token_is_fresh():
+                return
+            await self._get_token()
+
+    async def _refresh_loop(self):
+        """Фоновое обновление токена незадолго до истечения срока"""
+        while True:
+            delay = self.token_expires_at - self.refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self._refresh_token(self.access_token)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обновления токена Avito: {e}")
+                await asyncio.sleep(30)
+
+    async def _request(self, method, url, operation="request", **kwargs):
+        """Запрос к API с авторизацией и одним повтором при 401"""
+        with track("avito", operation):
+            for attempt in range(2):
+                token = self.access_token
+                headers = {"Authorization": f"Bearer {token}"}
+                async with self.session.request(method, url, headers=headers, **kwargs) as res:
+                    if res.status == 401 and attempt == 0:
+                        await self._refresh_token(token)
+                        continue
+                    try:
+                        data = await res.json(content_type=None)
+                    except ValueError:
+                        data = None
+                    if res.status != 200:
+                        upstream_errors.inc(upstream="avito", operation=operation)
+                    return res.status, data
 
     async def get_chats(self, limit=100):
         url = f"{self.base_url}/messenger/v2/accounts/{self.user_id}/chats"
-        async with self.session.get(url, params={"limit": limit}) as res:
-            return (await res.json()).get("chats", [])
+        _, data = await self._request("GET", url, "get_chats", params={"limit": limit})
+        return data.get("chats", []) if isinstance(data, dict) else []
+
+    async def iter_chats(self, since=None, unread_only=False, chat_types=None, page_size=100, max_offset=1000):
+        """Чаты от недавно обновленных к старым, страницами по page_size.
+
+        Avito отдает список по убыванию updated, поэтому на первом чате,
+        обновленном раньше since (unix-время), обход заканчивается: дальше
+        только более старые, и лишние страницы не запрашиваются. Фильтры
+        unread_only и chat_types (например ["u2i"]) применяет сам Avito.
+        """
+        url = f"{self.base_url}/messenger/v2/accounts/{self.user_id}/chats"
+        params = {"limit": page_size}
+        if unread_only:
+            params["unread_only"] = "true"
+        if chat_types:
+            params["chat_types"] = ",".join(chat_types)
+
+        offset = 0
+        while True:
+            status, data = await self._request("GET", url, "get_chats", params={**params, "offset": offset})
+            if status != 200 or not isinstance(data, dict):
+                logger.warning(f"Ошибка получения списка чатов (offset {offset}): {status}")
+                return
+            chats = data.get("chats", [])
+            for chat in chats:
+                if since is not None and (chat.get("updated") or 0) < since:
+                    return
+                yield chat
+            if len(chats) < page_size:
+                return
+            offset += page_size
+            # API не принимает offset больше max_offset
+            if offset > max_offset:
+                logger.warning(f"Список чатов обрезан на {offset} чатах: дальше offset не поддерживается")
+                return
+
+    async def get_chat(self, chat_id):
+        url = f"{self.base_url}/messenger/v2/accounts/{self.user_id}/chats/{chat_id}"
+        status, data = await self._request("GET", url, "get_chat")
+        return data if status == 200 and isinstance(data, dict) else None
+
+    async def subscribe_webhook(self, webhook_url):
+        url = f"{self.base_url}/messenger/v3/webhook"
+        status, _ = await self._request("POST", url, "subscribe_webhook", json={"url": webhook_url})
+        return status == 200
 
-    async def get_messages(self, chat_id, limit=20):
+    async def get_messages(self, chat_id, limit=20, offset=0):
         url = f"{self.base_url}/messenger/v3/accounts/{self.user_id}/chats/{chat_id}/messages/"
-        async with self.session.get(url, params={"limit": limit}) as res:
-            data = await res.json()
-            return data if isinstance(data, list) else data.get("messages", [])
+        _, data = await self._request("GET", url, "get_messages", params={"limit": limit, "offset": offset})
+        if isinstance(data, list):
+            return data
+        return data.get("messages", []) if isinstance(data, dict) else []
 
     async def send_message(self, chat_id, text):
         url = f"{self.base_url}/messenger/v1/accounts/{self.user_id}/chats/{chat_id}/messages"
         payload = {"message": {"text": text}, "type": "text"}
-        async with self.session.post(url, json=payload) as res:
-            return res.status == 200
+        status, _ = await self._request("POST", url, "send_message", json=payload)
+        return status == 200
 
 
 async def generate_response_with_openai(messages, item):
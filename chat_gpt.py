@@ -1,62 +1,226 @@
-import aiohttp
+import asyncio
 import json
+import logging
+import time
+import aiohttp
 from config import (
     SYSTEM_PROMPT, 
     EXTRACTION_PROMPT_TEMPLATE, 
+    SUMMARY_PROMPT_TEMPLATE,
+    EXTRACTION_PARTIAL_PROMPT_TEMPLATE,
+    EXTRACTION_FIELD_DESCRIPTIONS,
     FIRST_MESSAGE_INSTRUCTION,
     COMPLETION_MARKER,
     OPENAI_ERROR,
     OPENAI_API_KEY,
-    OPENAI_MODEL
+    OPENAI_MODEL,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    OPENAI_MAX_RETRIES,
+    OPENAI_REQUEST_TIMEOUT,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_MAX
 )
+from http_pool import get_session
+from metrics import track, upstream_errors
+from tracing import record_turn_usage
+from rate_limiter import OpenAIRateLimiter
+from streaming import ParagraphStream, parse_sse_line
+from message_cache import ROLE_LABELS, merge_turns
+from local_extraction import CLIENT_DATA_FIELDS, extract_local, missing_fields
+
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
 
 # Удаляем константы конфигурации
 
+LABEL_ROLES = {f"{label}: ": role for role, label in ROLE_LABELS.items()}
+
+
+def parse_dialog_history(dialog_history):
+    """Текстовая история "Клиент: ... / Светлана: ..." -> реплики (роль, текст)"""
+    turns = []
+    for line in dialog_history.splitlines():
+        for prefix, role in LABEL_ROLES.items():
+            if line.startswith(prefix):
+                turns.append((role, line[len(prefix):].strip()))
+                break
+        else:
+            # Продолжение многострочного сообщения
+            if turns:
+                turns[-1] = (turns[-1][0], turns[-1][1] + "\n" + line)
+            elif line.strip():
+                turns.append(("user", line))
+    return merge_turns(turns)
+
+
+def build_agent_messages(dialog, summary=None):
+    """Сообщения запроса: неизменный системный промпт, затем реплики по ролям.
+    
+    Между ходами диалога меняется только хвост списка, поэтому префикс
+    запроса совпадает с прошлым и попадает в кэш промптов OpenAI.
+    Краткое содержание начала диалога идет вторым системным сообщением.
+    """
+    if isinstance(dialog, str):
+        dialog = parse_dialog_history(dialog)
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Начало диалога (кратко):\n{summary}"})
+    return messages + list(dialog)
+
 
 class ChatGPTHandler:
     def __init__(self, api_key, model="gpt-4o"):
         self.api_key = api_key
         self.model = model
         self.base_url = "https://api.openai.com/v1/chat/completions"
+        # Клиентские лимиты: запросы ждут в очереди, а не падают на 429
+        self.limiter = OpenAIRateLimiter(
+            OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT,
+            max_retries=OPENAI_MAX_RETRIES,
+            backoff_base=OPENAI_BACKOFF_BASE,
+            backoff_max=OPENAI_BACKOFF_MAX
+        )
+        self.timeout = aiohttp.ClientTimeout(total=OPENAI_REQUEST_TIMEOUT)
         
-    async def _make_request(self, messages, temperature=0.7):
-        """Базовый запрос к OpenAI API"""
-        headers = {
+    def _headers(self):
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+    
+    async def _post(self, payload, read_response):
+        """Запрос к OpenAI API с лимитами и повторами.
         
+        read_response(response) разбирает успешный ответ; повтор возможен
+        только до его вызова, чтобы не отправить клиенту абзацы дважды.
+        """
+        estimated_tokens = self.limiter.estimate_tokens(payload["messages"])
+        operation = "stream" if payload.get("stream") else "completion"
+        session = get_session("openai")
+        
+        for attempt in range(self.limiter.max_retries + 1):
+            await self.limiter.acquire(estimated_tokens)
+            started = time.monotonic()
+            retry_headers = None
+            with track("openai", operation):
+                try:
+                    async with session.post(self.base_url, headers=self._headers(), json=payload, timeout=self.timeout) as response:
+                        self.limiter.update_from_headers(response.headers)
+                        if response.status == 200:
+                            result = await read_response(response)
+                            self.limiter.record_latency(time.monotonic() - started)
+                            return result
+                        
+                        error_text = await response.text()
+                        upstream_errors.inc(upstream="openai", operation=operation)
+                        logger.error(f"OpenAI API error: {response.status} — {error_text}")
+                        # Исчерпанную квоту повторами не исправить
+                        if response.status not in RETRYABLE_STATUSES or "insufficient_quota" in error_text:
+                            self.limiter.counters["errors"] += 1
+                            return None
+                        if response.status == 429:
+                            self.limiter.counters["throttled"] += 1
+                        retry_headers = response.headers
+                except asyncio.TimeoutError:
+                    upstream_errors.inc(upstream="openai", operation=operation)
+                    self.limiter.counters["timeouts"] += 1
+                    logger.warning(f"OpenAI request timeout после {OPENAI_REQUEST_TIMEOUT} с")
+                except aiohttp.ClientError as e:
+                    upstream_errors.inc(upstream="openai", operation=operation)
+                    logger.error(f"OpenAI request error: {e}")
+                except Exception as e:
+                    upstream_errors.inc(upstream="openai", operation=operation)
+                    logger.error(f"OpenAI request error: {e}")
+                    self.limiter.counters["errors"] += 1
+                    return None
+            
+            if attempt < self.limiter.max_retries:
+                delay = self.limiter.retry_delay(attempt, retry_headers)
+                self.limiter.counters["retries"] += 1
+                logger.warning(f"Повтор запроса к OpenAI через {delay:.1f} с (попытка {attempt + 2})")
+                await asyncio.sleep(delay)
+        
+        self.limiter.counters["errors"] += 1
+        return None
+    
+    async def _make_request(self, messages, temperature=0.7):
+        """Базовый запрос к OpenAI API: ответ целиком"""
         payload = {
             "model": self.model,
             "messages": messages,
             "temperature": temperature
         }
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["choices"][0]["message"]["content"]
-                    else:
-                        error_text = await response.text()
-                        print(f"OpenAI API error: {response.status} — {error_text}")
-                        return None
-        except Exception as e:
-            print(f"OpenAI request error: {e}")
-            return None
+        async def read_response(response):
+            data = await response.json()
+            self.limiter.record_usage(data.get("usage"))
+            record_turn_usage(data.get("usage"))
+            return data["choices"][0]["message"]["content"]
+        
+        return await self._post(payload, read_response)
     
-    async def generate_response(self, dialog_history, is_first_message=False):
-        """Генерация ответа агента по аренде"""
+    async def _stream_request(self, messages, on_paragraph, temperature=0.7):
+        """Потоковый запрос: каждый готовый абзац сразу уходит в on_paragraph.
+        
+        Возвращает ParagraphStream с отправленным текстом и флагом
+        завершения диалога, либо None, если поток не удалось открыть.
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+            # Последний чанк потока содержит usage с cached_tokens
+            "stream_options": {"include_usage": True}
+        }
+        
+        async def deliver(paragraphs):
+            """Передать абзацы; ошибка отправки не должна привести к повтору запроса"""
+            for paragraph in paragraphs:
+                try:
+                    await on_paragraph(paragraph)
+                except Exception as e:
+                    logger.error(f"Ошибка передачи абзаца ответа: {e}")
+                    return False
+            return True
+        
+        async def read_response(response):
+            stream = ParagraphStream(COMPLETION_MARKER)
+            lines = response.content.__aiter__()
+            while True:
+                # Под try только чтение потока: ошибки отправки абзацев сюда не попадают
+                try:
+                    line = await lines.__anext__()
+                except StopAsyncIteration:
+                    break
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    # Часть ответа уже у клиента: повторять запрос нельзя
+                    logger.warning(f"OpenAI stream interrupted: {e}")
+                    break
+                text, usage, done = parse_sse_line(line.decode("utf-8", "replace"))
+                if usage:
+                    self.limiter.record_usage(usage)
+                    record_turn_usage(usage)
+                if not await deliver(stream.feed(text)):
+                    return stream
+                if done:
+                    break
+            await deliver(stream.finish())
+            return stream
+        
+        return await self._post(payload, read_response)
+    
+    async def generate_response(self, dialog_history, is_first_message=False, summary=None):
+        """Генерация ответа агента по аренде.
+        
+        dialog_history - реплики [{"role", "content"}] или текстовая история.
+        """
         try:
-            # Используем только основной системный промпт
-            system_prompt = SYSTEM_PROMPT
-            
-            # Формируем сообщения для API
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": dialog_history}
-            ]
+            # Системный промпт и реплики диалога по ролям
+            messages = build_agent_messages(dialog_history, summary)
             
             # Получаем ответ от GPT
             response = await self._make_request(messages)
@@ -67,16 +231,53 @@ class ChatGPTHandler:
             return response.strip()
             
         except Exception as e:
-            print(f"Error generating response: {e}")
+            logger.error(f"Error generating response: {e}")
             return OPENAI_ERROR
     
-    async def extract_client_data(self, dialog_history):
-        """Извлечение структурированных данных о клиенте из диалога"""
+    async def stream_response(self, dialog_history, on_paragraph, summary=None):
+        """Потоковая генерация ответа агента с отправкой по абзацам"""
         try:
-            # Формируем промпт для извлечения данных
-            extraction_prompt = EXTRACTION_PROMPT_TEMPLATE.format(
+            messages = build_agent_messages(dialog_history, summary)
+            return await self._stream_request(messages, on_paragraph)
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            return None
+    
+    async def summarize_dialog(self, previous_summary, turns):
+        """Краткое содержание старых реплик с учетом предыдущего содержания"""
+        try:
+            dialog_history = "\n".join(
+                f"{ROLE_LABELS[turn['role']]}: {turn['content']}" for turn in turns
+            )
+            prompt = SUMMARY_PROMPT_TEMPLATE.format(
+                previous_summary=previous_summary or "нет",
                 dialog_history=dialog_history
             )
+            response = await self._make_request([{"role": "user", "content": prompt}], temperature=0.1)
+            return response.strip() if response else None
+        except Exception as e:
+            logger.error(f"Error summarizing dialog: {e}")
+            return None
+    
+    async def extract_client_data(self, dialog_history, fields=None):
+        """Извлечение структурированных данных о клиенте из диалога.
+        
+        fields - список полей, если модель нужна только для части заявки.
+        """
+        try:
+            # Формируем промпт для извлечения данных
+            if fields:
+                extraction_prompt = EXTRACTION_PARTIAL_PROMPT_TEMPLATE.format(
+                    dialog_history=dialog_history,
+                    fields=json.dumps(
+                        {name: EXTRACTION_FIELD_DESCRIPTIONS[name] for name in fields},
+                        ensure_ascii=False, indent=3
+                    )
+                )
+            else:
+                extraction_prompt = EXTRACTION_PROMPT_TEMPLATE.format(
+                    dialog_history=dialog_history
+                )
             
             messages = [
                 {"role": "user", "content": extraction_prompt}
@@ -93,12 +294,12 @@ class ChatGPTHandler:
                 client_data = json.loads(response)
                 return client_data
             except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {e}")
-                print(f"Raw response: {response}")
+                logger.error(f"JSON parsing error: {e}")
+                logger.warning(f"Raw response: {response}")
                 return None
                 
         except Exception as e:
-            print(f"Error extracting client data: {e}")
+            logger.error(f"Error extracting client data: {e}")
             return None
     
     def is_dialog_complete(self, response):
@@ -108,13 +309,61 @@ class ChatGPTHandler:
 # Глобальный экземпляр ChatGPT хендлера
 chatgpt_handler = ChatGPTHandler(OPENAI_API_KEY, OPENAI_MODEL)
 
-async def get_agent_response(dialog_history, is_first_message=False):
+async def get_agent_response(dialog_history, is_first_message=False, summary=None):
     """Получение ответа агента"""
-    return await chatgpt_handler.generate_response(dialog_history, is_first_message)
+    return await chatgpt_handler.generate_response(dialog_history, is_first_message, summary)
+
+async def stream_agent_response(dialog_history, on_paragraph, summary=None):
+    """Ответ агента потоком: абзацы передаются в on_paragraph по мере готовности"""
+    return await chatgpt_handler.stream_response(dialog_history, on_paragraph, summary)
+
+async def summarize_dialog(previous_summary, turns):
+    """Краткое содержание начала длинного диалога"""
+    return await chatgpt_handler.summarize_dialog(previous_summary, turns)
+
+# Сколько заявок обошлось без модели или с урезанным запросом
+extraction_stats = {"dialogs": 0, "llm_skipped": 0, "llm_partial": 0, "llm_full": 0, "local_fields": 0}
+
+async def extract_final_client_data(dialog_history, today=None):
+    """Извлечение финальных данных клиента.
+    
+    Шаблонные поля (телефон, даты, срок, явно названные жильцы) ищутся
+    локально; модель получает запрос только на оставшиеся поля, а если
+    найдено все - не вызывается вовсе.
+    """
+    extraction_stats["dialogs"] += 1
+    local_data = extract_local(parse_dialog_history(dialog_history), today)
+    missing = missing_fields(local_data)
+    extraction_stats["local_fields"] += len(local_data)
+    
+    if not missing:
+        extraction_stats["llm_skipped"] += 1
+        return local_data
+    
+    if local_data:
+        extraction_stats["llm_partial"] += 1
+        llm_data = await chatgpt_handler.extract_client_data(dialog_history, missing)
+    else:
+        extraction_stats["llm_full"] += 1
+        llm_data = await chatgpt_handler.extract_client_data(dialog_history)
+    if llm_data is None:
+        return None
+    
+    # Локальное значение - только для полей, которые модель не заполнила
+    client_data = {name: llm_data.get(name) for name in CLIENT_DATA_FIELDS}
+    for name, value in local_data.items():
+        if client_data[name] is None:
+            client_data[name] = value
+    return client_data
+
+def get_extraction_stats():
+    """Доля заявок, для которых модель не понадобилась"""
+    dialogs = extraction_stats["dialogs"]
+    return {**extraction_stats, "skip_ratio": extraction_stats["llm_skipped"] / dialogs if dialogs else 0.0}
 
-async def extract_final_client_data(dialog_history):
-    """Извлечение финальных данных клиента"""
-    return await chatgpt_handler.extract_client_data(dialog_history)
+def get_openai_stats():
+    """Перцентили задержек OpenAI, очередь лимитера и счетчики 429/повторов"""
+    return chatgpt_handler.limiter.stats()
 
 def check_dialog_completion(response):
     """Проверка завершенности сбора информации"""
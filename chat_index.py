@@ -0,0 +1,39 @@
+class ChatChangeIndex:
+    """Индекс изменений чатов по данным списка get_chats"""
+
+    def __init__(self):
+        # chat_id -> подпись последнего обработанного состояния чата
+        self.signatures = {}
+        # Счетчики для оценки экономии запросов get_messages
+        self.stats = {"checked": 0, "fetched": 0, "skipped": 0}
+
+    @staticmethod
+    def signature(chat):
+        """Подпись чата: время обновления и последнее сообщение"""
+        last_message = chat.get("last_message") or {}
+        return (chat.get("updated"), last_message.get("id"), last_message.get("created"))
+
+    def has_changed(self, chat):
+        """Изменился ли чат с прошлого цикла (подпись сразу запоминается)"""
+        chat_id = chat.get("id")
+        signature = self.signature(chat)
+        self.stats["checked"] += 1
+
+        # Без данных о последнем сообщении сравнивать не с чем - загружаем всегда
+        if signature != (None, None, None) and self.signatures.get(chat_id) == signature:
+            self.stats["skipped"] += 1
+            return False
+
+        self.signatures[chat_id] = signature
+        self.stats["fetched"] += 1
+        return True
+
+    def invalidate(self, chat_id):
+        """Сбросить подпись, чтобы чат был загружен в следующем цикле (например, после ошибки)"""
+        self.signatures.pop(chat_id, None)
+
+    def skip_ratio(self):
+        """Доля пропущенных загрузок сообщений"""
+        if not self.stats["checked"]:
+            return 0.0
+        return self.stats["skipped"] / self.stats["checked"]
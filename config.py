@@ -2,21 +2,145 @@
 # OpenAI Configuration
 OPENAI_API_KEY = "ВАШ_АПИ_КЛЮЧ"
 OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_RPM_LIMIT = 500  # запросов в минуту (лимит вашего тарифа)
+OPENAI_TPM_LIMIT = 200000  # токенов в минуту (лимит вашего тарифа)
+OPENAI_MAX_RETRIES = 4  # повторы при 429/5xx и таймаутах
+OPENAI_REQUEST_TIMEOUT = 60  # таймаут одного запроса в секундах
+OPENAI_BACKOFF_BASE = 1.0  # начальная пауза перед повтором
+OPENAI_BACKOFF_MAX = 30.0  # максимальная пауза перед повтором
+OPENAI_STREAMING = False  # отправлять ответ клиенту по абзацам по мере генерации
 
 # Avito API Configuration  
 AVITO_USER_ID = 000000000  # <-- подставь свой ID
 AVITO_CLIENT_ID = "КЛИЕНТ_АЙДИ"
 AVITO_CLIENT_SECRET = "СИКРЕТ_КЕЙ"
+AVITO_TOKEN_CACHE_FILE = None  # например "avito_token.json" - переживает перезапуск без нового запроса токена
+AVITO_TOKEN_REFRESH_MARGIN = 5 * 60  # обновлять токен за N секунд до истечения
+
+# Несколько аккаунтов Avito в одном процессе: у каждого свой токен и состояние чатов,
+# лимиты OpenAI и очередь заявок в Telegram - общие. Аккаунт "default" хранит
+# состояние под прежними именами, остальные - с префиксом "имя/".
+AVITO_ACCOUNTS = [
+    {
+        "name": "default",
+        "user_id": AVITO_USER_ID,
+        "client_id": AVITO_CLIENT_ID,
+        "client_secret": AVITO_CLIENT_SECRET,
+        "token_cache_file": AVITO_TOKEN_CACHE_FILE,
+    },
+    # {"name": "second", "user_id": 111111111, "client_id": "...", "client_secret": "..."},
+]
 
 # Telegram Bot Configuration
 TELEGRAM_BOT_TOKEN = "ТОКЕН_БОТА"
 TELEGRAM_CHAT_ID = "ЧАТ_АЙДИ"  # ID чата куда отправлять заявки
+TELEGRAM_CHAT_MIN_INTERVAL = 3.0  # пауза между сообщениями в один чат (группы: до 20 в минуту)
+TELEGRAM_GLOBAL_MIN_INTERVAL = 0.05  # пауза между любыми сообщениями бота (до 30 в секунду)
+TELEGRAM_MAX_ATTEMPTS = 50  # после стольких неудачных попыток заявка снимается из очереди
+
+# Фоновая обработка завершенных диалогов (извлечение данных и постановка заявки)
+COMPLETION_WORKERS = 2  # параллельных обработчиков
+COMPLETION_RETRY_DELAY = 30  # начальная пауза перед повтором при ошибке (сек)
+COMPLETION_MAX_ATTEMPTS = 20  # после стольких ошибок задание снимается
+
+# Адреса объявлений (Nominatim): кэш на диске и не больше 1 запроса в секунду
+GEOCODE_CACHE_FILE = "geocode_cache.json"  # None - кэш только в памяти
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60  # адрес по координатам считаем актуальным N секунд
+GEOCODE_CACHE_MAX_ENTRIES = 1000  # максимум адресов в кэше
+GEOCODE_PRECISION = 5  # знаков после запятой в ключе кэша (~1 м)
+NOMINATIM_MIN_INTERVAL = 1.0  # пауза между запросами к Nominatim (их правила: 1 rps)
 
 # ================== НАСТРОЙКИ РАБОТЫ БОТА ==================
 CHECK_INTERVAL = 5  # в секундах - интервал проверки новых сообщений
 TIME_WINDOW_HOURS = 3  # новые сообщения за последние N часов
-MAX_MESSAGES_HISTORY = 30  # максимум сообщений для контекста GPT
-FOLLOWUP_CHECK_INTERVAL = 30 * 60  # проверка follow-up каждые 30 минут
+MAX_MESSAGES_HISTORY = 100  # окно сообщений чата в кэше (в промпт идет то, что влезает в бюджет)
+CONTEXT_TOKEN_BUDGET = 1500  # бюджет токенов на историю диалога в запросе к GPT
+CONTEXT_KEEP_RATIO = 0.5  # доля бюджета, остающаяся свежим репликам после сворачивания
+
+# Кэш сообщений чатов: после первой загрузки запрашиваются только новые сообщения
+MESSAGE_CACHE_PAGE_SIZE = 5  # размер страницы при догрузке новых сообщений
+MESSAGE_CACHE_MAX_CHATS = 2000  # максимум чатов в кэше (вытесняются давно не активные)
+MESSAGE_CACHE_MAX_MESSAGES = 60000  # максимум сообщений в кэше суммарно
+MESSAGE_CACHE_TTL = 6 * 60 * 60  # чат без активности дольше N секунд удаляется из кэша
+FOLLOWUP_MAX_SLEEP = 60  # follow-up ждут своего времени по таймеру, но не дольше N секунд подряд
+FOLLOWUP_RETRY_DELAY = 60  # повтор follow-up через N секунд после ошибки отправки
+# Список чатов запрашивается страницами до первого чата старше TIME_WINDOW_HOURS
+CHATS_PAGE_SIZE = 100  # чатов на страницу (максимум API)
+CHATS_UNREAD_ONLY = False  # только непрочитанные (прочитанные в приложении Avito будут пропущены)
+CHATS_TYPES = None  # типы чатов, например ["u2i"] - только по объявлениям; None - все
+
+# ================== НАСТРОЙКИ WEBHOOK ==================
+# В режиме webhook Avito сам присылает новые сообщения, а опрос get_chats
+# остается только редкой сверкой на случай потерянных событий
+WEBHOOK_ENABLED = False
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/avito/webhook"
+WEBHOOK_PUBLIC_URL = None  # внешний адрес, например "https://bot.example.com/avito/webhook?token=..."
+WEBHOOK_SECRET = None  # если задан - требуется параметр ?token=<секрет> в адресе webhook
+WEBHOOK_RECONCILE_INTERVAL = 5 * 60  # интервал сверочного опроса в секундах
+
+# ================== МЕТРИКИ ==================
+# Страница /metrics в формате Prometheus: задержки апстримов, цикл опроса, очереди
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9838  # не 9100: его обычно занимает node_exporter
+METRICS_PATH = "/metrics"
+
+# ================== ТРАССИРОВКА ==================
+# Каждый ход диалога - строка JSON с длительностью этапов (загрузка, этап, история,
+# запрос к модели, отправка, завершение); файл пишется в фоне и ротируется по размеру
+TRACE_ENABLED = True
+TRACE_FILE = "traces.jsonl"
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUP_COUNT = 5
+
+# ================== ЛОГИРОВАНИЕ ==================
+# Записи уходят в очередь и пишутся отдельным потоком - медленный stdout/journald
+# не блокирует обработку чатов
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"  # "text" или "json" (одна запись - одна строка JSON)
+LOG_FILE = None  # None - stdout
+# Уровни отдельных модулей, например {"chat_gpt": "DEBUG", "outbox": "WARNING"}
+LOG_MODULE_LEVELS = {
+    "main.dialog": "WARNING",  # подробный дамп истории перед запросом к модели; "DEBUG" - включить
+    "aiohttp.access": "WARNING",  # журнал запросов к webhook-серверу и /metrics
+}
+LOG_DIALOG_DUMP_SAMPLE_RATE = 0.05  # доля ходов, для которых пишется дамп (когда он включен)
+
+# ================== ПАРАЛЛЕЛЬНОСТЬ ==================
+# Максимум одновременных запросов к каждому апстриму
+UPSTREAM_CONCURRENCY_LIMITS = {
+    "avito": 10,
+    "openai": 5,
+    "telegram": 2
+}
+# Максимум ходов одного аккаунта одновременно: занятый аккаунт не занимает
+# все места в общих очередях к Avito и OpenAI
+ACCOUNT_CHAT_CONCURRENCY = 10
+
+# ================== НЕСКОЛЬКО ПРОЦЕССОВ ==================
+# Чаты делятся на разделы по хешу id; каждый процесс арендует часть разделов
+# в общей базе и отвечает только в своих чатах. Упавший процесс теряет аренду
+# через PARTITION_LEASE_TTL секунд, и его разделы забирают остальные.
+# Каждый процесс запускается из своего каталога (свои config.py и STATE_DB_PATH),
+# PARTITION_DB_PATH у всех указывает на один файл.
+PARTITIONING_ENABLED = False
+PARTITION_DB_PATH = "partitions.db"  # например "/mnt/shared/avito_bot/partitions.db"
+PARTITION_COUNT = 64  # число разделов (одинаковое у всех процессов)
+PARTITION_LEASE_TTL = 30  # срок аренды в секундах (больше самого долгого хода); продление каждые TTL/3
+PARTITION_CLOCK_MARGIN = 5  # запас на расхождение часов между хостами (сек)
+WORKER_ID = None  # имя процесса; по умолчанию "хост:рабочий_каталог"
+
+# ================== НАСТРОЙКИ HTTP ==================
+HTTP_POOL_LIMIT = 100  # максимум соединений в пуле одной сессии
+HTTP_POOL_LIMIT_PER_HOST = 20  # максимум соединений к одному хосту
+HTTP_DNS_CACHE_TTL = 300  # кэш DNS в секундах
+HTTP_KEEPALIVE_TIMEOUT = 60  # сколько держать простаивающее соединение открытым
+
+# Постоянное хранилище состояния (SQLite)
+STATE_DB_PATH = "bot_state.db"
+STATE_FLUSH_INTERVAL = 1  # пакетная запись изменений раз в N секунд
 
 # ================== НАСТРОЙКИ FOLLOW-UP ==================
 FOLLOWUP_INTERVALS = {
@@ -176,6 +300,56 @@ EXTRACTION_PROMPT_TEMPLATE = """
 Верни только JSON, без дополнительного текста.
    """
    
+# Описания полей заявки - для запроса только тех полей, что не найдены локально
+EXTRACTION_FIELD_DESCRIPTIONS = {
+   "name": "имя клиента",
+   "phone": "номер телефона",
+   "residents_info": "ТОЛЬКО ВЗРОСЛЫЕ (без детей): например 'парень 25 лет и девушка 23 года', 'мужчина 35 лет', 'женщина 28 лет'",
+   "residents_count": "число_взрослых_людей_без_детей",
+   "residents_details": "подробно: пол, возраст каждого ВЗРОСЛОГО",
+   "has_children": "true/false",
+   "children_details": "КОНКРЕТНО о детях (например'сын 8 лет', 'дочка 5 лет и сын 10 лет', 'ребенок 3 года')",
+   "has_pets": "true/false",
+   "pets_details": "КОНКРЕТНО о животных (например 'собака', 'коты', 'кот и собака', 'попугай')",
+   "rental_period": "срок аренды",
+   "move_in_deadline": "дата заезда",
+}
+
+# Промпт для извлечения только недостающих полей
+EXTRACTION_PARTIAL_PROMPT_TEMPLATE = """
+Проанализируй завершенный диалог и извлеки данные о клиенте.
+
+ДИАЛОГ:
+{dialog_history}
+
+Извлеки ТОЛЬКО эти поля в JSON формате:
+
+{fields}
+
+ПРАВИЛА:
+- residents_count и residents_info - ТОЛЬКО взрослые, НЕ включать детей!
+- has_children и has_pets только true/false
+- Если информация не найдена - null
+
+Верни только JSON, без дополнительного текста.
+"""
+
+# Промпт для краткого содержания начала длинного диалога
+SUMMARY_PROMPT_TEMPLATE = """
+Кратко перескажи начало диалога агента Светланы с клиентом по аренде квартиры.
+
+ПРЕДЫДУЩЕЕ КРАТКОЕ СОДЕРЖАНИЕ:
+{previous_summary}
+
+НОВЫЕ РЕПЛИКИ:
+{dialog_history}
+
+Сохрани все факты, которые клиент уже сообщил: состав проживающих (пол, возраст),
+дети, животные, имя, срок аренды, дата заезда, телефон, а также о чем Светлана
+уже спросила. Пиши коротко, списком, без приветствий и оценок.
+Верни только краткое содержание.
+"""
+
 #СООБЩЕНИЯ ОБ ОШИБКАХ
 TECHNICAL_ERROR = "Извините, произошла техническая ошибка.\nПопробуйте написать еще раз!"
 RESET_ERROR = "❌ Произошла ошибка.\nПопробуйте /start"
@@ -197,6 +371,38 @@ FINAL_PHRASE = "Отлично, обсудим вас с собственниц
 GREETING_PHRASE = "Здравствуйте, на связи Светлана, АН Skyline"
 START_QUESTION = "Расскажите, пожалуйста, кто проживать планирует"
 
+# Быстрые ответы без GPT: приветствие и частые вопросы (ответы - из SYSTEM_PROMPT)
+FAST_REPLIES_ENABLED = True
+FAST_REPLY_MAX_LENGTH = 150  # сообщения длиннее всегда уходят в GPT
+FAST_REPLY_MAX_EXTRA_WORDS = 0  # незнакомое слово обычно ответ на вопрос этапа - такие сообщения в GPT
+FAST_REPLY_FILLER_WORDS = [
+   "а", "и", "ли", "же", "у", "вас", "по", "за", "на", "это", "как", "какая", "какой", "какие", "каков",
+   "сколько", "подскажите", "скажите", "пожалуйста", "еще", "ещё", "вообще", "квартира", "квартиру",
+   "квартиры", "можно", "уместен", "возможен", "возможна", "там", "примерно", "выходит",
+   "ваша", "ваш", "какую", "берете", "берёте", "платить", "оплата", "в", "включена", "включены", "включено",
+   "входит",
+]
+GREETING_WORDS = ["здравствуйте", "здрасте", "добрый день", "добрый вечер", "доброе утро", "привет", "добрый"]
+FAQ_INTENTS = [
+   {"name": "availability", "keywords": ["актуальн", "свободн", "сдается", "сдаётся"],
+    "answer": "Да, свободна"},
+   {"name": "commission", "keywords": ["комисс"], "answer": "60% от месячной платы - ниже рынка"},
+   {"name": "utilities", "keywords": ["коммунал", "жкх", "квартплат"], "answer": "Летом ~3100₽, зимой 4200-4400₽"},
+   {"name": "min_term", "keywords": ["минимальн"], "answer": "От 6 месяцев"},
+   {"name": "discount", "keywords": ["торг", "скидк", "уступ"], "answer": "Обсуждаемо, уточню у собственницы"},
+   {"name": "viewing", "keywords": ["посмотреть", "просмотр"],
+    "answer": "Можем организовать в удобное время, но сначала пару вопросов"},
+]
+# Вопрос, которым быстрый ответ возвращает к сбору информации (этап -> вопрос)
+STAGE_QUESTIONS = {
+   "residents": START_QUESTION,
+   "children": "Подскажите, будут ли проживать дети",
+   "pets": "Подскажите, есть ли домашние животные",
+   "rental_period": "Подскажите, на какой срок планируете аренду",
+   "deadline": "Подскажите, какого числа планируете заселение",
+   "contacts": "Оставьте, пожалуйста, номер телефона для связи",
+}
+
 # Запрещенные фразы (для контроля качества)
 FORBIDDEN_PHRASES = [
       "давайте продолжим собирать информацию",
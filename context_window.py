@@ -0,0 +1,98 @@
+from functools import lru_cache
+
+from message_cache import merge_turns
+
+try:
+    import tiktoken
+except ImportError:  # токенизатор необязателен, без него - приблизительный подсчет
+    tiktoken = None
+
+# Служебные токены, которые API добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """Локальный подсчет токенов: tiktoken, если установлен, иначе ~3 символа на токен"""
+
+    def __init__(self, model):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+        # Тексты сообщений не меняются - каждый считаем один раз
+        self.count = lru_cache(maxsize=8192)(self._count)
+
+    def _count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return len(text) // 3 + 1
+
+
+class ContextWindow:
+    """История диалога в пределах бюджета токенов.
+
+    Старые реплики, не влезающие в бюджет, сворачиваются в краткое
+    содержание чата. Оно считается один раз и хранится вместе с границей
+    (created последней свернутой реплики), а сдвигается только когда
+    свежая часть снова превысит бюджет - тогда в ней остается около
+    keep_ratio бюджета. Между сдвигами префикс запроса не меняется.
+    """
+
+    def __init__(self, counter, budget, summarize, summaries, keep_ratio=0.5):
+        self.counter = counter
+        self.budget = budget
+        self.summarize = summarize
+        # chat_id -> {"upto": created, "summary": текст}
+        self.summaries = summaries
+        self.keep_ratio = keep_ratio
+        self.stats = {"builds": 0, "summarized": 0, "summary_errors": 0}
+
+    def tokens(self, line):
+        _, _, _, text = line
+        return self.counter.count(text) + MESSAGE_OVERHEAD_TOKENS
+
+    async def build(self, chat_id, lines):
+        """Вернуть (краткое содержание или None, реплики user/assistant в бюджете).
+
+        lines - реплики чата (ключ, created, роль, текст) от старых к новым.
+        """
+        self.stats["builds"] += 1
+        state = self.summaries.get(chat_id) or {}
+        upto = state.get("upto")
+        recent = [line for line in lines if upto is None or line[1] > upto]
+        summary = state.get("summary")
+
+        keep = self._split(recent) if sum(map(self.tokens, recent)) > self.budget else len(recent)
+        if keep < len(recent):
+            dropped = recent[:len(recent) - keep]
+            new_summary = await self.summarize(summary, merge_turns((role, text) for _, _, role, text in dropped))
+            if new_summary:
+                summary = new_summary
+                self.summaries[chat_id] = {"upto": dropped[-1][1], "summary": summary}
+                self.stats["summarized"] += 1
+            else:
+                # Без свежего содержания просто обрезаем, границу не сдвигаем
+                self.stats["summary_errors"] += 1
+            recent = recent[len(recent) - keep:]
+
+        return summary, merge_turns((role, text) for _, _, role, text in recent)
+
+    def _split(self, recent):
+        """Сколько последних реплик оставить как есть (хотя бы одну)"""
+        target = self.budget * self.keep_ratio
+        total = 0
+        keep = 0
+        for line in reversed(recent):
+            total += self.tokens(line)
+            if total > target and keep:
+                break
+            keep += 1
+        # Не разрываем реплики с одинаковым created: граница хранится по времени
+        while keep < len(recent) and recent[-keep - 1][1] == recent[-keep][1]:
+            keep += 1
+        return keep
+
+    def forget(self, chat_id):
+        self.summaries.pop(chat_id, None)
@@ -0,0 +1,126 @@
+from dataclasses import dataclass, field
+
+from config import COMPLETION_MARKER, MIN_PHONE_DIGITS
+
+# Ключевые слова в сообщениях клиента (семейство -> подстроки)
+CLIENT_KEYWORDS = {
+    "residents": ["человек", "буду", "планирую", "один", "два", "три", "пара", "семья"],
+    "seven": ["семь"],
+    "period": ["месяц", "год"],
+    "vague_period": ["надолго", "постоянно"],
+    "month": ["август", "сентябр", "октябр", "ноябр", "декабр", "январ", "феврал", "март", "апрел", "май", "июн", "июл"],
+    "day_word": ["число"],
+}
+
+# Темы последнего сообщения агента (тема -> подстроки)
+AGENT_TOPICS = {
+    "residents": ["кто проживать планирует"],
+    "children": ["дет", "ребен"],
+    "pets": ["животн", "питом"],
+    "period": ["срок", "месяц"],
+    "date": ["дата", "заез"],
+    "contacts": ["телефон", "номер"],
+}
+
+
+def _compile_table(families):
+    """Таблица (семейство, кортеж подстрок) для проверки одним проходом.
+
+    Подстроки ищутся встроенным поиском str на общем тексте - в CPython это
+    заметно быстрее объединенного regex по кириллическим альтернативам."""
+    return tuple((name, tuple(words)) for name, words in families.items())
+
+
+CLIENT_TABLE = _compile_table(CLIENT_KEYWORDS)
+AGENT_TOPIC_TABLE = _compile_table(AGENT_TOPICS)
+DIGITS = "0123456789"
+
+
+def count_digits(text):
+    """Число цифр в тексте (str.count быстрее посимвольного перебора и regex)"""
+    return sum(map(text.count, DIGITS))
+
+
+@dataclass
+class DialogFeatures:
+    """Признаки диалога, собранные за один проход по сообщениям"""
+    has_agent_messages: bool = False
+    has_greeting: bool = False
+    has_completion_marker: bool = False
+    # Семейства ключевых слов, найденные в сообщениях клиента
+    client_families: set = field(default_factory=set)
+    has_phone: bool = False
+    # Темы последнего сообщения агента
+    last_agent_topics: frozenset = frozenset()
+
+    @property
+    def has_residents(self):
+        return "residents" in self.client_families
+
+    @property
+    def has_residents_info(self):
+        # "семь" дополнительно засчитывается при определении этапа
+        return self.has_residents or "seven" in self.client_families
+
+    @property
+    def has_period(self):
+        return "period" in self.client_families
+
+    @property
+    def has_period_info(self):
+        # "надолго" и "постоянно" засчитываются для этапа, но не для завершения
+        return self.has_period or "vague_period" in self.client_families
+
+    @property
+    def has_date(self):
+        families = self.client_families
+        return "month" in families or ("day_word" in families and "digit" in families)
+
+
+def extract_dialog_features(messages):
+    """Собрать признаки диалога за один проход по сообщениям"""
+    features = DialogFeatures()
+    client_texts = []
+    agent_texts = []
+
+    for message in messages:
+        if message.get("type") != "text":
+            continue
+        text = message.get("content", {}).get("text", "").strip()
+        if not text:
+            continue
+
+        if message.get("direction") == "out":
+            agent_texts.append(text)
+            if not features.has_greeting:
+                lowered = text.lower()
+                features.has_greeting = "здравствуйте" in lowered and "светлана" in lowered
+        else:
+            client_texts.append(text)
+
+    if agent_texts:
+        features.has_agent_messages = True
+        # Маркер не содержит перевода строки, поэтому ищем его сразу по всем сообщениям
+        features.has_completion_marker = COMPLETION_MARKER.lower() in "\n".join(agent_texts).lower()
+        last_agent_text = agent_texts[-1].lower()
+        features.last_agent_topics = frozenset(
+            name for name, words in AGENT_TOPIC_TABLE if any(word in last_agent_text for word in words)
+        )
+
+    # Ключевые слова ищем один раз по всему тексту клиента
+    client_text = "\n".join(client_texts).lower()
+    features.client_families = {
+        name for name, words in CLIENT_TABLE if any(word in client_text for word in words)
+    }
+
+    # Цифры считаем по сообщениям, только если их в сумме хватает на телефон
+    digits = count_digits(client_text)
+    if digits:
+        features.client_families.add("digit")
+    if digits >= MIN_PHONE_DIGITS:
+        # Телефон обычно в последних сообщениях - идем с конца до первого найденного
+        features.has_phone = any(
+            count_digits(text) >= MIN_PHONE_DIGITS
+            for text in reversed(client_texts) if len(text) >= MIN_PHONE_DIGITS
+        )
+    return features
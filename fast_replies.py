@@ -0,0 +1,94 @@
+import re
+
+from dialog_features import CLIENT_TABLE, count_digits
+
+WORD_RE = re.compile(r"[а-яёa-z]+")
+# "Не актуально", "нет, а комиссия?", "уже сняли" - ответ или отказ, решает GPT
+NEGATION_WORDS = frozenset({"не", "нет", "уже"})
+
+
+class FastReplyMatcher:
+    """Готовые ответы на приветствие и частые вопросы без запроса к GPT.
+
+    Срабатывает только на короткие сообщения, где кроме приветствия,
+    служебных слов и узнанных вопросов ничего нет: ни цифр, ни отрицаний,
+    ни сведений о жильцах, сроках и датах. Незнакомое слово чаще всего -
+    ответ на вопрос этапа ("Двое. Какая комиссия?"), поэтому такие
+    сообщения тоже уходят в GPT.
+    """
+
+    def __init__(self, intents, greeting_words, greeting_phrase, start_question, stage_questions,
+                 filler_words=(), max_length=150, max_extra_words=0):
+        self.intents = [(intent["name"], tuple(intent["keywords"]), intent["answer"]) for intent in intents]
+        self.greeting_words = tuple(greeting_words)
+        self.greeting_phrase = greeting_phrase
+        self.start_question = start_question
+        self.stage_questions = stage_questions
+        self.max_length = max_length
+        self.filler_words = frozenset(filler_words)
+        self.max_extra_words = max_extra_words
+        self.stats = {"checked": 0, "hits": 0, "greetings": 0}
+        self.intent_hits = {name: 0 for name, _, _ in self.intents}
+
+    def _match(self, text):
+        """(узнанные вопросы, есть приветствие) или None, если сообщение неоднозначно"""
+        if len(text) > self.max_length or count_digits(text):
+            return None
+        # Сведения для заявки (жильцы, сроки, даты) разбирает только GPT
+        for _, words in CLIENT_TABLE:
+            for word in words:
+                if word in text:
+                    return None
+
+        has_greeting = False
+        for phrase in self.greeting_words:
+            if phrase in text:
+                has_greeting = True
+                text = text.replace(phrase, " ")
+
+        matched = {}
+        unknown = 0
+        for word in WORD_RE.findall(text):
+            if word in NEGATION_WORDS:
+                return None
+            for name, keywords, answer in self.intents:
+                if any(keyword in word for keyword in keywords):
+                    matched.setdefault(name, answer)
+                    break
+            else:
+                if word not in self.filler_words:
+                    unknown += 1
+        # Незнакомые слова могут нести смысл - тогда решает GPT
+        if unknown > self.max_extra_words:
+            return None
+        return list(matched.items()), has_greeting
+
+    def reply(self, client_texts, is_first_message, stage):
+        """Готовый ответ на новые сообщения клиента или None"""
+        self.stats["checked"] += 1
+        if not client_texts:
+            return None
+        question = self.start_question if is_first_message else self.stage_questions.get(stage)
+        if question is None:
+            return None
+
+        result = self._match(" ".join(client_texts).lower())
+        if result is None:
+            return None
+        matched, has_greeting = result
+        if not matched and not (is_first_message and has_greeting):
+            return None
+
+        paragraphs = [self.greeting_phrase] if is_first_message else []
+        paragraphs += [answer for _, answer in matched]
+        paragraphs.append(question)
+
+        self.stats["hits"] += 1
+        if not matched:
+            self.stats["greetings"] += 1
+        for name, _ in matched:
+            self.intent_hits[name] += 1
+        return "\n\n".join(paragraphs)
+
+    def hit_rate(self):
+        return self.stats["hits"] / self.stats["checked"] if self.stats["checked"] else 0.0
@@ -0,0 +1,83 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class FollowupQueue:
+    """Очередь follow-up на куче: ближайший по времени чат всегда сверху"""
+
+    def __init__(self):
+        # Куча (время, порядковый номер, chat_id); отмененные записи удаляются лениво
+        self._heap = []
+        # chat_id -> (время, порядковый номер) актуальной записи
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._entries
+
+    def schedule(self, chat_id, when):
+        """Запланировать (или перенести) follow-up чата на время when - O(log n)"""
+        seq = next(self._counter)
+        self._entries[chat_id] = (when, seq)
+        heapq.heappush(self._heap, (when, seq, chat_id))
+        self._compact()
+        # Разбудить ожидание, если новая запись раньше текущей ближайшей
+        if self._wakeup is not None and self.next_time() == when:
+            self._wakeup.set()
+
+    def cancel(self, chat_id):
+        """Отменить follow-up чата (запись в куче станет устаревшей)"""
+        self._entries.pop(chat_id, None)
+
+    def next_time(self):
+        """Время ближайшего follow-up или None"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Забрать все чаты, время которых наступило"""
+        now = time.time() if now is None else now
+        due = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, _, chat_id = heapq.heappop(self._heap)
+            del self._entries[chat_id]
+            due.append(chat_id)
+
+    def upcoming(self, limit=10):
+        """Ближайшие запланированные follow-up: [(время, chat_id), ...]"""
+        return heapq.nsmallest(limit, ((when, chat_id) for chat_id, (when, _) in self._entries.items()))
+
+    async def wait_due(self, max_sleep=60):
+        """Спать до ближайшего follow-up (или до появления более раннего)"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.clear()
+        next_time = self.next_time()
+        timeout = max_sleep if next_time is None else min(max(next_time - time.time(), 0), max_sleep)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _is_stale(self, item):
+        when, seq, chat_id = item
+        return self._entries.get(chat_id) != (when, seq)
+
+    def _drop_stale(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Перестраиваем кучу, когда устаревших записей становится слишком много
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [item for item in self._heap if not self._is_stale(item)]
+            heapq.heapify(self._heap)
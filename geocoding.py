@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from config import (
+    GEOCODE_CACHE_FILE,
+    GEOCODE_CACHE_TTL,
+    GEOCODE_CACHE_MAX_ENTRIES,
+    GEOCODE_PRECISION,
+    NOMINATIM_MIN_INTERVAL
+)
+from http_pool import get_session
+
+logger = logging.getLogger(__name__)
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
+
+
+async def get_address_from_coords(session, lat, lon, url=NOMINATIM_URL):
+    """Получение адреса по координатам через Nominatim API (None при ошибке)"""
+    params = {"format": "json", "lat": lat, "lon": lon, "zoom": 18, "addressdetails": 1}
+    headers = {"User-Agent": "AvitoBot/1.0"}
+
+    async with session.get(url, params=params, headers=headers) as resp:
+        if resp.status != 200:
+            logger.error(f"Nominatim error: {resp.status}")
+            return None
+        data = await resp.json()
+    address_parts = data.get("address", {})
+
+    # Формируем адрес из компонентов
+    address_components = []
+    for key in ["road", "house_number", "suburb", "city", "town", "village"]:
+        if address_parts.get(key):
+            address_components.append(address_parts[key])
+
+    return ", ".join(address_components) if address_components else data.get("display_name")
+
+
+class ReverseGeocoder:
+    """Кэш адресов объявлений перед Nominatim.
+
+    LRU в памяти с TTL, копия на диске переживает перезапуск. Запросы к
+    Nominatim идут не чаще одного в min_interval секунд, а одновременные
+    запросы одних координат ждут один общий поиск.
+    """
+
+    def __init__(self, cache_file=None, ttl=30 * 24 * 60 * 60, max_entries=1000, precision=5, min_interval=1.0):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.min_interval = min_interval
+        self.url = NOMINATIM_URL
+        # ключ -> [адрес, время сохранения], от давно не использованных к недавним
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = None
+        self._last_request = 0.0
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+        self._load()
+
+    def key(self, lat, lon):
+        return f"{round(float(lat), self.precision)},{round(float(lon), self.precision)}"
+
+    async def address(self, lat, lon):
+        """Адрес по координатам или None, если Nominatim не ответил"""
+        key = self.key(lat, lon)
+        entry = self._entries.get(key)
+        if entry and time.time() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._lookup(key, lat, lon))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет общий поиск
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key, lat, lon):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            delay = self._last_request + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                address = await get_address_from_coords(get_session("nominatim"), lat, lon, self.url)
+            except Exception as e:
+                logger.error(f"Ошибка получения адреса: {e}")
+                address = None
+            finally:
+                self._last_request = time.monotonic()
+
+        if address is None:
+            # Ошибки не кэшируем - следующая заявка попробует снова
+            self.stats["errors"] += 1
+            return None
+        self._entries[key] = [address, time.time()]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._save()
+        return address
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать кэш адресов: {e}")
+            return
+        now = time.time()
+        # В файле записи от старых к новым - порядок LRU сохраняется
+        for key, (address, stored_at) in cached.items():
+            if now - stored_at < self.ttl:
+                self._entries[key] = [address, stored_at]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        tmp_path = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш адресов: {e}")
+
+
+# Общий кэш адресов для всех заявок
+geocoder = ReverseGeocoder(
+    GEOCODE_CACHE_FILE,
+    ttl=GEOCODE_CACHE_TTL,
+    max_entries=GEOCODE_CACHE_MAX_ENTRIES,
+    precision=GEOCODE_PRECISION,
+    min_interval=NOMINATIM_MIN_INTERVAL
+)
+
+
+async def get_listing_address(lat, lon):
+    """Адрес объявления через кэш (None, если получить не удалось)"""
+    return await geocoder.address(lat, lon)
@@ -0,0 +1,34 @@
+import aiohttp
+from config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT
+)
+
+# Общие сессии процесса (имя апстрима -> aiohttp.ClientSession)
+_sessions = {}
+
+
+def get_session(name):
+    """Получить сессию с пулом соединений для апстрима (создается при первом обращении)"""
+    session = _sessions.get(name)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[name] = session
+    return session
+
+
+async def close_all_sessions():
+    """Закрыть все сессии при остановке процесса"""
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
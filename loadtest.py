@@ -0,0 +1,402 @@
+"""
+Нагрузочный тест AvitoRentalBot без сети.
+
+Поднимает локальные имитации Avito Messenger, OpenAI и Telegram с заданными
+задержками и долей ошибок, запускает N клиентов, которые переписываются с
+ботом, и гоняет настоящие циклы опроса бота. В конце - время цикла,
+перцентили задержки ответа и число запросов к каждому апстриму.
+
+Запуск: python loadtest.py --chats 500 --duration 120
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from logging_setup import setup_logging, shutdown_logging
+from rate_limiter import percentile
+
+ACCOUNT_ID = 1000
+CLIENT_AUTHOR_ID = 2000
+
+# Реплики клиентов: один вариант из каждой строки, по порядку
+CLIENT_SCRIPT = (
+    ("Здравствуйте, квартира еще сдается?", "Добрый день! Актуально?", "Здравствуйте"),
+    ("Нас двое, парень 27 лет и девушка 24 года", "Буду жить одна, мне 30 лет", "Семья, муж 35 лет и жена 32 года"),
+    ("Детей нет", "Без детей", "Сын 7 лет"),
+    ("Животных нет", "С котом", "Без животных"),
+    ("Какая комиссия?", "На год", "Надолго, минимум год"),
+    ("На полгода", "Заехать хотим с 1 ноября", "Через неделю"),
+    ("Заезд в конце месяца", "Анна", "Меня зовут Дмитрий"),
+    ("+7 912 345-67-89", "8 (921) 555-12-34", "89161234567"),
+)
+
+# Вопросы агента по порядку хода (имитация OpenAI)
+AGENT_QUESTIONS = (
+    "Здравствуйте, на связи Светлана, АН Skyline\n\nРасскажите, пожалуйста, кто проживать планирует",
+    "Спасибо! Дети с вами будут?",
+    "Животные есть?",
+    "На какой срок планируете аренду?",
+    "Когда планируете заезд?",
+    "Как к вам можно обращаться?",
+    "Оставьте, пожалуйста, номер телефона",
+)
+
+
+class Upstream:
+    """Задержка и ошибки одного имитируемого апстрима"""
+
+    def __init__(self, name, latency, jitter, error_rate, error_status=500):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = Counter()
+        self.errors = Counter()
+
+    async def delay(self, endpoint):
+        """Подождать как настоящий сервер; True - ответить ошибкой"""
+        self.calls[endpoint] += 1
+        if self.latency > 0:
+            # Логнормальное распределение: медиана latency, хвост задает jitter
+            await asyncio.sleep(self.latency * random.lognormvariate(0, self.jitter))
+        if random.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            return True
+        return False
+
+    def error_response(self):
+        if self.error_status == 429:
+            return web.json_response({"error": {"message": "Rate limit"}}, status=429, headers={"retry-after": "1"})
+        return web.json_response({"error": "internal"}, status=self.error_status)
+
+
+class FakeChat:
+    def __init__(self, chat_id, script):
+        self.id = chat_id
+        self.script = script
+        self.messages = []  # от старых к новым
+        self.step = 0
+        self.waiting_since = None  # время последней реплики клиента без ответа
+        self.item = {"id": int(chat_id[4:]), "title": f"1-к. квартира, 38 м², {chat_id}", "location": {"title": "Москва"}}
+
+    def add(self, direction, text):
+        created = int(time.time())
+        message = {
+            "id": f"{self.id}-{len(self.messages)}",
+            "author_id": ACCOUNT_ID if direction == "out" else CLIENT_AUTHOR_ID,
+            "created": created,
+            "direction": direction,
+            "type": "text",
+            "content": {"text": text},
+        }
+        self.messages.append(message)
+        return message
+
+    def listing(self):
+        last = self.messages[-1] if self.messages else None
+        return {
+            "id": self.id,
+            "updated": last["created"] if last else 0,
+            "last_message": {"id": last["id"], "created": last["created"]} if last else None,
+            "context": {"type": "item", "value": self.item},
+        }
+
+
+class FakeAvito:
+    """Имитация Avito Messenger API и клиентов, которые отвечают боту"""
+
+    def __init__(self, upstream, chats, think_time):
+        self.upstream = upstream
+        self.think_time = think_time
+        self.chats = {f"chat{i:04d}": FakeChat(f"chat{i:04d}", [random.choice(row) for row in CLIENT_SCRIPT])
+                      for i in range(chats)}
+        self.reply_latencies = []
+        self.replies = 0
+        self.finished = 0
+        self._tasks = set()
+
+    def routes(self, app):
+        app.router.add_post("/token", self.token)
+        app.router.add_get("/messenger/v2/accounts/{user_id}/chats", self.get_chats)
+        app.router.add_get("/messenger/v3/accounts/{user_id}/chats/{chat_id}/messages/", self.get_messages)
+        app.router.add_post("/messenger/v1/accounts/{user_id}/chats/{chat_id}/messages", self.send_message)
+
+    async def token(self, request):
+        await self.upstream.delay("token")
+        return web.json_response({"access_token": "load-test", "expires_in": 24 * 60 * 60})
+
+    async def get_chats(self, request):
+        if await self.upstream.delay("get_chats"):
+            return self.upstream.error_response()
+        limit = int(request.query.get("limit", 100))
+        offset = int(request.query.get("offset", 0))
+        active = [chat for chat in self.chats.values() if chat.messages]
+        active.sort(key=lambda chat: chat.messages[-1]["created"], reverse=True)
+        return web.json_response({"chats": [chat.listing() for chat in active[offset:offset + limit]]})
+
+    async def get_messages(self, request):
+        if await self.upstream.delay("get_messages"):
+            return self.upstream.error_response()
+        chat = self.chats.get(request.match_info["chat_id"])
+        if chat is None:
+            return web.json_response({"error": "not found"}, status=404)
+        limit = int(request.query.get("limit", 20))
+        offset = int(request.query.get("offset", 0))
+        newest_first = chat.messages[::-1]
+        return web.json_response({"messages": newest_first[offset:offset + limit]})
+
+    async def send_message(self, request):
+        if await self.upstream.delay("send_message"):
+            return self.upstream.error_response()
+        chat = self.chats.get(request.match_info["chat_id"])
+        if chat is None:
+            return web.json_response({"error": "not found"}, status=404)
+        data = await request.json()
+        message = chat.add("out", data["message"]["text"])
+        self.replies += 1
+        if chat.waiting_since is not None:
+            # Задержка ответа - до первого абзаца, остальные абзацы не считаем
+            self.reply_latencies.append(time.time() - chat.waiting_since)
+            chat.waiting_since = None
+            self._schedule(chat, random.uniform(self.think_time, self.think_time * 2))
+        return web.json_response(message)
+
+    def start_clients(self, ramp):
+        """Первые сообщения клиентов - равномерно в течение ramp секунд"""
+        for chat in self.chats.values():
+            self._schedule(chat, random.uniform(0, ramp))
+
+    def _schedule(self, chat, delay):
+        task = asyncio.ensure_future(self._client_says(chat, delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _client_says(self, chat, delay):
+        await asyncio.sleep(delay)
+        if chat.step >= len(chat.script):
+            self.finished += 1
+            return
+        chat.add("in", chat.script[chat.step])
+        chat.step += 1
+        chat.waiting_since = time.time()
+
+    def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    def unanswered(self):
+        return sum(1 for chat in self.chats.values() if chat.waiting_since is not None)
+
+
+class FakeOpenAI:
+    """Имитация chat/completions: вопрос по номеру хода, затем [COMPLETE]"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def routes(self, app):
+        app.router.add_post("/v1/chat/completions", self.completions)
+
+    def answer(self, messages):
+        text = "\n".join(message.get("content") or "" for message in messages)
+        if "JSON" in text:
+            # Извлечение данных клиента
+            phone = re.search(r"\+?\d[\d\s\-()]{8,}\d", text)
+            return json.dumps({"name": "Клиент", "phone": phone.group() if phone else None,
+                               "residents_info": "двое взрослых", "residents_count": 2}, ensure_ascii=False)
+        if "Кратко перескажи" in text:
+            return "Клиент рассказал о жильцах и сроках."
+        user_turns = sum(1 for message in messages if message["role"] == "user")
+        if user_turns > len(AGENT_QUESTIONS):
+            return "Спасибо! Передаю информацию собственнику, он свяжется с вами. [COMPLETE]"
+        return AGENT_QUESTIONS[user_turns - 1] if user_turns else AGENT_QUESTIONS[0]
+
+    async def completions(self, request):
+        payload = await request.json()
+        if await self.upstream.delay("stream" if payload.get("stream") else "completion"):
+            return self.upstream.error_response()
+        answer = self.answer(payload["messages"])
+        prompt_tokens = sum(len(message.get("content") or "") for message in payload["messages"]) // 3
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer) // 3,
+                 "prompt_tokens_details": {"cached_tokens": prompt_tokens // 1024 * 1024}}
+        if not payload.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": answer}}], "usage": usage})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for chunk in re.split(r"(?<=\n\n)", answer):
+            delta = {"choices": [{"index": 0, "delta": {"content": chunk}}]}
+            await response.write(f"data: {json.dumps(delta, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(self.upstream.latency / 4)
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+class FakeTelegram:
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.applications = []
+
+    def routes(self, app):
+        app.router.add_post("/bot{token}/sendMessage", self.send_message)
+
+    async def send_message(self, request):
+        if await self.upstream.delay("sendMessage"):
+            return self.upstream.error_response()
+        data = await request.json()
+        self.applications.append(data["text"])
+        return web.json_response({"ok": True, "result": {"message_id": len(self.applications)}})
+
+
+async def start_server(*fakes):
+    """Один локальный сервер на свободном порту; возвращает (runner, адрес)"""
+    app = web.Application()
+    for fake in fakes:
+        fake.routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def format_percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "нет данных"
+    return (f"p50 {percentile(values, 0.5):.2f}с, p95 {percentile(values, 0.95):.2f}с, "
+            f"p99 {percentile(values, 0.99):.2f}с, макс {values[-1]:.2f}с")
+
+
+async def run_load_test(args):
+    random.seed(args.seed)
+    # Состояние бота (SQLite, трассировки, кэши) - во временном каталоге
+    workdir = tempfile.mkdtemp(prefix="avito_loadtest_")
+    os.chdir(workdir)
+
+    # Модули бота импортируются после смены каталога: пути в config.py относительные
+    from main import AvitoRentalBot
+    from chat_gpt import chatgpt_handler
+    from telegram import telegram_bot
+    from http_pool import close_all_sessions
+    from rate_limiter import TokenBucket
+    from metrics import upstream_latency, upstream_errors
+
+    avito = FakeAvito(Upstream("avito", args.avito_latency, args.jitter, args.avito_errors), args.chats, args.think)
+    openai = FakeOpenAI(Upstream("openai", args.openai_latency, args.jitter, args.openai_errors, error_status=429))
+    telegram = FakeTelegram(Upstream("telegram", args.telegram_latency, args.jitter, args.telegram_errors))
+    runners = []
+    for fake in (avito, openai, telegram):
+        runner, url = await start_server(fake)
+        runners.append(runner)
+        fake.url = url
+
+    chatgpt_handler.base_url = f"{openai.url}/v1/chat/completions"
+    if args.openai_rpm:
+        chatgpt_handler.limiter.requests = TokenBucket(args.openai_rpm)
+    telegram_bot.base_url = f"{telegram.url}/botLOADTEST"
+
+    bot = AvitoRentalBot(accounts=[{"name": "default", "user_id": ACCOUNT_ID,
+                                    "client_id": "load-test", "client_secret": "load-test"}])
+    account = bot.accounts[0]
+    client = account.client
+    client.base_url = avito.url
+
+    cycle_times = []
+    cycle_answered = []
+    if bot.trace_writer:
+        bot.trace_writer.start()
+    bot.completion_workers.start()
+    background = [asyncio.create_task(bot.telegram_outbox.run()), asyncio.create_task(bot.flush_state_loop())]
+
+    print(f"Нагрузочный тест: {args.chats} чатов, {args.duration} с, опрос каждые {args.poll_interval} с")
+    print(f"Рабочий каталог: {workdir}")
+    started = time.monotonic()
+    avito.start_clients(args.ramp)
+    try:
+        await client.start()
+        while time.monotonic() - started < args.duration:
+            cycle_started = time.monotonic()
+            try:
+                cycle = await bot.poll_cycle(account)
+                cycle_answered.append(cycle["answered"])
+            except Exception as e:
+                print(f"Ошибка цикла опроса: {e}")
+            cycle_times.append(time.monotonic() - cycle_started)
+            await asyncio.sleep(max(0.0, args.poll_interval - (time.monotonic() - cycle_started)))
+        # Даем фоновым очередям дослать заявки
+        await asyncio.sleep(args.drain)
+    finally:
+        avito.stop()
+        for task in background:
+            task.cancel()
+        bot.completion_workers.stop()
+        if bot.trace_writer:
+            bot.trace_writer.stop()
+        bot.store.close()
+        await client.close()
+        await close_all_sessions()
+        for runner in runners:
+            await runner.cleanup()
+
+    print("\n" + "=" * 60)
+    print("РЕЗУЛЬТАТЫ")
+    print("=" * 60)
+    print(f"Циклов опроса: {len(cycle_times)}, время цикла: {format_percentiles(cycle_times)}")
+    print(f"Ответов за цикл: в среднем {sum(cycle_answered) / max(len(cycle_answered), 1):.1f}, "
+          f"максимум {max(cycle_answered, default=0)}")
+    print(f"Задержка ответа клиенту ({len(avito.reply_latencies)} ответов): {format_percentiles(avito.reply_latencies)}")
+    print(f"Сообщений от бота: {avito.replies}, клиентов без ответа в конце: {avito.unanswered()}, "
+          f"диалогов доведено до конца: {avito.finished}, заявок в Telegram: {len(telegram.applications)}")
+
+    print("\nЗапросы к имитациям (вызовы / ошибки):")
+    for fake in (avito, openai, telegram):
+        for endpoint, calls in sorted(fake.upstream.calls.items()):
+            print(f"  {fake.upstream.name:9} {endpoint:13} {calls:7} / {fake.upstream.errors[endpoint]}")
+
+    print("\nЗапросы со стороны бота (метрики):")
+    for (upstream, operation), series in sorted(upstream_latency.series.items()):
+        print(f"  {upstream:9} {operation:13} {series[2]:7}, среднее {series[1] / series[2]:.3f}с, "
+              f"ошибок {upstream_errors.get(upstream=upstream, operation=operation)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных имитациях API")
+    parser.add_argument("--chats", type=int, default=500, help="число одновременных диалогов")
+    parser.add_argument("--duration", type=float, default=120, help="длительность теста, с")
+    parser.add_argument("--ramp", type=float, default=30, help="за сколько секунд приходят первые сообщения")
+    parser.add_argument("--think", type=float, default=3.0, help="минимальная пауза клиента перед ответом, с")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="пауза между циклами опроса, с")
+    parser.add_argument("--drain", type=float, default=5.0, help="ожидание фоновых очередей в конце, с")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержек (sigma логнормального)")
+    parser.add_argument("--avito-latency", type=float, default=0.05, help="медианная задержка Avito, с")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="медианная задержка OpenAI, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="медианная задержка Telegram, с")
+    parser.add_argument("--avito-errors", type=float, default=0.0, help="доля ответов 500 от Avito")
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="доля ответов 429 от OpenAI")
+    parser.add_argument("--telegram-errors", type=float, default=0.0, help="доля ответов 500 от Telegram")
+    parser.add_argument("--openai-rpm", type=int, default=None, help="лимит запросов в минуту вместо OPENAI_RPM_LIMIT")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логов бота во время теста")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    setup_logging(arguments.log_level)
+    try:
+        asyncio.run(run_load_test(arguments))
+    finally:
+        shutdown_logging()
@@ -0,0 +1,331 @@
+import re
+from datetime import date, timedelta
+
+from config import MIN_PHONE_DIGITS
+
+# Поля заявки, которые заполняет EXTRACTION_PROMPT_TEMPLATE
+CLIENT_DATA_FIELDS = (
+    "name", "phone", "residents_info", "residents_count", "residents_details",
+    "has_children", "children_details", "has_pets", "pets_details",
+    "rental_period", "move_in_deadline",
+)
+
+# (основа, родительный падеж, именительный падеж)
+MONTHS = (
+    ("январ", "января", "январь"), ("феврал", "февраля", "февраль"), ("март", "марта", "март"),
+    ("апрел", "апреля", "апрель"), ("ма", "мая", "май"), ("июн", "июня", "июнь"),
+    ("июл", "июля", "июль"), ("август", "августа", "август"), ("сентябр", "сентября", "сентябрь"),
+    ("октябр", "октября", "октябрь"), ("ноябр", "ноября", "ноябрь"), ("декабр", "декабря", "декабрь"),
+)
+MONTH_PATTERN = r"(январ\w*|феврал\w*|март\w*|апрел\w*|ма[йяе]\w*|июн\w*|июл\w*|август\w*|сентябр\w*|октябр\w*|ноябр\w*|декабр\w*)"
+
+NUMBER_WORDS = {
+    "один": 1, "одного": 1, "два": 2, "двух": 2, "пару": 2, "три": 3, "трех": 3, "трёх": 3,
+    "четыре": 4, "четырех": 4, "пять": 5, "пяти": 5, "шесть": 6, "шести": 6,
+    "семь": 7, "восемь": 8, "девять": 9, "десять": 10, "одиннадцать": 11, "двенадцать": 12,
+}
+
+PHONE_RE = re.compile(r"\+?\d[\d\s\-()]{8,}\d")
+# "1.5 года", "2.5 месяца" - дробное число, а не дата
+NUMERIC_DATE_RE = re.compile(r"\b(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?\b(?!\s*(?:год|лет|мес))")
+DAY_MONTH_RE = re.compile(r"\b(\d{1,2})(?:-?го)?\s+" + MONTH_PATTERN)
+DAY_OF_MONTH_RE = re.compile(r"\b(\d{1,2})(?:-?го)?\s+числа")
+# "5 числа" - дата заезда, только если рядом сказано о заезде ("платить 5 числа" - нет)
+MOVE_IN_WORDS_RE = re.compile(r"заезд|заед|засел|въезд|въед|переезд|переед")
+# "с 10 по 20 ноября", "10-15 числа" - диапазон дат, решает модель
+DATE_RANGE_RE = re.compile(
+    r"\b\d{1,2}(?:-?го)?\s*(?:-|–|—|по|до|или)\s*\d{1,2}(?:-?го)?\s+(?:числа|" + MONTH_PATTERN + r")"
+)
+PART_OF_MONTH_RE = re.compile(r"\b(начал\w*|середин\w*|конц\w*|конец)\s+" + MONTH_PATTERN)
+MONTH_ONLY_RE = re.compile(r"\bв\s+" + MONTH_PATTERN)
+IN_DAYS_RE = re.compile(r"\bчерез\s+(\d{1,2}|\w+)?\s*(дн\w*|день|недел\w*)")
+# Вторая группа - конец диапазона ("2-3 месяца", "два или три месяца"): такой срок решает модель
+PERIOD_MONTHS_RE = re.compile(
+    r"\b(\d{1,2}|" + "|".join(NUMBER_WORDS) + r")(?:\s*(?:-|–|—|или|до)\s*(\d{1,2}|" + "|".join(NUMBER_WORDS) + r"))?"
+    r"\s*(?:мес|месяц\w*)\b"
+)
+PERIOD_YEARS_RE = re.compile(r"\bна\s+(\d|" + "|".join(NUMBER_WORDS) + r")?\s*(?:год|года|лет)\b")
+PERSON_RE = re.compile(
+    r"\b(парень|девушка|мужчина|женщина|муж|жена|сын|дочь|дочка|ребенок|ребёнок)[\s,]*(\d{1,2})\s*(?:год|года|лет)\b"
+)
+NAME_RE = re.compile(r"\b(?:меня\s+зовут|зовут|мое имя|моё имя)\s+([А-ЯЁа-яё]{2,})")
+
+ADULT_WORDS = {"парень", "девушка", "мужчина", "женщина", "муж", "жена"}
+# Любое упоминание жильца, в том числе без возраста ("с женой", "детьми")
+PERSON_MENTION_RE = re.compile(r"\b(?:пар[её]?н|девушк|мужчин|женщин|муж|жен|сын|доч|реб[её]н|дет)\w*")
+# Жильцы, которых PERSON_RE не разбирает: "я и жена 25 лет", "мне 25"
+OTHER_PERSON_RE = re.compile(
+    r"\b(?:я|мне|меня|мы|нас|вдво[её]м|втро[её]м|друг\w*|подруг\w*|мам\w*|пап\w*|брат\w*|"
+    r"сестр\w*|бабушк\w*|дедушк\w*|родител\w*|коллег\w*)\b"
+)
+NO_CHILDREN_RE = re.compile(r"без\s+(?:детей|ребен|ребён)|детей\s+нет|нет\s+детей|детей\s+не\s+(?:будет|планир)")
+PET_PATTERN = r"(?:собак\w*|пес|пёс|псом|щен\w+|кошк\w*|кошеч\w+|кот|коты|котом|котик\w*|кот[её]н\w*|попуга\w+|хомяк\w*)"
+PETS_RE = re.compile(r"\b(" + PET_PATTERN + r")\b")
+# "Без собаки", "собаки нет", "нет кошки" - тоже ответ "животных нет"
+NO_PETS_RE = re.compile(
+    r"без\s+(?:животн|питом|домашн)|(?:животных|питомцев)\s+нет|нет\s+(?:животных|питомцев)|"
+    r"\bбез\s+" + PET_PATTERN + r"\b|\b" + PET_PATTERN + r"\s+(?:у\s+нас\s+|у\s+меня\s+)?нет\b|\bнет\s+" + PET_PATTERN + r"\b"
+)
+# Отрицание рядом со словом о животном ("собаку не берем") - не разбираем
+NEGATION_RE = re.compile(r"\b(?:не|нет|без|ни)\b")
+# Вопросы агента, после которых клиент называет имя
+NAME_QUESTIONS = ("обращаться", "как вас зовут", "ваше имя")
+NOT_NAMES = {
+    "меня", "зовут", "можно", "я", "это", "да", "нет", "здравствуйте", "привет", "добрый",
+    "день", "вечер", "просто", "ок", "хорошо", "спасибо", "мое", "моё", "имя",
+}
+URGENT_WORDS = ("как можно скорее", "срочно", "прямо сейчас", "побыстрее")
+
+
+# Поле названо в реплике по-разному ("на 6 месяцев или на год") - решает модель
+AMBIGUOUS = object()
+
+
+def plural(n, one, few, many):
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return few
+    return many
+
+
+def month_index(word):
+    for index, (stem, _, _) in enumerate(MONTHS):
+        if word.startswith(stem) and (stem != "ма" or word[2:3] in ("й", "я", "е")):
+            return index + 1
+    return None
+
+
+def to_number(token):
+    if token is None:
+        return None
+    return int(token) if token.isdigit() else NUMBER_WORDS.get(token)
+
+
+def normalize_phone(text):
+    """Последний номер телефона в тексте в виде +7XXXXXXXXXX (или цифрами, если не российский)"""
+    phone = None
+    for match in PHONE_RE.finditer(text):
+        digits = re.sub(r"\D", "", match.group())
+        if len(digits) == 11 and digits[0] in "78":
+            phone = "+7" + digits[1:]
+        elif len(digits) == 10 and digits[0] == "9":
+            phone = "+7" + digits
+        elif len(digits) >= MIN_PHONE_DIGITS:
+            phone = ("+" if match.group().startswith("+") else "") + digits
+    return phone
+
+
+def _future_date(today, month, day, year=None):
+    """Дата без года - ближайшая не в прошлом"""
+    try:
+        result = date(year or today.year, month, day)
+    except ValueError:
+        return None
+    if year is None and result < today:
+        result = result.replace(year=today.year + 1)
+    return result
+
+
+def extract_move_in(text, today):
+    """Дата заезда: точная дата в виде ДД.ММ.ГГГГ, нормализованное выражение или AMBIGUOUS"""
+    dates = set()
+    for match in NUMERIC_DATE_RE.finditer(text):
+        day, month, year = match.groups()
+        if year and len(year) == 2:
+            year = "20" + year
+        result = _future_date(today, int(month), int(day), int(year) if year else None)
+        if result:
+            dates.add(result.strftime("%d.%m.%Y"))
+    if DATE_RANGE_RE.search(text):
+        return AMBIGUOUS
+
+    for match in DAY_MONTH_RE.finditer(text):
+        month = month_index(match.group(2))
+        result = month and _future_date(today, month, int(match.group(1)))
+        if result:
+            dates.add(result.strftime("%d.%m.%Y"))
+
+    for match in DAY_OF_MONTH_RE.finditer(text):
+        context = text[max(match.start() - 40, 0):match.end() + 20]
+        if not MOVE_IN_WORDS_RE.search(context):
+            continue
+        # "с 15 числа" - в этом месяце, а если число уже прошло - в следующем
+        day = int(match.group(1))
+        if day >= today.day:
+            result = _future_date(today, today.month, day)
+        else:
+            next_month = today.month % 12 + 1
+            result = _future_date(today, next_month, day, today.year + (next_month == 1))
+        if result:
+            dates.add(result.strftime("%d.%m.%Y"))
+
+    if len(dates) > 1:
+        return AMBIGUOUS
+    if dates:
+        return dates.pop()
+
+    if "сегодня" in text:
+        return today.strftime("%d.%m.%Y")
+    if "послезавтра" in text:
+        return (today + timedelta(days=2)).strftime("%d.%m.%Y")
+    if "завтра" in text:
+        return (today + timedelta(days=1)).strftime("%d.%m.%Y")
+
+    match = IN_DAYS_RE.search(text)
+    if match:
+        count = to_number(match.group(1)) or 1
+        days = count * 7 if match.group(2).startswith("недел") else count
+        return (today + timedelta(days=days)).strftime("%d.%m.%Y")
+
+    match = PART_OF_MONTH_RE.search(text)
+    if match:
+        month = month_index(match.group(2))
+        part = {"н": "начало", "с": "середина"}.get(match.group(1)[0], "конец")
+        if month:
+            return f"{part} {MONTHS[month - 1][1]}"
+
+    for phrase in URGENT_WORDS:
+        if phrase in text:
+            return "как можно скорее"
+
+    match = MONTH_ONLY_RE.search(text)
+    if match:
+        month = month_index(match.group(1))
+        if month:
+            year = today.year + (1 if month < today.month else 0)
+            return f"{MONTHS[month - 1][2]} {year}"
+    return None
+
+
+def extract_period(text):
+    """Срок аренды ("6 месяцев", "1 год", "длительный срок"), None или AMBIGUOUS"""
+    periods = set()
+    for match in PERIOD_MONTHS_RE.finditer(text):
+        # "через 2 месяца" - когда заезд, а не на сколько
+        if re.search(r"через\s*$", text[:match.start()]):
+            continue
+        if match.group(2):
+            return AMBIGUOUS
+        months = to_number(match.group(1))
+        if months:
+            periods.add(f"{months} {plural(months, 'месяц', 'месяца', 'месяцев')}")
+    if "полгода" in text or "пол года" in text:
+        periods.add("6 месяцев")
+    for match in PERIOD_YEARS_RE.finditer(text):
+        years = to_number(match.group(1)) or 1
+        periods.add(f"{years} {plural(years, 'год', 'года', 'лет')}")
+    if len(periods) > 1:
+        return AMBIGUOUS
+    if periods:
+        return periods.pop()
+    if any(word in text for word in ("длительн", "долгосроч", "надолго", "постоянн")):
+        return "длительный срок"
+    return None
+
+
+def extract_name(turns):
+    """Имя клиента: "меня зовут ..." или короткий ответ на вопрос, как обращаться"""
+    for index, turn in enumerate(turns):
+        if turn["role"] == "user":
+            match = NAME_RE.search(turn["content"].lower())
+            if match and match.group(1) not in NOT_NAMES:
+                return match.group(1).capitalize()
+        elif any(question in turn["content"].lower() for question in NAME_QUESTIONS):
+            if index + 1 < len(turns) and turns[index + 1]["role"] == "user":
+                words = [w for w in re.findall(r"[А-ЯЁа-яё]+", turns[index + 1]["content"])
+                         if w.lower() not in NOT_NAMES]
+                # Длинный ответ - скорее всего не только имя, оставляем модели
+                if 1 <= len(words) <= 2 and len(words[0]) >= 2:
+                    return words[0].capitalize()
+    return None
+
+
+def extract_people(text, result):
+    """Взрослые с возрастом, дети и животные, если клиент назвал их явно.
+
+    Жильцов заполняем, только если разобран каждый упомянутый: иначе
+    ("я и жена 25 лет") число жильцов оказалось бы неверным.
+    """
+    adults, children = [], []
+    matches = PERSON_RE.findall(text)
+    for word, age in matches:
+        age = int(age)
+        phrase = f"{word} {age} {plural(age, 'год', 'года', 'лет')}"
+        (adults if word in ADULT_WORDS else children).append(phrase)
+
+    mentions = len(PERSON_MENTION_RE.findall(NO_CHILDREN_RE.sub(" ", text)))
+    if mentions != len(matches) or OTHER_PERSON_RE.search(text):
+        adults, children = [], []
+        if not NO_CHILDREN_RE.search(text):
+            # Про детей тоже судить не можем - спросим модель
+            children = None
+
+    if adults:
+        result["residents_info"] = " и ".join(adults)
+        result["residents_count"] = len(adults)
+        result["residents_details"] = ", ".join(adults)
+
+    if children:
+        result["has_children"] = True
+        result["children_details"] = ", ".join(children)
+    elif children is not None and NO_CHILDREN_RE.search(text):
+        result["has_children"] = False
+        result["children_details"] = None
+
+    # Животные, названные без отрицания; "собаку не берем" и подобное - модели
+    rest = NO_PETS_RE.sub(" ", text)
+    pets = []
+    for match in PETS_RE.finditer(rest):
+        if NEGATION_RE.search(rest[max(match.start() - 20, 0):match.end() + 15]):
+            return
+        pets.append(match.group(1))
+    if pets:
+        result["has_pets"] = True
+        result["pets_details"] = ", ".join(dict.fromkeys(pets))
+    elif NO_PETS_RE.search(text):
+        result["has_pets"] = False
+        result["pets_details"] = None
+
+
+def extract_local(turns, today=None):
+    """Поля заявки, которые удалось надежно найти без модели.
+
+    turns - реплики [{"role", "content"}]; ищем только в словах клиента,
+    более поздние реплики важнее ранних (клиент мог передумать).
+    """
+    today = today or date.today()
+    client_turns = [turn["content"] for turn in turns if turn["role"] == "user"]
+    text = "\n".join(client_turns).lower()
+    result = {}
+
+    phone = normalize_phone(text)
+    if phone:
+        result["phone"] = phone
+
+    for content in reversed(client_turns):
+        lowered = content.lower()
+        if "move_in_deadline" not in result:
+            # Номер телефона не должен читаться как дата
+            move_in = extract_move_in(PHONE_RE.sub(" ", lowered), today)
+            if move_in:
+                result["move_in_deadline"] = move_in
+        if "rental_period" not in result:
+            period = extract_period(lowered)
+            if period:
+                result["rental_period"] = period
+    # Неоднозначные поля оставляем модели (в более ранних репликах не ищем)
+    for name in ("move_in_deadline", "rental_period"):
+        if result.get(name) is AMBIGUOUS:
+            del result[name]
+
+    name = extract_name(turns)
+    if name:
+        result["name"] = name
+
+    extract_people(text, result)
+    return result
+
+
+def missing_fields(local_data):
+    return [name for name in CLIENT_DATA_FIELDS if name not in local_data]
@@ -0,0 +1,88 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Атрибуты LogRecord; все остальное пришло через extra= и попадает в вывод как поля
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    """Строка "время уровень модуль: сообщение key=value ..." """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON (для journald/Loki)"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level="INFO", module_levels=None, fmt="text", log_file=None):
+    """Логирование через очередь: запись в stdout или файл идет в отдельном потоке.
+
+    module_levels - уровни отдельных логгеров, например {"chat_gpt": "DEBUG"}.
+    """
+    global _listener
+    shutdown_logging()
+
+    if log_file:
+        handler = logging.handlers.WatchedFileHandler(log_file, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Дописать накопленные записи (при остановке процесса)"""
+    global _listener
+    if _listener is not None:
+        # Поздние записи (при выходе из процесса) пойдут в stderr напрямую
+        logging.getLogger().handlers = []
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def sampled(logger, rate, level=logging.DEBUG):
+    """Писать ли подробную запись: уровень логгера включен и выпал шанс rate"""
+    return rate > 0 and logger.isEnabledFor(level) and (rate >= 1 or random.random() < rate)
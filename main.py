@@ -1,28 +1,105 @@
 import asyncio
 import aiohttp
+import time
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
-import json
+import logging
 
 # Импорты модулей проекта
-from avito import AvitoClient
-from chat_gpt import get_agent_response, extract_final_client_data, check_dialog_completion
-from telegram import send_completed_application
+from accounts import DEFAULT_ACCOUNT, create_accounts
+from chat_gpt import get_agent_response, stream_agent_response, summarize_dialog, extract_final_client_data, check_dialog_completion, get_openai_stats, get_extraction_stats
+from telegram import telegram_bot, format_application
+from http_pool import close_all_sessions
+from webhook import WebhookServer
+from tracing import TurnTrace, TraceWriter, current_trace, span, annotate
+from logging_setup import setup_logging, shutdown_logging, sampled
+from metrics import MetricsServer, registry, poll_cycle_seconds, poll_chats, last_cycle_chats, queue_size, partitions_owned
+from scheduler import ChatScheduler
+from partitioning import PartitionLeases, SharedChatState
+from storage import StateStore, PersistentDict, DurableQueue
+from outbox import TelegramOutbox
+from workers import QueueWorkerPool
+from dialog_features import extract_dialog_features
+from message_cache import MessageCache, format_dialog_line, dialog_turn
+from fast_replies import FastReplyMatcher
+from context_window import ContextWindow, TokenCounter
 from config import (
    COMPLETION_MARKER,
-   AVITO_USER_ID,
-   AVITO_CLIENT_ID,
-   AVITO_CLIENT_SECRET,
+   OPENAI_ERROR,
+   AVITO_ACCOUNTS,
+   AVITO_TOKEN_REFRESH_MARGIN,
    CHECK_INTERVAL,
+   OPENAI_STREAMING,
+   FAST_REPLIES_ENABLED,
+   FAST_REPLY_MAX_LENGTH,
+   FAST_REPLY_MAX_EXTRA_WORDS,
+   FAST_REPLY_FILLER_WORDS,
+   FAQ_INTENTS,
+   GREETING_WORDS,
+   GREETING_PHRASE,
+   START_QUESTION,
+   STAGE_QUESTIONS,
    TIME_WINDOW_HOURS,
+   CHATS_PAGE_SIZE,
+   CHATS_UNREAD_ONLY,
+   CHATS_TYPES,
    MAX_MESSAGES_HISTORY,
-   FOLLOWUP_CHECK_INTERVAL,
+   CONTEXT_TOKEN_BUDGET,
+   CONTEXT_KEEP_RATIO,
+   OPENAI_MODEL,
+   TELEGRAM_CHAT_ID,
+   TELEGRAM_CHAT_MIN_INTERVAL,
+   TELEGRAM_GLOBAL_MIN_INTERVAL,
+   TELEGRAM_MAX_ATTEMPTS,
+   COMPLETION_WORKERS,
+   COMPLETION_RETRY_DELAY,
+   COMPLETION_MAX_ATTEMPTS,
+   FOLLOWUP_MAX_SLEEP,
+   FOLLOWUP_RETRY_DELAY,
    FOLLOWUP_INTERVALS,
    FOLLOWUP_MESSAGES,
    WORK_HOUR_START,
-   WORK_HOUR_END
+   WORK_HOUR_END,
+   WEBHOOK_ENABLED,
+   WEBHOOK_HOST,
+   WEBHOOK_PORT,
+   WEBHOOK_PATH,
+   WEBHOOK_PUBLIC_URL,
+   WEBHOOK_SECRET,
+   WEBHOOK_RECONCILE_INTERVAL,
+   METRICS_ENABLED,
+   TRACE_ENABLED,
+   LOG_LEVEL,
+   LOG_FORMAT,
+   LOG_FILE,
+   LOG_MODULE_LEVELS,
+   LOG_DIALOG_DUMP_SAMPLE_RATE,
+   TRACE_FILE,
+   TRACE_MAX_BYTES,
+   TRACE_BACKUP_COUNT,
+   METRICS_HOST,
+   METRICS_PORT,
+   METRICS_PATH,
+   UPSTREAM_CONCURRENCY_LIMITS,
+   ACCOUNT_CHAT_CONCURRENCY,
+   PARTITIONING_ENABLED,
+   PARTITION_DB_PATH,
+   PARTITION_COUNT,
+   PARTITION_LEASE_TTL,
+   PARTITION_CLOCK_MARGIN,
+   WORKER_ID,
+   STATE_DB_PATH,
+   STATE_FLUSH_INTERVAL,
+   MESSAGE_CACHE_PAGE_SIZE,
+   MESSAGE_CACHE_MAX_CHATS,
+   MESSAGE_CACHE_MAX_MESSAGES,
+   MESSAGE_CACHE_TTL
 )
 
+logger = logging.getLogger("main")
+# Подробный дамп истории перед запросом к модели (уровень и доля - в config.py)
+dialog_logger = logging.getLogger("main.dialog")
+
 # Этапы диалога
 STAGE_GREETING = "greeting"
 STAGE_RESIDENTS = "residents"
@@ -34,20 +111,143 @@ STAGE_CONTACTS = "contacts"
 STAGE_COMPLETE = "complete"
 
 class AvitoRentalBot:
-   def __init__(self):
-       # Хранилище состояния чатов (chat_id -> dialog_history)
-       self.chat_states = defaultdict(list)
-       # Отслеживание обработанных сообщений (chat_id -> last_message_timestamp)
-       self.processed_messages = defaultdict(int)
-       # Завершенные диалоги (чтобы не обрабатывать повторно)
-       self.completed_chats = set()
-       # Этапы диалогов (chat_id -> stage)
-       self.chat_stages = defaultdict(lambda: STAGE_GREETING)
-       # Follow-up состояния (chat_id -> {last_client_activity, next_followup_time, followup_stage})
-       self.followup_states = defaultdict(dict)
-       # Данные объявлений для чатов (chat_id -> item_data)
-       self.chat_items = defaultdict(dict)
+   def __init__(self, accounts=None):
+       # Постоянное хранилище: состояние ниже переживает перезапуск процесса
+       self.store = StateStore(STATE_DB_PATH)
+       # Подсчет токенов общий: тексты кэшируются один раз для всех аккаунтов
+       self.token_counter = TokenCounter(OPENAI_MODEL)
+       # Аккаунты Avito: у каждого свой клиент, токен и состояние чатов
+       self.accounts = create_accounts(
+           AVITO_ACCOUNTS if accounts is None else accounts,
+           self.store,
+           refresh_margin=AVITO_TOKEN_REFRESH_MARGIN
+       )
+       self.accounts_by_name = {account.name: account for account in self.accounts}
+       self.accounts_by_user_id = {account.user_id: account for account in self.accounts}
+       for account in self.accounts:
+           # Кэш сообщений: догружаем только новые сообщения чата
+           account.message_cache = MessageCache(
+               max_per_chat=MAX_MESSAGES_HISTORY,
+               page_size=MESSAGE_CACHE_PAGE_SIZE,
+               max_chats=MESSAGE_CACHE_MAX_CHATS,
+               max_messages=MESSAGE_CACHE_MAX_MESSAGES,
+               ttl=MESSAGE_CACHE_TTL
+           )
+           # История в пределах бюджета токенов; краткие содержания хранятся в базе
+           account.context_window = ContextWindow(
+               self.token_counter,
+               CONTEXT_TOKEN_BUDGET,
+               self.summarize_history,
+               PersistentDict(self.store, account.namespace("dialog_summaries")),
+               keep_ratio=CONTEXT_KEEP_RATIO
+           )
+       # Лимиты параллельных запросов к апстримам, блокировки чатов и ходы аккаунтов
+       self.scheduler = ChatScheduler(UPSTREAM_CONCURRENCY_LIMITS, account_limit=ACCOUNT_CHAT_CONCURRENCY)
+       # Очередь заявок в Telegram: переживает перезапуск, соблюдает лимиты
+       self.telegram_outbox = TelegramOutbox(
+           DurableQueue(self.store, "telegram"),
+           telegram_bot,
+           chat_interval=TELEGRAM_CHAT_MIN_INTERVAL,
+           global_interval=TELEGRAM_GLOBAL_MIN_INTERVAL,
+           max_attempts=TELEGRAM_MAX_ATTEMPTS
+       )
+       # Завершенные диалоги обрабатываются в фоне, не задерживая ответы клиентам
+       self.completion_workers = QueueWorkerPool(
+           DurableQueue(self.store, "completions"),
+           lambda job: self.handle_completed_dialog(
+               job["chat_id"], job["final_dialog"], job.get("completed_at"), job.get("account", DEFAULT_ACCOUNT)
+           ),
+           workers=COMPLETION_WORKERS,
+           backoff_base=COMPLETION_RETRY_DELAY,
+           max_attempts=COMPLETION_MAX_ATTEMPTS
+       )
+       # Готовые ответы на приветствие и частые вопросы (без GPT)
+       self.fast_replies = FastReplyMatcher(
+           FAQ_INTENTS, GREETING_WORDS, GREETING_PHRASE, START_QUESTION, STAGE_QUESTIONS,
+           filler_words=FAST_REPLY_FILLER_WORDS,
+           max_length=FAST_REPLY_MAX_LENGTH,
+           max_extra_words=FAST_REPLY_MAX_EXTRA_WORDS
+       )
+       # Размеры очередей читаются при каждом запросе /metrics
+       queue_size.set_function(lambda: sum(len(account.followup_queue) for account in self.accounts), queue="followup")
+       queue_size.set_function(lambda: len(self.telegram_outbox.queue), queue="telegram")
+       queue_size.set_function(lambda: len(self.completion_workers.queue), queue="completions")
+       # Аренда разделов чатов, когда бот запущен в нескольких процессах
+       self.leases = None
+       # Завершенность диалогов и follow-up, общие для процессов (в базе аренды)
+       self.shared_state = None
+       if PARTITIONING_ENABLED:
+           self.leases = PartitionLeases(
+               PARTITION_DB_PATH, WORKER_ID,
+               partitions=PARTITION_COUNT, ttl=PARTITION_LEASE_TTL, clock_margin=PARTITION_CLOCK_MARGIN
+           )
+           self.shared_state = SharedChatState(self.leases)
+           partitions_owned.set_function(self.leases.owned_count)
+       # Трассировки ходов диалога (JSONL, запись в отдельном потоке)
+       self.trace_writer = TraceWriter(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT) if TRACE_ENABLED else None
        
+   def get_account(self, name):
+       """Аккаунт по имени; задания без имени (до перехода на несколько аккаунтов) - первого"""
+       return self.accounts_by_name.get(name) or self.accounts[0]
+   
+   def account_for_event(self, message):
+       """Аккаунт получателя webhook-события (по user_id в событии)"""
+       return self.accounts_by_user_id.get(message.get("user_id")) or self.accounts[0]
+   
+   def owns_chat(self, account, chat_id):
+       """Отвечает ли этот процесс в чате (без разделения на процессы - во всех)"""
+       return self.leases is None or self.leases.owns(f"{account.name}:{chat_id}")
+   
+   async def is_chat_completed(self, account, chat_id):
+       """Завершен ли диалог - этим процессом или прежним владельцем раздела"""
+       if chat_id in account.completed_chats:
+           return True
+       if self.shared_state and await self.shared_state.submit(self.shared_state.is_completed, account.name, chat_id):
+           account.completed_chats.add(chat_id)
+           return True
+       return False
+   
+   def write_shared(self, account, chat_id, method, *args):
+       """Запись состояния чата в общую базу без ожидания (ошибка только в лог)"""
+       def done(future):
+           if not future.cancelled() and future.exception():
+               logger.error(f"[{account.name}] Не удалось записать состояние чата {chat_id} в общую базу: "
+                            f"{future.exception()}")
+       self.shared_state.submit(method, account.name, chat_id, *args).add_done_callback(done)
+   
+   def share_followup(self, account, chat_id):
+       """Записать follow-up чата в общую базу: его продолжит новый владелец раздела"""
+       if self.shared_state is None:
+           return
+       # Копия: этап меняется на месте, а запись выполняется позже в потоке базы
+       state = account.followup_states.get(chat_id)
+       self.write_shared(account, chat_id, self.shared_state.save_followup, dict(state) if state else None)
+   
+   async def handle_partition_change(self, gained, lost):
+       """Follow-up переходят вместе с разделами.
+       
+       По отданным разделам локальное состояние удаляется (его ведет новый
+       владелец), по полученным - заменяется состоянием из общей базы.
+       """
+       changed = gained | lost
+       for account in self.accounts:
+           for chat_id in list(account.followup_states):
+               if self.leases.partition(f"{account.name}:{chat_id}") in changed:
+                   account.followup_queue.cancel(chat_id)
+                   del account.followup_states[chat_id]
+           if not gained:
+               continue
+           try:
+               followups = await self.shared_state.submit(self.shared_state.followups, account.name, gained)
+           except Exception as e:
+               logger.error(f"[{account.name}] Не удалось загрузить follow-up полученных разделов: {e}")
+               continue
+           for chat_id, state in followups.items():
+               account.followup_states[chat_id] = state
+               account.followup_queue.schedule(chat_id, state["next_followup_time"])
+           if followups:
+               logger.info(f"[{account.name}] Из полученных разделов принято follow-up: {len(followups)}")
+   
    def get_moscow_time(self):
        """Получить текущее время в МСК"""
        moscow_tz = timezone(timedelta(hours=3))
@@ -79,37 +279,30 @@ class AvitoRentalBot:
        
        return target_time.timestamp()
    
-   def is_dialog_complete_check(self, messages):
+   def is_dialog_complete_check(self, messages, features=None):
        """Проверка завершенности диалога на основе собранной информации"""
-       client_messages = []
-       agent_messages = []
-       
-       for message in messages:
-           if message.get("type") != "text":
-               continue
-           text = message.get("content", {}).get("text", "").strip().lower()
-           if not text:
-               continue
-               
-           if message.get("direction") == "out":
-               agent_messages.append(text)
-           else:
-               client_messages.append(text)
+       if features is None:
+           features = extract_dialog_features(messages)
        
        # Проверяем наличие маркера завершения в сообщениях агента
-       has_completion_marker = any(COMPLETION_MARKER.lower() in msg for msg in agent_messages)
-       if has_completion_marker:
+       if features.has_completion_marker:
            return True
        
-       client_text = " ".join(client_messages).lower()
-       
        # Проверяем базовую информацию
-       has_residents = any(word in client_text for word in ["человек", "буду", "планирую", "один", "два", "три", "пара", "семья"])
-       has_period = any(word in client_text for word in ["месяц", "год"]) or any(char.isdigit() for char in client_text if "месяц" in client_text)
-       has_date = any(word in client_text for word in ["август", "сентябр", "октябр", "ноябр", "декабр", "январ", "феврал", "март", "апрел", "май", "июн", "июл"]) or ("число" in client_text and any(char.isdigit() for char in client_text))
-       has_phone = any(len([c for c in msg if c.isdigit()]) >= 10 for msg in client_messages)
-       
-       return has_residents and has_period and has_date and has_phone
+       return features.has_residents and features.has_period and features.has_date and features.has_phone
+   
+   def pending_client_texts(self, messages):
+       """Тексты клиента, пришедшие после последнего ответа агента"""
+       last_outgoing = max(
+           (m.get("created", 0) for m in messages if m.get("direction") == "out" and m.get("type") == "text"),
+           default=0
+       )
+       texts = []
+       for message in messages:
+           turn = dialog_turn(message)
+           if turn and turn[0] == "user" and message.get("created", 0) > last_outgoing:
+               texts.append(turn[1])
+       return texts
    
    def get_last_real_client_message(self, messages):
        """Получить последнее реальное сообщение от клиента (не системное, не удаленное)"""
@@ -127,198 +320,216 @@ class AvitoRentalBot:
        
        return last_client_message
    
-   def start_followup_sequence(self, chat_id, last_activity_time):
+   def start_followup_sequence(self, account, chat_id, last_activity_time):
        """Запуск последовательности follow-up сообщений"""
-       if chat_id in self.completed_chats:
+       if chat_id in account.completed_chats:
            return
            
        next_time = self.calculate_next_followup_time(last_activity_time, FOLLOWUP_INTERVALS["2h"])
        
-       self.followup_states[chat_id] = {
+       account.followup_states[chat_id] = {
            "last_client_activity": last_activity_time,
            "next_followup_time": next_time,
            "followup_stage": "2h"
        }
+       account.followup_queue.schedule(chat_id, next_time)
+       self.share_followup(account, chat_id)
        
        moscow_time = datetime.fromtimestamp(next_time, timezone(timedelta(hours=3)))
-       print(f"Запланирован follow-up для чата {chat_id} на {moscow_time.strftime('%Y-%m-%d %H:%M:%S МСК')}")
+       logger.info(f"Запланирован follow-up для чата {chat_id} на {moscow_time.strftime('%Y-%m-%d %H:%M:%S МСК')}")
    
-   def stop_followup_sequence(self, chat_id):
+   def stop_followup_sequence(self, account, chat_id):
        """Остановка последовательности follow-up сообщений"""
-       if chat_id in self.followup_states:
-           del self.followup_states[chat_id]
-           print(f"Follow-up остановлен для чата {chat_id}")
+       account.followup_queue.cancel(chat_id)
+       if chat_id in account.followup_states:
+           del account.followup_states[chat_id]
+           self.share_followup(account, chat_id)
+           logger.info(f"Follow-up остановлен для чата {chat_id}")
+   
+   def reschedule_followup(self, account, chat_id, next_time):
+       """Перенести follow-up чата на новое время"""
+       account.followup_states[chat_id]["next_followup_time"] = next_time
+       account.followup_queue.schedule(chat_id, next_time)
+       self.share_followup(account, chat_id)
    
-   async def process_followups(self, client):
-       """Обработка запланированных follow-up сообщений"""
-       current_time = datetime.utcnow().timestamp()
+   def upcoming_followups(self, account, limit=10):
+       """Ближайшие запланированные follow-up: [(chat_id, время МСК, этап), ...]"""
+       moscow_tz = timezone(timedelta(hours=3))
+       return [
+           (chat_id, datetime.fromtimestamp(when, moscow_tz), account.followup_states[chat_id]["followup_stage"])
+           for when, chat_id in account.followup_queue.upcoming(limit)
+       ]
+   
+   async def process_followups(self, account):
+       """Обработка follow-up, время которых наступило"""
+       for chat_id in account.followup_queue.pop_due():
+           state = account.followup_states.get(chat_id)
+           if not state:
+               continue
+           try:
+               await self._process_followup(account, chat_id, state)
+           except Exception as e:
+               # Чат уже снят с очереди: без переноса follow-up не отправится до перезапуска
+               logger.error(f"Ошибка follow-up в чате {chat_id}: {e}")
+               if chat_id in account.followup_states:
+                   self.reschedule_followup(account, chat_id, time.time() + FOLLOWUP_RETRY_DELAY)
+   
+   async def _process_followup(self, account, chat_id, state):
+       """Один follow-up: проверка рабочего времени и завершения диалога, отправка"""
        moscow_tz = timezone(timedelta(hours=3))
        
-       for chat_id, state in list(self.followup_states.items()):
-           if current_time >= state["next_followup_time"]:
-               
-               # Проверяем рабочее время для времени отправки
-               send_time = datetime.fromtimestamp(state["next_followup_time"], moscow_tz)
-               if not self.is_work_time(send_time):
-                   # Если время отправки не рабочее, переносим на следующий рабочий час
-                   new_time = self.calculate_next_followup_time(state["next_followup_time"], 0)
-                   self.followup_states[chat_id]["next_followup_time"] = new_time
-                   continue
-               
-               # Дополнительная проверка: не завершился ли диалог
-               try:
-                   messages = await client.get_messages(chat_id, limit=MAX_MESSAGES_HISTORY)
-                   if self.is_dialog_complete_check(messages):
-                       print(f"Диалог {chat_id} завершен, отменяем follow-up")
-                       del self.followup_states[chat_id]
-                       continue
-               except:
-                   pass  # Если не удалось проверить, продолжаем отправку
-               
-               # Отправляем follow-up сообщение
-               stage = state["followup_stage"]
-               message = FOLLOWUP_MESSAGES[stage]
-               
-               success = await client.send_message(chat_id, message)
-               
-               if success:
-                   print(f"Отправлен follow-up {stage} в чат {chat_id}: {message}")
-                   
-                   # Планируем следующий follow-up с накопительными интервалами
-                   base_time = state["last_client_activity"]
-                   
-                   if stage == "2h":
-                       next_stage = "16h"
-                       next_interval = FOLLOWUP_INTERVALS["16h"]  # 16 часов от начала
-                   elif stage == "16h":
-                       next_stage = "2d"
-                       next_interval = FOLLOWUP_INTERVALS["2d"]   # 2 дня от начала
-                   elif stage == "2d":
-                       next_stage = "4d"
-                       next_interval = FOLLOWUP_INTERVALS["4d"]   # 4 дня от начала
-                   else:  # stage == "4d"
-                       # Последний follow-up отправлен
-                       del self.followup_states[chat_id]
-                       continue
-                   
-                   # Рассчитываем время следующего follow-up от базового времени
-                   next_time = self.calculate_next_followup_time(base_time, next_interval)
-                   
-                   self.followup_states[chat_id].update({
-                       "next_followup_time": next_time,
-                       "followup_stage": next_stage
-                   })
-               else:
-                   print(f"Ошибка отправки follow-up в чат {chat_id}")
-
-   def determine_dialog_stage(self, messages):
-       """Определение текущего этапа диалога на основе истории сообщений"""
-       agent_messages = []
-       client_messages = []
+       # Чат другого процесса: его follow-up ведет владелец раздела по общей базе,
+       # локальная копия устарела (общую не трогаем)
+       if not self.owns_chat(account, chat_id):
+           del account.followup_states[chat_id]
+           return
        
-       for message in messages:
-           if message.get("type") != "text":
-               continue
-           text = message.get("content", {}).get("text", "").strip().lower()
-           if not text:
-               continue
-               
-           if message.get("direction") == "out":
-               agent_messages.append(text)
-           else:
-               client_messages.append(text)
+       # Проверяем рабочее время для времени отправки
+       send_time = datetime.fromtimestamp(state["next_followup_time"], moscow_tz)
+       if not self.is_work_time(send_time):
+           # Если время отправки не рабочее, переносим на следующий рабочий час
+           new_time = self.calculate_next_followup_time(state["next_followup_time"], 0)
+           self.reschedule_followup(account, chat_id, new_time)
+           return
        
-       # Если нет сообщений от агента - это начало
-       if not agent_messages:
-           return STAGE_GREETING
+       # Дополнительная проверка: не завершился ли диалог
+       try:
+           # Под блокировкой чата: догрузка не пересекается с ходом по этому же чату
+           async with self.scheduler.chat(account.chat_key(chat_id)):
+               async with self.scheduler.upstream("avito"):
+                   messages = await account.message_cache.sync(account.client, chat_id)
+           if self.is_dialog_complete_check(messages):
+               logger.info(f"Диалог {chat_id} завершен, отменяем follow-up")
+               del account.followup_states[chat_id]
+               self.share_followup(account, chat_id)
+               return
+       except Exception:
+           pass  # Если не удалось проверить, продолжаем отправку
        
-       # Проверяем, есть ли уже приветствие
-       has_greeting = any("здравствуйте" in msg and "светлана" in msg for msg in agent_messages)
-       if not has_greeting:
-           return STAGE_GREETING
-           
-       # Анализируем собранную информацию из сообщений клиента
-       client_text = " ".join(client_messages).lower()
-       last_agent_msg = agent_messages[-1] if agent_messages else ""
+       # Отправляем follow-up сообщение
+       stage = state["followup_stage"]
+       message = FOLLOWUP_MESSAGES[stage]
        
-       # Проверяем наличие информации о жильцах
-       has_residents_info = any(word in client_text for word in ["человек", "буду", "планирую", "один", "два", "три", "семь", "пара", "семья"])
+       # Не отправляем follow-up, пока по чату идет ход
+       async with self.scheduler.chat(account.chat_key(chat_id)):
+           if account.followup_states.get(chat_id) is not state or not self.owns_chat(account, chat_id):
+               return
+           async with self.scheduler.upstream("avito"):
+               success = await account.client.send_message(chat_id, message)
        
-       # Проверяем наличие информации о сроке
-       has_period_info = any(word in client_text for word in ["месяц", "год", "надолго", "постоянно"]) or any(char.isdigit() for char in client_text if "месяц" in client_text)
+       if success:
+           logger.info(f"Отправлен follow-up {stage} в чат {chat_id}: {message}")
+           
+           # Планируем следующий follow-up с накопительными интервалами
+           base_time = state["last_client_activity"]
+           
+           if stage == "2h":
+               next_stage = "16h"
+               next_interval = FOLLOWUP_INTERVALS["16h"]  # 16 часов от начала
+           elif stage == "16h":
+               next_stage = "2d"
+               next_interval = FOLLOWUP_INTERVALS["2d"]   # 2 дня от начала
+           elif stage == "2d":
+               next_stage = "4d"
+               next_interval = FOLLOWUP_INTERVALS["4d"]   # 4 дня от начала
+           else:  # stage == "4d"
+               # Последний follow-up отправлен
+               del account.followup_states[chat_id]
+               self.share_followup(account, chat_id)
+               self.store.flush()
+               return
+           
+           # Рассчитываем время следующего follow-up от базового времени
+           next_time = self.calculate_next_followup_time(base_time, next_interval)
+           
+           account.followup_states[chat_id]["followup_stage"] = next_stage
+           self.reschedule_followup(account, chat_id, next_time)
+           
+           # Сразу фиксируем этап, чтобы после перезапуска не повторить follow-up
+           self.store.flush()
+       else:
+           logger.error(f"Ошибка отправки follow-up в чат {chat_id}")
+           self.reschedule_followup(account, chat_id, time.time() + FOLLOWUP_RETRY_DELAY)
+
+   def determine_dialog_stage(self, messages, features=None):
+       """Определение текущего этапа диалога на основе истории сообщений"""
+       if features is None:
+           features = extract_dialog_features(messages)
        
-       # Проверяем наличие даты
-       has_date_info = any(word in client_text for word in ["август", "сентябр", "октябр", "ноябр", "декабр", "январ", "феврал", "март", "апрел", "май", "июн", "июл"]) or ("число" in client_text and any(char.isdigit() for char in client_text))
+       # Если нет сообщений от агента или еще не поздоровались - это начало
+       if not features.has_agent_messages or not features.has_greeting:
+           return STAGE_GREETING
        
-       # Проверяем наличие телефона
-       has_phone = any(len([c for c in msg if c.isdigit()]) >= 10 for msg in client_messages)
+       # Темы последнего сообщения агента
+       topics = features.last_agent_topics
+       has_period_info = features.has_period_info
        
        # Определяем этап на основе собранной информации
-       if not has_residents_info or "кто проживать планирует" in last_agent_msg:
+       if not features.has_residents_info or "residents" in topics:
            return STAGE_RESIDENTS
-       elif ("дет" in last_agent_msg or "ребен" in last_agent_msg) and not has_period_info:
+       elif "children" in topics and not has_period_info:
            return STAGE_CHILDREN
-       elif ("животн" in last_agent_msg or "питом" in last_agent_msg) and not has_period_info:
+       elif "pets" in topics and not has_period_info:
            return STAGE_PETS
-       elif not has_period_info or ("срок" in last_agent_msg or "месяц" in last_agent_msg):
+       elif not has_period_info or "period" in topics:
            return STAGE_RENTAL_PERIOD
-       elif not has_date_info or ("дата" in last_agent_msg or "заез" in last_agent_msg):
+       elif not features.has_date or "date" in topics:
            return STAGE_DEADLINE
-       elif not has_phone or ("телефон" in last_agent_msg or "номер" in last_agent_msg):
+       elif not features.has_phone or "contacts" in topics:
            return STAGE_CONTACTS
        else:
            return STAGE_COMPLETE  
 
    def format_dialog_history(self, messages):
        """Форматирование истории диалога для отправки в GPT"""
-       dialog = []
-       
        # Берем последние 30 сообщений и сортируем по времени (от старых к новым)
        recent_messages = messages[-MAX_MESSAGES_HISTORY:]
        sorted_messages = sorted(recent_messages, key=lambda x: x.get("created", 0))
        
-       for message in sorted_messages:
-           if message.get("type") != "text":
-               continue
-               
-           # Фильтруем системные и удаленные сообщения
-           if (message.get("author_id", 0) == 0 or 
-               "сообщение удалено" in message.get("content", {}).get("text", "").lower()):
-               continue
-               
-           direction = message.get("direction")
-           text = message.get("content", {}).get("text", "").strip()
-           
-           if not text:
-               continue
-           
-           # Определяем роль отправителя
-           if direction == "in":
-               dialog.append(f"Клиент: {text}")
-           elif direction == "out":
-               # Убираем дублирование "Светлана:" если оно уже есть в тексте
-               clean_text = text
-               if clean_text.startswith("Светлана: "):
-                   clean_text = clean_text[10:].strip()  # Убираем "Светлана: "
-               dialog.append(f"Светлана: {clean_text}")
-       
-       return "\n".join(dialog)
-       
-   async def process_chat(self, client, chat_id, chat_data):
-       """Обработка отдельного чата"""
+       dialog = [format_dialog_line(message) for message in sorted_messages]
+       return "\n".join(line for line in dialog if line is not None)
+       
+   async def summarize_history(self, previous_summary, turns):
+       """Свернуть старые реплики в краткое содержание (через слот OpenAI)"""
+       async with self.scheduler.upstream("openai"):
+           return await summarize_dialog(previous_summary, turns)
+   
+   async def process_chat(self, account, chat_id, chat_data):
+       """Обработка отдельного чата (не больше одного хода на чат одновременно)"""
+       # Чат из раздела другого процесса - ход сделает он
+       if not self.owns_chat(account, chat_id):
+           return
+       async with self.scheduler.chat(account.chat_key(chat_id)), self.scheduler.account(account.name):
+           trace = TurnTrace(chat_id)
+           trace.set(account=account.name)
+           token = current_trace.set(trace)
+           try:
+               await self._process_chat_turn(account, chat_id, chat_data)
+           finally:
+               current_trace.reset(token)
+               # Пишем только ходы с новым сообщением клиента
+               if self.trace_writer and "message_id" in trace.attributes:
+                   self.trace_writer.write(trace)
+   
+   async def _process_chat_turn(self, account, chat_id, chat_data):
+       """Один ход диалога: загрузка сообщений, ответ и проверка завершения"""
        try:
-           # Проверяем, не завершен ли уже диалог
-           if chat_id in self.completed_chats:
+           # Проверяем, не завершен ли уже диалог (в том числе прежним владельцем раздела)
+           if await self.is_chat_completed(account, chat_id):
                return
            
            # Сохраняем данные объявления
            item_data = chat_data.get("context", {}).get("value", {})
            if item_data:
-               self.chat_items[chat_id] = item_data
+               account.chat_items[chat_id] = item_data
            
-           # Получаем сообщения чата
-           messages = await client.get_messages(chat_id, limit=MAX_MESSAGES_HISTORY)
+           # Получаем сообщения чата (из кэша, догружая только новые)
+           with span("fetch_messages"):
+               async with self.scheduler.upstream("avito"):
+                   messages = await account.message_cache.sync(account.client, chat_id)
            if not messages:
+               # Ошибка get_messages: подпись чата уже запомнена, без сброса чат больше не проверится
+               account.chat_index.invalidate(chat_id)
                return
            
            # Ищем последнее реальное сообщение от клиента
@@ -335,7 +546,7 @@ class AvitoRentalBot:
                return
            
            # Проверяем, не обработано ли уже это сообщение
-           last_processed_time = self.processed_messages.get(chat_id, 0)
+           last_processed_time = account.processed_messages.get(chat_id, 0)
            if last_incoming["created"] <= last_processed_time:
                return
            
@@ -348,144 +559,455 @@ class AvitoRentalBot:
            if has_newer_outgoing:
                return
            
-           print(f"Получено сообщение: {last_incoming['content']['text'][:100]}...")
+           logger.info("Получено сообщение в чате %s: %.100s", chat_id, last_incoming["content"]["text"])
+           annotate(message_id=last_incoming.get("id"), message_created=last_incoming["created"])
            
            # Останавливаем follow-up при получении нового сообщения от клиента
-           self.stop_followup_sequence(chat_id)
-           
-           # Определяем текущий этап диалога
-           current_stage = self.determine_dialog_stage(messages)
-           self.chat_stages[chat_id] = current_stage
-           
-           # Определяем, первое ли это сообщение
-           has_any_outgoing = any(m.get("direction") == "out" and m.get("type") == "text" for m in messages)
-           is_first_message = not has_any_outgoing
+           self.stop_followup_sequence(account, chat_id)
            
-           # Форматируем историю диалога для отправки в GPT
-           dialog_history = self.format_dialog_history(messages)
-           
-           # ОТЛАДКА: выводим что отправляется в нейросеть
-           print(f"=== ОТЛАДКА ЧАТА {chat_id} ===")
-           print(f"current_stage: {current_stage}")
-           print(f"is_first_message: {is_first_message}")
-           print(f"dialog_history отправляемый в GPT:")
-           print(dialog_history[-500:])  # Показываем только последние 500 символов
-           print("=== КОНЕЦ ОТЛАДКИ ===")
-           
-           # Генерируем ответ через ChatGPT
-           response = await get_agent_response(dialog_history, is_first_message)
+           with span("stage_detection"):
+               # Признаки диалога собираем за один проход и используем повторно
+               features = extract_dialog_features(messages)
+               
+               # Определяем текущий этап диалога
+               current_stage = self.determine_dialog_stage(messages, features)
+               account.chat_stages[chat_id] = current_stage
+               
+               # Определяем, первое ли это сообщение
+               has_any_outgoing = any(m.get("direction") == "out" and m.get("type") == "text" for m in messages)
+               is_first_message = not has_any_outgoing
+           annotate(stage=current_stage, is_first_message=is_first_message, messages=len(messages))
            
-           if not response:
-               print(f"Не удалось сгенерировать ответ для чата {chat_id}")
-               return
+           # История диалога поддерживается кэшем инкрементально (текст - для логов и заявки)
+           dialog_history = account.message_cache.dialog(chat_id)
            
-           # Удаляем маркер завершения из ответа перед отправкой клиенту
-           clean_response = response.replace(COMPLETION_MARKER, "").strip()
+           # Приветствие и частые вопросы отвечаем сразу, без GPT
+           fast_reply = None
+           if FAST_REPLIES_ENABLED:
+               fast_reply = self.fast_replies.reply(self.pending_client_texts(messages), is_first_message, current_stage)
            
-           # Отправляем ответ клиенту
-           success = await client.send_message(chat_id, clean_response)
+           if fast_reply:
+               logger.info(f"Быстрый ответ без GPT для чата {chat_id}")
+               annotate(reply_path="fast")
+               clean_response, is_complete = fast_reply, False
+               with span("avito_send"):
+                   success = await self.send_reply(account, chat_id, clean_response)
+           else:
+               annotate(reply_path="stream" if OPENAI_STREAMING else "gpt")
+               reply = await self._llm_reply(account, chat_id, dialog_history, is_first_message)
+               if reply is None:
+                   logger.warning(f"Не удалось сгенерировать ответ для чата {chat_id}")
+                   annotate(outcome="no_response")
+                   account.chat_index.invalidate(chat_id)
+                   return
+               clean_response, success, is_complete = reply
            
            if success:
-               print(f"Отправлен ответ: {clean_response[:100]}...")
+               logger.info("Отправлен ответ в чат %s: %.100s", chat_id, clean_response)
+               poll_chats.inc(account=account.name, result="answered")
+               account.stats["answered"] += 1
+               annotate(outcome="completed" if is_complete else "answered")
                
                # Обновляем время последнего обработанного сообщения
-               self.processed_messages[chat_id] = last_incoming["created"]
+               account.processed_messages[chat_id] = last_incoming["created"]
                
                # Сохраняем состояние диалога
-               self.chat_states[chat_id].append(dialog_history)
+               account.chat_states[chat_id].append(dialog_history)
                
                # Проверяем завершенность диалога по маркеру
-               if check_dialog_completion(response):
-                   await self.handle_completed_dialog(chat_id, dialog_history + f"\nСветлана: {clean_response}")
+               if is_complete:
+                   with span("completion"):
+                       self.complete_dialog(account, chat_id, dialog_history + f"\nСветлана: {clean_response}")
                else:
                    # Запускаем follow-up последовательность только если диалог не завершен
-                   if not self.is_dialog_complete_check(messages):
-                       self.start_followup_sequence(chat_id, last_incoming["created"])
+                   if not self.is_dialog_complete_check(messages, features):
+                       self.start_followup_sequence(account, chat_id, last_incoming["created"])
                    
            else:
-               print(f"Ошибка отправки ответа в чат {chat_id}")
+               logger.error(f"Ошибка отправки ответа в чат {chat_id}")
+               annotate(outcome="send_failed")
+               account.chat_index.invalidate(chat_id)
                
        except Exception as e:
-           print(f"Ошибка обработки чата {chat_id}: {e}")
+           logger.error(f"Ошибка обработки чата {chat_id}: {e}")
+           annotate(outcome="error", error=f"{type(e).__name__}: {e}")
+           account.chat_index.invalidate(chat_id)
+   
+   async def send_reply(self, account, chat_id, text):
+       """Отправка ответа хода (False - не отправлен).
+       
+       Пока шел ход (повторы OpenAI, свертка истории, поток), раздел чата
+       мог перейти к другому процессу - тогда отвечает уже он.
+       """
+       if not self.owns_chat(account, chat_id):
+           logger.warning(f"[{account.name}] Чат {chat_id} перешел к другому процессу во время хода, ответ не отправлен")
+           return False
+       async with self.scheduler.upstream("avito"):
+           return await account.client.send_message(chat_id, text)
+   
+   async def _llm_reply(self, account, chat_id, dialog_history, is_first_message):
+       """Ответ через GPT: (отправленный текст, успех, диалог завершен) или None"""
+       # Реплики по ролям в пределах бюджета токенов (свертка старых - тоже запрос к модели)
+       with span("history") as record:
+           summary, dialog_turns = await account.context_window.build(chat_id, account.message_cache.dialog_lines(chat_id))
+           if record is not None:
+               record.update(turns=len(dialog_turns), summary=bool(summary), history_chars=len(dialog_history))
+       
+       if sampled(dialog_logger, LOG_DIALOG_DUMP_SAMPLE_RATE):
+           dialog_logger.debug(
+               "Запрос к модели для чата %s: реплик %d, краткое содержание: %s\n%s",
+               chat_id, len(dialog_turns), "есть" if summary else "нет", dialog_history[-500:]
+           )
+       
+       # Генерируем ответ через ChatGPT
+       if OPENAI_STREAMING:
+           with span("llm", streaming=True):
+               return await self._stream_reply(account, chat_id, dialog_turns, summary)
+       
+       with span("llm", streaming=False):
+           async with self.scheduler.upstream("openai"):
+               response = await get_agent_response(dialog_turns, is_first_message, summary)
+       
+       if not response:
+           return None
+       
+       # Удаляем маркер завершения из ответа перед отправкой клиенту
+       clean_response = response.replace(COMPLETION_MARKER, "").strip()
+       
+       # Отправляем ответ клиенту
+       with span("avito_send"):
+           success = await self.send_reply(account, chat_id, clean_response)
+       return clean_response, success, check_dialog_completion(response)
+   
+   async def _stream_reply(self, account, chat_id, dialog_turns, summary=None):
+       """Потоковый ответ: каждый готовый абзац сразу отправляется в Avito.
+       
+       Возвращает (отправленный текст, успех, диалог завершен). Если абзац
+       не удалось отправить, остальные не отправляются, чтобы клиент не
+       получил ответ с пропуском посередине; уже отправленная часть
+       считается ответом, чтобы не повторять ее на следующем цикле.
+       """
+       sent = []
+       failed = False
+       
+       async def send_paragraph(paragraph):
+           nonlocal failed
+           if failed:
+               return
+           try:
+               with span("avito_send"):
+                   ok = await self.send_reply(account, chat_id, paragraph)
+           except Exception as e:
+               # Ошибка сети при отправке - как неудачная отправка, без повтора запроса к OpenAI
+               logger.error(f"Ошибка отправки абзаца в чат {chat_id}: {e}")
+               ok = False
+           if ok:
+               if not sent:
+                   logger.info(f"Первый абзац ответа отправлен в чат {chat_id}")
+               sent.append(paragraph)
+           else:
+               failed = True
+       
+       async with self.scheduler.upstream("openai"):
+           stream = await stream_agent_response(dialog_turns, send_paragraph, summary)
+       
+       if stream is None and not sent and not failed:
+           # Поток не открылся: как и в обычном режиме, просим повторить
+           ok = await self.send_reply(account, chat_id, OPENAI_ERROR)
+           return OPENAI_ERROR, ok, False
+       
+       is_complete = stream is not None and stream.completed and not failed
+       return "\n\n".join(sent), bool(sent), is_complete
    
-   async def handle_completed_dialog(self, chat_id, final_dialog):
-       """Обработка завершенного диалога"""
+   async def handle_webhook_event(self, account, chat_id, message):
+       """Обработка webhook-события о новом сообщении в чате"""
        try:
-           print(f"Диалог завершен в чате {chat_id}, извлекаем данные клиента...")
-           
-           # Извлекаем структурированные данные клиента
-           client_data = await extract_final_client_data(final_dialog)
+           # Свои сообщения и сообщения завершенных чатов не обрабатываем
+           if message.get("author_id") == account.user_id or chat_id in account.completed_chats:
+               return
            
-           if client_data:
-               print(f"Данные клиента извлечены: {json.dumps(client_data, ensure_ascii=False, indent=2)}")
-               
-               # Получаем данные объявления для этого чата
-               item_data = self.chat_items.get(chat_id)
-               
-               # Отправляем заявку в Telegram с данными объявления
-               success = await send_completed_application(client_data, item_data)
-               
-               if success:
-                   print(f"Заявка отправлена в Telegram для чата {chat_id}")
-               else:
-                   print(f"Ошибка отправки заявки в Telegram для чата {chat_id}")
+           # Данные объявления берем из кэша, при первом событии - запрашиваем чат
+           item_data = account.chat_items.get(chat_id)
+           if item_data:
+               chat_data = {"id": chat_id, "context": {"value": item_data}}
            else:
-               print(f"Не удалось извлечь данные клиента из чата {chat_id}")
-           
-           # Помечаем чат как завершенный и останавливаем follow-up
-           self.completed_chats.add(chat_id)
-           self.stop_followup_sequence(chat_id)
+               chat_data = await account.client.get_chat(chat_id) or {"id": chat_id}
            
+           await self.process_chat(account, chat_id, chat_data)
        except Exception as e:
-           print(f"Ошибка обработки завершенного диалога {chat_id}: {e}")
+           logger.error(f"Ошибка обработки webhook-события для чата {chat_id}: {e}")
+   
+   def complete_dialog(self, account, chat_id, final_dialog):
+       """Зафиксировать завершение диалога и поставить заявку в фоновую обработку"""
+       logger.info(f"Диалог завершен в чате {chat_id}, заявка передана в фоновую обработку")
+       # Задание записывается на диск сразу; завершение фиксируем в том же шаге,
+       # чтобы после перезапуска заявка не ушла повторно
+       self.completion_workers.enqueue({
+           "account": account.name, "chat_id": chat_id, "final_dialog": final_dialog, "completed_at": time.time()
+       })
+       account.completed_chats.add(chat_id)
+       if self.shared_state:
+           self.write_shared(account, chat_id, self.shared_state.mark_completed)
+       self.stop_followup_sequence(account, chat_id)
+       self.store.flush()
+   
+   async def handle_completed_dialog(self, chat_id, final_dialog, completed_at=None, account_name=DEFAULT_ACCOUNT):
+       """Обработка завершенного диалога (фоновое задание; False - повторить позже)"""
+       account = self.get_account(account_name)
+       logger.info(f"Извлекаем данные клиента из чата {chat_id}...")
+       
+       # "Завтра" и "с 5 числа" считаются от дня завершения диалога, а не от повтора задания
+       moscow_tz = timezone(timedelta(hours=3))
+       today = datetime.fromtimestamp(completed_at or time.time(), moscow_tz).date()
+       
+       # Извлекаем структурированные данные клиента (модель - только для недостающих полей)
+       async with self.scheduler.upstream("openai"):
+           client_data = await extract_final_client_data(final_dialog, today)
+       
+       if not client_data:
+           logger.warning(f"Не удалось извлечь данные клиента из чата {chat_id}, повторим позже")
+           return False
+       
+       logger.info("Данные клиента извлечены из чата %s", chat_id)
+       logger.debug("Данные клиента из чата %s: %s", chat_id, client_data)
+       
+       # Получаем данные объявления для этого чата
+       item_data = account.chat_items.get(chat_id)
+       
+       # Ставим заявку в очередь Telegram: отправка с повторами, даже после перезапуска
+       application = await format_application(client_data, item_data)
+       self.telegram_outbox.enqueue(TELEGRAM_CHAT_ID, application)
+       logger.info(f"Заявка для чата {chat_id} поставлена в очередь Telegram")
+       return True
+   
+   async def followup_loop(self, account):
+       """Отправка follow-up в срок: сон до ближайшего запланированного"""
+       while True:
+           await account.followup_queue.wait_due(FOLLOWUP_MAX_SLEEP)
+           try:
+               await account.client.start()
+               await self.process_followups(account)
+           except Exception as e:
+               logger.error(f"Ошибка обработки follow-up: {e}")
+   
+   async def flush_state_loop(self):
+       """Периодическая запись накопленных изменений состояния"""
+       loop = asyncio.get_running_loop()
+       while True:
+           await asyncio.sleep(STATE_FLUSH_INTERVAL)
+           try:
+               self.store.sync()
+               await loop.run_in_executor(None, self.store.write_pending)
+           except Exception as e:
+               logger.error(f"Ошибка записи состояния: {e}")
+   
+   async def poll_cycle(self, account):
+       """Один цикл опроса аккаунта: список чатов и параллельная обработка изменившихся"""
+       cycle_started = time.monotonic()
+       answered_before = account.stats["answered"]
+       
+       # Получаем чаты, обновленные в пределах временного окна (страницы - по очереди)
+       since = time.time() - TIME_WINDOW_HOURS * 60 * 60
+       async with self.scheduler.upstream("avito"):
+           chats = [
+               chat async for chat in account.client.iter_chats(
+                   since, unread_only=CHATS_UNREAD_ONLY, chat_types=CHATS_TYPES, page_size=CHATS_PAGE_SIZE
+               )
+           ]
+       logger.info(f"[{account.name}] Получено {len(chats)} чатов для проверки")
+       
+       # Создаем задачи для параллельной обработки изменившихся чатов
+       # (одновременных ходов аккаунта - не больше ACCOUNT_CHAT_CONCURRENCY)
+       tasks = []
+       foreign = 0
+       for chat in chats:
+           chat_id = chat.get("id")
+           # Чужие чаты не запоминаем в индексе: если раздел перейдет к нам, чат проверится
+           if chat_id and not self.owns_chat(account, chat_id):
+               foreign += 1
+               continue
+           if chat_id and account.chat_index.has_changed(chat):
+               task = asyncio.create_task(
+                   self.process_chat(account, chat_id, chat)
+               )
+               tasks.append(task)
+       
+       # Ждем завершения всех задач
+       if tasks:
+           await asyncio.gather(*tasks, return_exceptions=True)
+       
+       # Метрики цикла: ответы через webhook между циклами тоже попадают в answered
+       cycle_chats = {
+           "scanned": len(chats),
+           "skipped": len(chats) - len(tasks) - foreign,
+           "answered": account.stats["answered"] - answered_before
+       }
+       poll_cycle_seconds.observe(time.monotonic() - cycle_started, account=account.name)
+       poll_chats.inc(cycle_chats["scanned"], account=account.name, result="scanned")
+       poll_chats.inc(cycle_chats["skipped"], account=account.name, result="skipped")
+       for result, count in cycle_chats.items():
+           last_cycle_chats.set(count, account=account.name, result=result)
+       
+       logger.info(f"[{account.name}] Загружено сообщений: {len(tasks)} чатов, без изменений: {cycle_chats['skipped']} "
+                   f"(всего пропущено {account.chat_index.stats['skipped']}), других процессов: {foreign}, "
+                   f"ответов: {cycle_chats['answered']}, "
+                   f"цикл {time.monotonic() - cycle_started:.2f}с")
+       return cycle_chats
+   
+   async def poll_accounts(self):
+       """Цикл опроса всех аккаунтов параллельно; ошибка одного не мешает остальным"""
+       results = await asyncio.gather(*(self.poll_account(account) for account in self.accounts))
+       return dict(zip((account.name for account in self.accounts), results))
+   
+   async def poll_account(self, account):
+       try:
+           # Открываем сессию и токен (повторный вызов ничего не делает)
+           await account.client.start()
+           return await self.poll_cycle(account)
+       except Exception as e:
+           logger.error(f"[{account.name}] Ошибка цикла опроса: {e}")
+           return None
+   
+   def log_stats(self):
+       """Сводка по очередям, апстримам и кэшам после цикла опроса"""
+       for name, stat in sorted(self.scheduler.stats().items()):
+           logger.info(f"Очередь {name}: в работе {stat['in_flight']}, ожидают {stat['waiting']}, "
+                       f"ожидание p95 {stat['wait_p95']:.2f}с, макс {stat['wait_max']:.2f}с")
+       openai_stats = get_openai_stats()
+       summarized = sum(account.context_window.stats["summarized"] for account in self.accounts)
+       logger.info(f"OpenAI: p50 {openai_stats['latency_p50']:.2f}с, p95 {openai_stats['latency_p95']:.2f}с, "
+                   f"429: {openai_stats['throttled']}, повторов: {openai_stats['retries']}, "
+                   f"в очереди лимитера: {openai_stats['waiting']}, "
+                   f"кэш промпта: {openai_stats['cache_hit_ratio']:.0%}, "
+                   f"сверток истории: {summarized}")
+       for account in self.accounts:
+           logger.info(f"[{account.name}] Follow-up в очереди: {len(account.followup_queue)}, "
+                       f"ответов всего: {account.stats['answered']}")
+       if self.leases:
+           logger.info(f"Разделы чатов: {self.leases.owned_count()}/{self.leases.partitions}, "
+                       f"процессов {self.leases.stats['workers']}, ошибок продления {self.leases.stats['errors']}")
+       fast_stats = self.fast_replies.stats
+       logger.info(f"Быстрые ответы без GPT: {fast_stats['hits']}/{fast_stats['checked']} "
+                   f"({self.fast_replies.hit_rate():.0%}), по вопросам: {self.fast_replies.intent_hits}")
+       outbox_stats = self.telegram_outbox.stats()
+       logger.info(f"Очередь Telegram: {outbox_stats['depth']}, доставлено {outbox_stats['delivered']}, "
+                   f"доставка p95 {outbox_stats['latency_p95']:.1f}с, 429: {outbox_stats['throttled']}")
+       completion_stats = self.completion_workers.stats()
+       extraction = get_extraction_stats()
+       logger.info(f"Завершенные диалоги: в очереди {completion_stats['depth']}, "
+                   f"в работе {completion_stats['in_progress']}, повторов {completion_stats['retries']}, "
+                   f"без запроса к модели {extraction['llm_skipped']}/{extraction['dialogs']} "
+                   f"({extraction['skip_ratio']:.0%}), частичных {extraction['llm_partial']}")
    
    async def run(self):
        """Основной цикл работы бота"""
-       print("Запуск Avito Rental Bot...")
-       print(f"Интервал проверки: {CHECK_INTERVAL} секунд")
-       print(f"Временное окно: {TIME_WINDOW_HOURS} часов")
-       print(f"Интервал проверки follow-up: {FOLLOWUP_CHECK_INTERVAL} секунд")
+       logger.info("Запуск Avito Rental Bot...")
+       logger.info(f"Интервал проверки: {CHECK_INTERVAL} секунд")
+       logger.info(f"Режим приема сообщений: {'webhook' if WEBHOOK_ENABLED else 'опрос'}")
+       logger.info(f"Временное окно: {TIME_WINDOW_HOURS} часов")
+       logger.info(f"Аккаунты Avito: {', '.join(account.name for account in self.accounts)}")
+       logger.info(f"Заявок в очереди Telegram: {len(self.telegram_outbox.queue)}")
+       logger.info(f"Завершенных диалогов в обработке: {len(self.completion_workers.queue)}")
+       for account in self.accounts:
+           logger.info(f"[{account.name}] Follow-up в очереди: {len(account.followup_queue)}")
+           for chat_id, when, stage in self.upcoming_followups(account, 5):
+               logger.info(f"  {when.strftime('%Y-%m-%d %H:%M:%S МСК')} - чат {chat_id}, этап {stage}")
        
-       # Последняя проверка follow-up
-       last_followup_check = 0
+       if self.trace_writer:
+           self.trace_writer.start()
        
-       while True:
+       # Аренда разделов: первая - до опроса, дальше продлевается в фоне
+       lease_task = None
+       if self.leases:
+           logger.info(f"Процесс {self.leases.worker_id}, разделов {self.leases.partitions}, аренда {self.leases.ttl}с")
            try:
-               current_time = datetime.utcnow().timestamp()
-               
-               # Создаем клиент Avito API
-               async with AvitoClient(AVITO_USER_ID, AVITO_CLIENT_ID, AVITO_CLIENT_SECRET) as client:
-                   # Проверяем follow-up сообщения
-                   if current_time - last_followup_check >= FOLLOWUP_CHECK_INTERVAL:
-                       await self.process_followups(client)
-                       last_followup_check = current_time
-                   
-                   # Получаем список чатов
-                   chats = await client.get_chats(limit=100)
-                   print(f"Получено {len(chats)} чатов для проверки")
-                   
-                   # Создаем задачи для параллельной обработки чатов
-                   tasks = []
-                   for chat in chats:
-                       chat_id = chat.get("id")
-                       if chat_id:
-                           task = asyncio.create_task(
-                               self.process_chat(client, chat_id, chat)
-                           )
-                           tasks.append(task)
-                   
-                   # Ждем завершения всех задач
-                   if tasks:
-                       await asyncio.gather(*tasks, return_exceptions=True)
+               # Состояние, накопленное до включения разделения, становится общим
+               for account in self.accounts:
+                   await self.shared_state.submit(
+                       self.shared_state.import_local,
+                       account.name, list(account.completed_chats), dict(account.followup_states)
+                   )
+               gained, lost = await asyncio.get_running_loop().run_in_executor(None, self.leases.renew)
+               await self.handle_partition_change(gained, lost)
+           except Exception as e:
+               logger.error(f"Не удалось арендовать разделы: {e}")
+           lease_task = asyncio.create_task(self.leases.run(self.handle_partition_change))
+       
+       # Фоновая пакетная запись состояния в SQLite
+       flush_task = asyncio.create_task(self.flush_state_loop())
+       # Follow-up отправляются своим таймером, независимо от цикла опроса (по таймеру на аккаунт)
+       followup_tasks = [asyncio.create_task(self.followup_loop(account)) for account in self.accounts]
+       # Заявки в Telegram (в том числе не отправленные до перезапуска)
+       outbox_task = asyncio.create_task(self.telegram_outbox.run())
+       # Фоновая обработка завершенных диалогов (и недоделанных до перезапуска)
+       self.completion_workers.start()
+       
+       # Метрики для Prometheus
+       metrics_server = None
+       if METRICS_ENABLED:
+           metrics_server = MetricsServer(registry, host=METRICS_HOST, port=METRICS_PORT, path=METRICS_PATH)
+           try:
+               await metrics_server.start()
+           except OSError as e:
+               # Занятый порт не должен останавливать бота
+               logger.warning(f"Не удалось запустить сервер метрик: {e}")
+               metrics_server = None
+       
+       # В режиме webhook опрос get_chats остается только сверкой
+       webhook_server = None
+       poll_interval = WEBHOOK_RECONCILE_INTERVAL if WEBHOOK_ENABLED else CHECK_INTERVAL
+       
+       try:
+           while True:
+               try:
+                   # Один webhook-сервер на все аккаунты: событие уходит аккаунту получателя
+                   if WEBHOOK_ENABLED and webhook_server is None:
+                       webhook_server = WebhookServer(
+                           lambda chat_id, message: self.handle_webhook_event(
+                               self.account_for_event(message), chat_id, message
+                           ),
+                           host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET
+                       )
+                       await webhook_server.start()
+                       if WEBHOOK_PUBLIC_URL:
+                           for account in self.accounts:
+                               await account.client.start()
+                               if await account.client.subscribe_webhook(WEBHOOK_PUBLIC_URL):
+                                   logger.info(f"[{account.name}] Webhook зарегистрирован в Avito: {WEBHOOK_PUBLIC_URL}")
+                               else:
+                                   logger.warning(f"[{account.name}] Не удалось зарегистрировать webhook в Avito")
                    
-                   print(f"Обработка завершена. Ожидание {CHECK_INTERVAL} секунд...")
+                   await self.poll_accounts()
+                   self.log_stats()
+                   logger.info(f"Обработка завершена. Ожидание {poll_interval} секунд...")
                    
-           except Exception as e:
-               print(f"Критическая ошибка в основном цикле: {e}")
-               print("Ожидание перед повторной попыткой...")
-           
-           # Ждем до следующей проверки
-           await asyncio.sleep(CHECK_INTERVAL)
+               except Exception as e:
+                   logger.error(f"Критическая ошибка в основном цикле: {e}")
+                   logger.warning("Ожидание перед повторной попыткой...")
+               
+               # Ждем до следующей проверки
+               await asyncio.sleep(poll_interval)
+       finally:
+           flush_task.cancel()
+           for task in followup_tasks:
+               task.cancel()
+           if lease_task:
+               lease_task.cancel()
+               self.shared_state.close()
+               self.leases.release()
+               self.leases.close()
+           outbox_task.cancel()
+           self.completion_workers.stop()
+           if webhook_server:
+               await webhook_server.stop()
+           if metrics_server:
+               await metrics_server.stop()
+           if self.trace_writer:
+               self.trace_writer.stop()
+           self.store.close()
+           for account in self.accounts:
+               await account.client.close()
+           await close_all_sessions()
 
 async def main():
    """Точка входа в приложение"""
@@ -493,11 +1015,15 @@ async def main():
    await bot.run()
 
 if __name__ == "__main__":
+   # Логи пишутся фоновым потоком, чтобы медленный stdout не блокировал цикл
+   setup_logging(LOG_LEVEL, LOG_MODULE_LEVELS, LOG_FORMAT, LOG_FILE)
    # Запуск основного приложения
    try:
        asyncio.run(main())
    except KeyboardInterrupt:
-       print("\nОстановка бота по запросу пользователя")
+       logger.info("Остановка бота по запросу пользователя")
    except Exception as e:
 
-       print(f"Критическая ошибка: {e}")
+       logger.exception(f"Критическая ошибка: {e}")
+   finally:
+       shutdown_logging()
@@ -0,0 +1,212 @@
+import time
+from collections import OrderedDict, deque
+
+# Максимальный limit у метода сообщений Avito
+MAX_PAGE_SIZE = 100
+
+
+# Роли сообщений в запросе к GPT и подписи в текстовой истории
+ROLE_LABELS = {"user": "Клиент", "assistant": "Светлана"}
+
+
+def dialog_turn(message):
+    """Реплика диалога (роль, текст) или None, если сообщение не попадает в историю"""
+    if message.get("type") != "text":
+        return None
+
+    # Фильтруем системные и удаленные сообщения
+    text = message.get("content", {}).get("text", "")
+    if message.get("author_id", 0) == 0 or "сообщение удалено" in text.lower():
+        return None
+
+    text = text.strip()
+    if not text:
+        return None
+
+    direction = message.get("direction")
+    if direction == "in":
+        return "user", text
+    elif direction == "out":
+        # Убираем дублирование "Светлана:" если оно уже есть в тексте
+        if text.startswith("Светлана: "):
+            text = text[10:].strip()
+        return "assistant", text
+    return None
+
+
+def format_dialog_line(message):
+    """Строка истории диалога для GPT или None, если сообщение не попадает в историю"""
+    turn = dialog_turn(message)
+    if turn is None:
+        return None
+    role, text = turn
+    return f"{ROLE_LABELS[role]}: {text}"
+
+
+def merge_turns(turns):
+    """Сообщения для chat completions: подряд идущие реплики одной роли склеиваются"""
+    messages = []
+    for role, text in turns:
+        if messages and messages[-1]["role"] == role:
+            messages[-1]["content"] += "\n" + text
+        else:
+            messages.append({"role": role, "content": text})
+    return messages
+
+
+def message_key(message):
+    return message.get("id") or (message.get("created"), message.get("direction"), message.get("content", {}).get("text"))
+
+
+class ChatMessages:
+    """Окно последних сообщений одного чата и готовые строки истории"""
+
+    def __init__(self, max_messages):
+        self.max_messages = max_messages
+        self.keys = set()
+        # Сообщения от старых к новым и реплики истории (ключ, created, роль, текст) для них
+        self.messages = deque()
+        self.lines = deque()
+        self.touched_at = time.monotonic()
+
+    def add(self, new_messages):
+        """Добавить новые сообщения; возвращает изменение числа хранимых сообщений"""
+        before = len(self.messages)
+        # Одновременные догрузки одного чата могут принести одни и те же сообщения
+        fresh = {}
+        for message in new_messages:
+            key = message_key(message)
+            if key not in self.keys:
+                fresh.setdefault(key, message)
+        new_messages = sorted(fresh.values(), key=lambda m: m.get("created", 0))
+        last_created = self.messages[-1].get("created", 0) if self.messages else None
+        in_order = last_created is None or not new_messages or new_messages[0].get("created", 0) >= last_created
+
+        for message in new_messages:
+            self.keys.add(message_key(message))
+            self.messages.append(message)
+            if in_order:
+                turn = dialog_turn(message)
+                if turn is not None:
+                    self.lines.append((message_key(message), message.get("created", 0), *turn))
+
+        if not in_order:
+            # Сообщение пришло не по порядку - пересобираем окно целиком (редкий случай)
+            self.messages = deque(sorted(self.messages, key=lambda m: m.get("created", 0)))
+            self._trim()
+            self.lines = deque()
+            for m in self.messages:
+                turn = dialog_turn(m)
+                if turn is not None:
+                    self.lines.append((message_key(m), m.get("created", 0), *turn))
+        else:
+            self._trim()
+        return len(self.messages) - before
+
+    def _trim(self):
+        while len(self.messages) > self.max_messages:
+            oldest = self.messages.popleft()
+            key = message_key(oldest)
+            self.keys.discard(key)
+            if self.lines and self.lines[0][0] == key:
+                self.lines.popleft()
+
+    def dialog(self):
+        return "\n".join(f"{ROLE_LABELS[role]}: {text}" for _, _, role, text in self.lines)
+
+    def turns(self):
+        return merge_turns((role, text) for _, _, role, text in self.lines)
+
+
+class MessageCache:
+    """Кэш сообщений чатов: догружаются только сообщения новее уже известных"""
+
+    def __init__(self, max_per_chat=30, page_size=5, max_chats=1000, max_messages=50000, ttl=6 * 60 * 60):
+        self.max_per_chat = max_per_chat
+        self.page_size = page_size
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        self.ttl = ttl
+        # chat_id -> ChatMessages, от давно не использованных к недавним
+        self._chats = OrderedDict()
+        self.total_messages = 0
+        self.stats = {"syncs": 0, "requests": 0, "fetched": 0, "new": 0, "evicted_chats": 0}
+
+    def __contains__(self, chat_id):
+        return chat_id in self._chats
+
+    async def sync(self, client, chat_id):
+        """Догрузить новые сообщения чата и вернуть окно (от старых к новым).
+
+        API отдает сообщения от новых к старым, поэтому страницы запрашиваются
+        с offset до первого уже известного сообщения."""
+        self._expire()
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = ChatMessages(self.max_per_chat)
+            self._chats[chat_id] = entry
+        self._chats.move_to_end(chat_id)
+        entry.touched_at = time.monotonic()
+        self.stats["syncs"] += 1
+
+        new_messages = []
+        offset = 0
+        limit = self.page_size if entry.messages else min(self.max_per_chat, MAX_PAGE_SIZE)
+        while True:
+            page = await client.get_messages(chat_id, limit=limit, offset=offset)
+            self.stats["requests"] += 1
+            self.stats["fetched"] += len(page)
+            fresh = [m for m in page if message_key(m) not in entry.keys]
+            new_messages.extend(fresh)
+            offset += len(page)
+            # Дошли до известных сообщений, до конца истории или до размера окна
+            if len(fresh) < len(page) or len(page) < limit or offset >= self.max_per_chat:
+                break
+
+        if new_messages:
+            self.stats["new"] += len(new_messages)
+            self.total_messages += entry.add(new_messages)
+            self._evict()
+        return list(entry.messages)
+
+    def messages(self, chat_id):
+        entry = self._chats.get(chat_id)
+        return list(entry.messages) if entry else []
+
+    def dialog(self, chat_id):
+        """Готовая история диалога для GPT"""
+        entry = self._chats.get(chat_id)
+        return entry.dialog() if entry else ""
+
+    def turns(self, chat_id):
+        """История диалога для GPT в виде сообщений user/assistant"""
+        entry = self._chats.get(chat_id)
+        return entry.turns() if entry else []
+
+    def dialog_lines(self, chat_id):
+        """Реплики чата (ключ, created, роль, текст) от старых к новым"""
+        entry = self._chats.get(chat_id)
+        return list(entry.lines) if entry else []
+
+    def forget(self, chat_id):
+        entry = self._chats.pop(chat_id, None)
+        if entry:
+            self.total_messages -= len(entry.messages)
+
+    def _expire(self):
+        # Самые давно использованные чаты - в начале, поэтому проверяем только их
+        now = time.monotonic()
+        while self._chats:
+            chat_id, entry = next(iter(self._chats.items()))
+            if now - entry.touched_at < self.ttl:
+                break
+            self._drop_oldest()
+
+    def _evict(self):
+        while self._chats and (len(self._chats) > self.max_chats or self.total_messages > self.max_messages):
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        _, entry = self._chats.popitem(last=False)
+        self.total_messages -= len(entry.messages)
+        self.stats["evicted_chats"] += 1
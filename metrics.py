@@ -0,0 +1,224 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CYCLE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """[(суффикс имени, значения меток, доп. метки, значение), ...]"""
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, values, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонный счетчик (запросы, ошибки, обработанные чаты)"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        return [("", key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """Текущее значение; можно задать функцию, которая читается при выдаче метрик"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.values = {}
+        self.functions = {}
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self.functions[self._key(labels)] = function
+
+    def samples(self):
+        values = dict(self.values)
+        for key, function in self.functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.error(f"Ошибка чтения метрики {self.name}: {e}")
+        return [("", key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Распределение длительностей по корзинам (для перцентилей на стороне Prometheus)"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # ключ меток -> [счетчики по корзинам, сумма, количество]
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = [[0] * len(self.buckets), 0.0, 0]
+            self.series[key] = series
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels):
+        series = self.series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        result = []
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                result.append(("_bucket", key, (("le", format_value(bound)),), cumulative))
+            result.append(("_sum", key, (), total))
+            result.append(("_count", key, (), count))
+        return result
+
+
+class MetricsRegistry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(self.prefix + name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._add(Gauge(self.prefix + name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help_text, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class MetricsServer:
+    """HTTP-сервер с одной страницей /metrics для Prometheus"""
+
+    def __init__(self, registry, host="127.0.0.1", port=9838, path="/metrics"):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.path = path
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(self.path, self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+
+# Метрики бота (общие для всех модулей)
+registry = MetricsRegistry(prefix="avito_bot_")
+
+upstream_latency = registry.histogram(
+    "upstream_request_seconds", "Длительность запросов к внешним API", ("upstream", "operation")
+)
+upstream_errors = registry.counter(
+    "upstream_errors_total", "Неудачные запросы к внешним API (ошибки сети и статусы не 200)", ("upstream", "operation")
+)
+poll_cycle_seconds = registry.histogram(
+    "poll_cycle_seconds", "Длительность цикла опроса чатов аккаунта", ("account",), buckets=CYCLE_BUCKETS
+)
+poll_chats = registry.counter(
+    "poll_chats_total", "Чаты по результату: scanned - получены в цикле опроса, skipped - без изменений, "
+    "answered - отправлен ответ", ("account", "result")
+)
+last_cycle_chats = registry.gauge(
+    "poll_last_cycle_chats", "Чаты в последнем цикле опроса аккаунта по результату", ("account", "result")
+)
+queue_size = registry.gauge(
+    "queue_size", "Размер очередей бота (followup, telegram, completions)", ("queue",)
+)
+partitions_owned = registry.gauge(
+    "partitions_owned", "Разделы чатов, арендованные процессом (в режиме нескольких процессов)"
+)
+
+
+@contextmanager
+def track(upstream, operation):
+    """Замер длительности запроса; исключение считается ошибкой апстрима"""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        upstream_errors.inc(upstream=upstream, operation=operation)
+        raise
+    finally:
+        upstream_latency.observe(time.monotonic() - started, upstream=upstream, operation=operation)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+
+from rate_limiter import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramOutbox:
+    """Очередь исходящих сообщений в Telegram поверх DurableQueue.
+
+    Сообщения отправляются по одному: между отправками в один чат не меньше
+    chat_interval, между любыми отправками - global_interval. На 429 задание
+    и чат ждут retry_after из ответа, на сетевые ошибки и 5xx - растущую
+    паузу. Неотправленное остается в базе и уходит после перезапуска.
+    """
+
+    def __init__(self, queue, bot, chat_interval=3.0, global_interval=0.05,
+                 backoff_base=2.0, backoff_max=300.0, max_attempts=50, stats_window=1000):
+        self.queue = queue
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.global_interval = global_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_attempts = max_attempts
+        # chat_id -> время, раньше которого в чат не пишем
+        self._chat_ready = {}
+        self._global_ready = 0.0
+        self._wakeup = None
+        self.latencies = deque(maxlen=stats_window)
+        self.counters = {"enqueued": 0, "delivered": 0, "throttled": 0, "retries": 0, "failed": 0}
+
+    def enqueue(self, chat_id, text, parse_mode="Markdown"):
+        """Поставить сообщение в очередь (сразу записывается на диск)"""
+        job_id = self.queue.put({"chat_id": chat_id, "text": text, "parse_mode": parse_mode})
+        self.counters["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def run(self):
+        """Цикл отправки; работает до отмены задачи"""
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self._send_ready()
+            except Exception as e:
+                logger.error(f"Ошибка очереди Telegram: {e}")
+                delay = self.backoff_base
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send_ready(self):
+        """Отправить все, что можно отправить сейчас; вернуть паузу до следующей попытки"""
+        now = time.time()
+        wait = None
+        delivered = False
+        for job_id, payload, attempts, created in self.queue.due(now):
+            ready_at = max(self._chat_ready.get(payload["chat_id"], 0.0), self._global_ready)
+            if ready_at > time.time():
+                # Чат или бот еще на паузе - ждем, остальные чаты не блокируем
+                wait = ready_at - time.time() if wait is None else min(wait, ready_at - time.time())
+                continue
+            await self._deliver(job_id, payload, attempts, created)
+            delivered = True
+
+        if delivered:
+            return 0
+        next_time = self.queue.next_available(after=now)
+        if next_time is not None:
+            wait = next_time - now if wait is None else min(wait, next_time - now)
+        return wait
+
+    async def _deliver(self, job_id, payload, attempts, created):
+        chat_id = payload["chat_id"]
+        self._global_ready = time.time() + self.global_interval
+        self._chat_ready[chat_id] = time.time() + self.chat_interval
+        try:
+            status, data = await self.bot.post_message(chat_id, payload["text"], payload.get("parse_mode"))
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning(f"Telegram недоступен: {e}")
+            self._retry(job_id, attempts, self._backoff(attempts))
+            return
+
+        if status == 200:
+            self.queue.ack(job_id)
+            self.counters["delivered"] += 1
+            self.latencies.append(time.time() - created)
+            return
+
+        description = (data or {}).get("description", "")
+        if status == 429:
+            # Telegram сам говорит, сколько ждать
+            retry_after = ((data or {}).get("parameters") or {}).get("retry_after") or self.backoff_base
+            self.counters["throttled"] += 1
+            self._chat_ready[chat_id] = time.time() + retry_after
+            logger.warning(f"Telegram 429: повтор через {retry_after} с")
+            self._retry(job_id, attempts, retry_after)
+        elif status == 400 and payload.get("parse_mode") and "parse" in description.lower():
+            # Разметка сломана символами из ответа клиента - отправляем простым текстом
+            logger.warning(f"Telegram не разобрал разметку, отправляем без нее: {description}")
+            self.queue.ack(job_id)
+            self.queue.put({**payload, "parse_mode": None})
+        elif status >= 500:
+            logger.error(f"Telegram API error: {status} — {description}")
+            self._retry(job_id, attempts, self._backoff(attempts))
+        else:
+            # Неверный чат, нет прав и т.п. - повтор не поможет
+            self.queue.ack(job_id)
+            self.counters["failed"] += 1
+            logger.error(f"Telegram отклонил сообщение: {status} — {description}\n{payload['text']}")
+
+    def _backoff(self, attempts):
+        return min(self.backoff_max, self.backoff_base * 2 ** attempts)
+
+    def _retry(self, job_id, attempts, delay):
+        if attempts + 1 >= self.max_attempts:
+            self.queue.ack(job_id)
+            self.counters["failed"] += 1
+            logger.error(f"Сообщение в Telegram не отправлено после {attempts + 1} попыток")
+            return
+        self.counters["retries"] += 1
+        self.queue.retry(job_id, time.time() + delay)
+
+    def stats(self):
+        """Глубина очереди, счетчики и задержка доставки (от постановки до отправки)"""
+        values = sorted(self.latencies)
+        return {
+            **self.counters,
+            "depth": len(self.queue),
+            "latency_p50": percentile(values, 0.5),
+            "latency_p95": percentile(values, 0.95),
+        }
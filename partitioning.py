@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def partition_of(key, partitions):
+    """Номер раздела чата: одинаковый во всех процессах (hash() в Python зависит от запуска)"""
+    return zlib.crc32(str(key).encode("utf-8")) % partitions
+
+
+def default_worker_id():
+    """Имя процесса: хост и рабочий каталог - не меняется при перезапуске"""
+    return f"{socket.gethostname()}:{os.getcwd()}"
+
+
+class PartitionLeases:
+    """Аренда разделов чатов в общей базе SQLite.
+
+    Чаты делятся на partitions разделов по хешу id. Каждый процесс
+    арендует примерно равную долю разделов на ttl секунд и продлевает
+    аренду каждые ttl/3; ходы и follow-up выполняются только по чатам
+    своих разделов. Если процесс упал, его аренда истекает и разделы
+    забирают остальные; при появлении нового процесса лишние разделы
+    освобождаются. Свою аренду процесс считает действующей на
+    clock_margin секунд меньше, чем видят другие, - запас на расхождение
+    часов между хостами.
+    """
+
+    def __init__(self, path, worker_id=None, partitions=64, ttl=30.0, clock_margin=5.0):
+        self.path = path
+        self.worker_id = worker_id or default_worker_id()
+        self.partitions = partitions
+        self.ttl = ttl
+        self.clock_margin = clock_margin
+        # Без WAL: журнал отката работает и на общем (сетевом) хранилище
+        self.conn = sqlite3.connect(path, timeout=ttl / 3, check_same_thread=False, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " partition INTEGER PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " worker_id TEXT PRIMARY KEY,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        # Раздел -> момент (time.monotonic), до которого аренда точно наша
+        self.owned = {}
+        self.stats = {"renewals": 0, "errors": 0, "acquired": 0, "released": 0, "workers": 0}
+
+    def owns_partition(self, partition):
+        deadline = self.owned.get(partition)
+        return deadline is not None and time.monotonic() < deadline
+
+    def partition(self, key):
+        return partition_of(key, self.partitions)
+
+    def owns(self, key):
+        """Принадлежит ли чат разделу, арендованному этим процессом"""
+        return self.owns_partition(partition_of(key, self.partitions))
+
+    def owned_count(self):
+        now = time.monotonic()
+        return sum(1 for deadline in self.owned.values() if now < deadline)
+
+    def renew(self):
+        """Продлить аренду и перераспределить разделы; возвращает (полученные, отданные).
+
+        Выполняется одной транзакцией, поэтому два процесса не могут
+        одновременно взять один и тот же свободный раздел.
+        """
+        started = time.monotonic()
+        with self._lock:
+            now = time.time()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO workers (worker_id, expires_at) VALUES (?, ?)",
+                    (self.worker_id, now + self.ttl)
+                )
+                self.conn.execute("DELETE FROM workers WHERE expires_at <= ?", (now,))
+                workers = self.conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+                share = math.ceil(self.partitions / workers)
+
+                busy = set()
+                mine = []
+                for partition, owner, expires_at in self.conn.execute(
+                    "SELECT partition, owner, expires_at FROM leases WHERE expires_at > ? ORDER BY partition", (now,)
+                ):
+                    if owner == self.worker_id:
+                        mine.append(partition)
+                    else:
+                        busy.add(partition)
+
+                # Лишние разделы отдаем, недостающие берем из свободных и просроченных
+                released = mine[share:]
+                kept = mine[:share]
+                free = [p for p in range(self.partitions) if p not in busy and p not in mine]
+                acquired = free[:max(share - len(kept), 0)]
+
+                self.conn.executemany(
+                    "DELETE FROM leases WHERE partition = ? AND owner = ?",
+                    [(partition, self.worker_id) for partition in released]
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO leases (partition, owner, expires_at) VALUES (?, ?, ?)",
+                    [(partition, self.worker_id, now + self.ttl) for partition in kept + acquired]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        # Отсчет от начала продления: время ожидания блокировки базы не в нашу пользу
+        deadline = started + self.ttl - self.clock_margin
+        previous = {p for p in self.owned if self.owns_partition(p)}
+        self.owned = {partition: deadline for partition in kept + acquired}
+        gained = set(self.owned) - previous
+        lost = previous - set(self.owned)
+        self.stats["renewals"] += 1
+        self.stats["acquired"] += len(gained)
+        self.stats["released"] += len(lost)
+        self.stats["workers"] = workers
+        return gained, lost
+
+    def release(self):
+        """Освободить все разделы (при остановке), чтобы их сразу забрали другие"""
+        self.owned = {}
+        with self._lock:
+            self.conn.execute("DELETE FROM leases WHERE owner = ?", (self.worker_id,))
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    def close(self):
+        self.conn.close()
+
+    async def run(self, on_change=None):
+        """Продление аренды каждые ttl/3 (запрос к базе - в пуле потоков).
+
+        await on_change(полученные, отданные) - когда набор разделов
+        процесса изменился.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                gained, lost = await loop.run_in_executor(None, self.renew)
+                if (gained or lost) and on_change:
+                    await on_change(gained, lost)
+                if gained or lost:
+                    logger.info(f"Разделы процесса {self.worker_id}: получено {len(gained)}, отдано {len(lost)}, "
+                                f"всего {len(self.owned)}/{self.partitions}, процессов {self.stats['workers']}")
+            except Exception as e:
+                # Аренда истечет сама, если продлить не удается
+                self.stats["errors"] += 1
+                logger.error(f"Ошибка продления аренды разделов: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+
+class SharedChatState:
+    """Состояние чатов, которое должно переходить вместе с разделом.
+
+    Завершенность диалога и follow-up хранятся в той же общей базе, что
+    и аренда: новый владелец раздела не отвечает в уже завершенном
+    диалоге и продолжает follow-up с того этапа, где остановился прежний.
+    Запросы выполняются через submit() в отдельном потоке по порядку
+    вызовов: пока продление аренды держит блокировку общей базы, ждет
+    только этот поток, а не event loop.
+    """
+
+    def __init__(self, leases):
+        self.leases = leases
+        self.conn = leases.conn
+        self._lock = leases._lock
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-chat-state")
+        with self._lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_state ("
+                " account TEXT NOT NULL,"
+                " chat_id TEXT NOT NULL,"
+                " partition INTEGER NOT NULL,"
+                " completed INTEGER NOT NULL DEFAULT 0,"
+                " followup TEXT,"
+                " PRIMARY KEY (account, chat_id))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS chat_state_partition ON chat_state (account, partition)")
+
+    def submit(self, method, *args):
+        """Выполнить метод в потоке общей базы; возвращает asyncio.Future"""
+        return asyncio.wrap_future(self._executor.submit(method, *args))
+
+    def close(self):
+        """Дождаться записи поставленных запросов"""
+        self._executor.shutdown(wait=True)
+
+    def _upsert(self, account, chat_id, column, value):
+        partition = self.leases.partition(f"{account}:{chat_id}")
+        with self._lock:
+            self.conn.execute(
+                f"INSERT INTO chat_state (account, chat_id, partition, {column}) VALUES (?, ?, ?, ?)"
+                f" ON CONFLICT (account, chat_id) DO UPDATE SET {column} = excluded.{column}",
+                (account, chat_id, partition, value)
+            )
+
+    def import_local(self, account, completed, followups):
+        """Перенести в общую базу локальное состояние (при запуске с разделением).
+
+        Завершенные диалоги добавляются всегда; follow-up - только для чатов,
+        которых в общей базе еще нет, чтобы устаревшее локальное состояние
+        не перезаписало то, что уже сохранил другой процесс.
+        """
+        partition = lambda chat_id: self.leases.partition(f"{account}:{chat_id}")
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT INTO chat_state (account, chat_id, partition, completed) VALUES (?, ?, ?, 1)"
+                    " ON CONFLICT (account, chat_id) DO UPDATE SET completed = 1",
+                    [(account, chat_id, partition(chat_id)) for chat_id in completed]
+                )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO chat_state (account, chat_id, partition, followup) VALUES (?, ?, ?, ?)",
+                    [(account, chat_id, partition(chat_id), json.dumps(state)) for chat_id, state in followups.items()]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def mark_completed(self, account, chat_id):
+        self._upsert(account, chat_id, "completed", 1)
+
+    def is_completed(self, account, chat_id):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT completed FROM chat_state WHERE account = ? AND chat_id = ?", (account, chat_id)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def save_followup(self, account, chat_id, state):
+        """Записать (или удалить при state=None) follow-up чата"""
+        self._upsert(account, chat_id, "followup", None if state is None else json.dumps(state))
+
+    def followups(self, account, partitions):
+        """Follow-up чатов аккаунта в разделах partitions: chat_id -> состояние"""
+        partitions = list(partitions)
+        if not partitions:
+            return {}
+        placeholders = ",".join("?" * len(partitions))
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT chat_id, followup FROM chat_state WHERE account = ? AND followup IS NOT NULL"
+                f" AND partition IN ({placeholders})",
+                (account, *partitions)
+            ).fetchall()
+        return {chat_id: json.loads(followup) for chat_id, followup in rows}
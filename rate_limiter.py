@@ -0,0 +1,165 @@
+import asyncio
+import random
+import re
+import time
+from collections import deque
+
+# Длительности из заголовков OpenAI: "1s", "6m0s", "20ms", "1h2m3.5s"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    """Длительность из заголовка в секундах (None, если разобрать не удалось)"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class TokenBucket:
+    """Корзина токенов с равномерным пополнением за минуту"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Сколько ждать, пока в корзине наберется amount"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def sync(self, limit=None, remaining=None, reset_seconds=None):
+        """Подстроиться под остаток, о котором сообщил сервер"""
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+            # Лимит исчерпан: до его сброса на сервере новых запросов не будет
+            if remaining <= 0 and reset_seconds:
+                self.tokens = min(self.tokens, -reset_seconds * self.capacity / 60.0)
+
+
+class OpenAIRateLimiter:
+    """Клиентский лимитер OpenAI: запросы в минуту, токены в минуту и повторы"""
+
+    def __init__(self, rpm, tpm, max_retries=4, backoff_base=1.0, backoff_max=30.0, stats_window=1000):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = None
+        self.waiting = 0
+        self.latencies = deque(maxlen=stats_window)
+        self.counters = {"requests": 0, "throttled": 0, "retries": 0, "timeouts": 0, "errors": 0, "queued_seconds": 0.0,
+                         "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    @staticmethod
+    def estimate_tokens(messages, completion_tokens=300):
+        """Грубая оценка токенов запроса: ~3 символа кириллицы на токен"""
+        return sum(len(message.get("content") or "") for message in messages) // 3 + completion_tokens
+
+    async def acquire(self, estimated_tokens):
+        """Дождаться места в обоих лимитах (запросы обслуживаются по очереди)"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    delay = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(estimated_tokens)
+        finally:
+            self.waiting -= 1
+        self.counters["requests"] += 1
+        self.counters["queued_seconds"] += time.monotonic() - started
+
+    def update_from_headers(self, headers):
+        """Учесть заголовки x-ratelimit-* из ответа"""
+        def number(name):
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        self.requests.sync(
+            number("x-ratelimit-limit-requests"),
+            number("x-ratelimit-remaining-requests"),
+            parse_duration(headers.get("x-ratelimit-reset-requests"))
+        )
+        self.tokens.sync(
+            number("x-ratelimit-limit-tokens"),
+            number("x-ratelimit-remaining-tokens"),
+            parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        )
+
+    def retry_delay(self, attempt, headers=None):
+        """Пауза перед повтором: Retry-After, иначе экспоненциальная с джиттером"""
+        headers = headers or {}
+        delay = parse_duration(headers.get("retry-after-ms"))
+        if delay is not None:
+            delay /= 1000.0
+        else:
+            delay = parse_duration(headers.get("retry-after"))
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if delay is None:
+            return random.uniform(self.backoff_base, max(backoff, self.backoff_base))
+        # Небольшой джиттер, чтобы ожидающие запросы не вернулись одновременно
+        return delay + random.uniform(0, min(backoff, max(delay * 0.25, 0.1)))
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def record_usage(self, usage):
+        """Учесть usage из ответа, включая токены, взятые из кэша промптов"""
+        if not usage:
+            return
+        self.counters["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        self.counters["completion_tokens"] += usage.get("completion_tokens") or 0
+        details = usage.get("prompt_tokens_details") or {}
+        self.counters["cached_tokens"] += details.get("cached_tokens") or 0
+
+    def stats(self):
+        """Перцентили задержек и счетчики ограничений"""
+        values = sorted(self.latencies)
+        return {
+            **self.counters,
+            "waiting": self.waiting,
+            "cache_hit_ratio": self.counters["cached_tokens"] / self.counters["prompt_tokens"] if self.counters["prompt_tokens"] else 0.0,
+            "latency_p50": percentile(values, 0.5),
+            "latency_p95": percentile(values, 0.95),
+            "latency_p99": percentile(values, 0.99),
+        }
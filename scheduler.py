@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+
+class ChatScheduler:
+    """Ограничение параллельных запросов по апстримам и блокировка чатов"""
+
+    def __init__(self, limits, default_limit=10, stats_window=1000, account_limit=None):
+        # Лимиты одновременных запросов (апстрим -> число)
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        # Лимит одновременных ходов одного аккаунта (None - без ограничения)
+        self.account_limit = account_limit
+        self._semaphores = {}
+        # chat_id -> [lock, число ожидающих и выполняющихся ходов]
+        self._chat_locks = {}
+        # Статистика очередей и ожидания
+        self.waiting = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.wait_times = defaultdict(lambda: deque(maxlen=stats_window))
+
+    def _semaphore(self, upstream):
+        semaphore = self._semaphores.get(upstream)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limits.get(upstream, self.default_limit))
+            self._semaphores[upstream] = semaphore
+        return semaphore
+
+    @asynccontextmanager
+    async def upstream(self, name):
+        """Слот для запроса к апстриму (avito, openai, telegram)"""
+        semaphore = self._semaphore(name)
+        started = time.monotonic()
+        self.waiting[name] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[name] -= 1
+        self.wait_times[name].append(time.monotonic() - started)
+        self.in_flight[name] += 1
+        try:
+            yield
+        finally:
+            self.in_flight[name] -= 1
+            semaphore.release()
+
+    @asynccontextmanager
+    async def account(self, name):
+        """Слот хода аккаунта: у каждого аккаунта свой лимит, поэтому сотня
+        изменившихся чатов одного аккаунта не выстраивается в общих очередях
+        перед чатами остальных"""
+        if self.account_limit is None:
+            yield
+            return
+        key = f"account:{name}"
+        self.limits.setdefault(key, self.account_limit)
+        async with self.upstream(key):
+            yield
+
+    @asynccontextmanager
+    async def chat(self, chat_id):
+        """Эксклюзивный ход по чату: второй ход ждет завершения первого"""
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self._chat_locks[chat_id] = entry
+        entry[1] += 1
+        started = time.monotonic()
+        self.waiting["chat"] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release_chat_entry(chat_id, entry)
+            raise
+        finally:
+            self.waiting["chat"] -= 1
+        self.wait_times["chat"].append(time.monotonic() - started)
+        self.in_flight["chat"] += 1
+        try:
+            yield
+        finally:
+            self.in_flight["chat"] -= 1
+            entry[0].release()
+            self._release_chat_entry(chat_id, entry)
+
+    def _release_chat_entry(self, chat_id, entry):
+        # Удаляем блокировку, когда по чату больше нет ходов
+        entry[1] -= 1
+        if entry[1] == 0 and self._chat_locks.get(chat_id) is entry:
+            del self._chat_locks[chat_id]
+
+    def stats(self):
+        """Глубина очередей и время ожидания по каждому апстриму"""
+        result = {}
+        for name in set(self.wait_times) | set(self.waiting) | set(self.in_flight):
+            waits = sorted(self.wait_times.get(name, ()))
+            result[name] = {
+                "limit": self.limits.get(name, self.default_limit) if name != "chat" else None,
+                "in_flight": self.in_flight.get(name, 0),
+                "waiting": self.waiting.get(name, 0),
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(len(waits) * 0.95) - 1] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0
+            }
+        return result
@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping, MutableSet
+
+
+class StateStore:
+    """Хранилище состояния бота в SQLite (WAL) с пакетной записью"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        # Изменения, ожидающие записи: (namespace, key) -> json или None (удаление)
+        self._pending = {}
+        # Отслеживаемые коллекции, у которых значения могли измениться на месте
+        self._collections = []
+        self._lock = threading.Lock()
+
+    def load(self, namespace):
+        """Все записи пространства имен (key -> value)"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM state WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, namespace, key, value):
+        with self._lock:
+            self._pending[(namespace, key)] = json.dumps(value, ensure_ascii=False)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._pending[(namespace, key)] = None
+
+    def track(self, collection):
+        self._collections.append(collection)
+
+    def sync(self):
+        """Собрать изменения коллекций (вызывать из потока event loop)"""
+        for collection in self._collections:
+            collection.sync()
+
+    def flush(self):
+        """Собрать и записать все изменения"""
+        self.sync()
+        return self.write_pending()
+
+    def write_pending(self):
+        """Записать накопленные изменения одной транзакцией (можно из другого потока)"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            upserts = [(ns, key, value) for (ns, key), value in pending.items() if value is not None]
+            deletes = [(ns, key) for (ns, key), value in pending.items() if value is None]
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                    upserts
+                )
+                self.conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # Возвращаем изменения, чтобы записать их при следующей попытке
+                for item, value in pending.items():
+                    self._pending.setdefault(item, value)
+                raise
+            return len(pending)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class PersistentDict(MutableMapping):
+    """Словарь с кэшем в памяти и отложенной записью в StateStore"""
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+        self._data = store.load(namespace)
+        # Ключи, чьи изменяемые значения (dict/list) выдавались наружу
+        self._touched = set()
+        store.track(self)
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, (dict, list)):
+            self._touched.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._touched.discard(key)
+        self.store.put(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._touched.discard(key)
+        self.store.delete(self.namespace, key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._data else default
+
+    def sync(self):
+        """Поставить в очередь записи значения, которые могли измениться на месте"""
+        touched, self._touched = self._touched, set()
+        for key in touched:
+            if key in self._data:
+                self.store.put(self.namespace, key, self._data[key])
+
+
+class PersistentSet(MutableSet):
+    """Множество с кэшем в памяти и отложенной записью в StateStore"""
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+        self._data = set(store.load(namespace))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def add(self, key):
+        if key not in self._data:
+            self._data.add(key)
+            self.store.put(self.namespace, key, True)
+
+    def discard(self, key):
+        if key in self._data:
+            self._data.discard(key)
+            self.store.delete(self.namespace, key)
+
+
+class DurableQueue:
+    """Очередь заданий в той же базе SQLite: запись сразу, без пакетирования.
+
+    Задание удаляется только после ack, поэтому все, что не успели
+    обработать до остановки, достается из базы при следующем запуске.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        with store._lock:
+            store.conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " name TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " available_at REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            store.conn.execute("CREATE INDEX IF NOT EXISTS queue_due ON queue (name, available_at)")
+
+    def put(self, payload, available_at=None):
+        """Добавить задание; возвращает его id"""
+        now = time.time()
+        with self.store._lock:
+            cursor = self.store.conn.execute(
+                "INSERT INTO queue (name, payload, created, available_at) VALUES (?, ?, ?, ?)",
+                (self.name, json.dumps(payload, ensure_ascii=False), now, available_at or now)
+            )
+        return cursor.lastrowid
+
+    def due(self, now=None, limit=100):
+        """Готовые задания [(id, payload, attempts, created)] в порядке добавления"""
+        with self.store._lock:
+            rows = self.store.conn.execute(
+                "SELECT id, payload, attempts, created FROM queue"
+                " WHERE name = ? AND available_at <= ? ORDER BY id LIMIT ?",
+                (self.name, time.time() if now is None else now, limit)
+            ).fetchall()
+        return [(job_id, json.loads(payload), attempts, created) for job_id, payload, attempts, created in rows]
+
+    def next_available(self, after=0):
+        """Время, когда станет готово ближайшее отложенное (позже after) задание, или None"""
+        with self.store._lock:
+            row = self.store.conn.execute(
+                "SELECT MIN(available_at) FROM queue WHERE name = ? AND available_at > ?", (self.name, after)
+            ).fetchone()
+        return row[0]
+
+    def ack(self, job_id):
+        with self.store._lock:
+            self.store.conn.execute("DELETE FROM queue WHERE id = ?", (job_id,))
+
+    def retry(self, job_id, available_at):
+        """Отложить задание до available_at, увеличив счетчик попыток"""
+        with self.store._lock:
+            self.store.conn.execute(
+                "UPDATE queue SET available_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (available_at, job_id)
+            )
+
+    def __len__(self):
+        with self.store._lock:
+            return self.store.conn.execute(
+                "SELECT COUNT(*) FROM queue WHERE name = ?", (self.name,)
+            ).fetchone()[0]
@@ -0,0 +1,73 @@
+import json
+import re
+
+# Абзацы в ответе модели разделены пустой строкой
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+
+
+def parse_sse_line(line):
+    """Разбор строки SSE-потока OpenAI: возвращает (текст, usage, конец_потока)"""
+    line = line.strip()
+    if not line.startswith("data:"):
+        return "", None, False
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return "", None, True
+    try:
+        chunk = json.loads(data)
+    except json.JSONDecodeError:
+        return "", None, False
+    text = ""
+    for choice in chunk.get("choices") or ():
+        text += (choice.get("delta") or {}).get("content") or ""
+    return text, chunk.get("usage"), False
+
+
+class ParagraphStream:
+    """Собирает поток токенов в готовые абзацы и вырезает маркер завершения.
+
+    Абзац отдается только после того, как за ним пришла пустая строка,
+    поэтому маркер, разорванный между чанками, всегда оказывается целиком
+    внутри одного абзаца и вырезается до отправки клиенту.
+    """
+
+    def __init__(self, marker):
+        self.marker = marker
+        self.buffer = ""
+        self.parts = []
+        self.completed = False
+
+    def _clean(self, paragraph):
+        if self.marker in paragraph:
+            self.completed = True
+            paragraph = paragraph.replace(self.marker, "")
+        return paragraph.strip()
+
+    def feed(self, text):
+        """Добавить фрагмент ответа; возвращает список завершенных абзацев"""
+        self.buffer += text
+        ready = []
+        while True:
+            match = PARAGRAPH_BREAK.search(self.buffer)
+            if not match:
+                break
+            paragraph = self._clean(self.buffer[:match.start()])
+            self.buffer = self.buffer[match.end():]
+            if paragraph:
+                self.parts.append(paragraph)
+                ready.append(paragraph)
+        return ready
+
+    def finish(self):
+        """Остаток буфера после конца потока"""
+        paragraph = self._clean(self.buffer)
+        self.buffer = ""
+        if paragraph:
+            self.parts.append(paragraph)
+            return [paragraph]
+        return []
+
+    @property
+    def text(self):
+        """Ответ без маркера в том виде, в каком его увидел клиент"""
+        return "\n\n".join(self.parts)
@@ -5,21 +5,44 @@
 """
 
 import asyncio
+import aiohttp
 import json
 from datetime import datetime, timezone, timedelta
 import sys
 import os
+import timeit
+import logging
 
 # Импорты из проекта
 from config import (
     AVITO_USER_ID, AVITO_CLIENT_ID, AVITO_CLIENT_SECRET,
     TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID,
     FOLLOWUP_MESSAGES, FOLLOWUP_INTERVALS,
-    WORK_HOUR_START, WORK_HOUR_END
+    WORK_HOUR_START, WORK_HOUR_END,
+    FAQ_INTENTS, GREETING_WORDS, GREETING_PHRASE, START_QUESTION, STAGE_QUESTIONS, FAST_REPLY_FILLER_WORDS
 )
 from avito import AvitoClient
-from chat_gpt import get_agent_response, extract_final_client_data, check_dialog_completion
+from chat_gpt import get_agent_response, stream_agent_response, extract_final_client_data, check_dialog_completion, chatgpt_handler, get_extraction_stats, parse_dialog_history
+from local_extraction import extract_local, missing_fields
+from fast_replies import FastReplyMatcher
+from tracing import TurnTrace, TraceWriter, current_trace, span, annotate, record_turn_usage
+from logging_setup import setup_logging, shutdown_logging, sampled
+from metrics import MetricsServer, registry, track, upstream_latency, upstream_errors
 from telegram import send_completed_application
+from http_pool import close_all_sessions, get_session
+from webhook import WebhookServer
+from dialog_features import extract_dialog_features
+from context_window import ContextWindow, TokenCounter
+from geocoding import ReverseGeocoder
+from storage import StateStore, DurableQueue
+from accounts import create_accounts
+from scheduler import ChatScheduler
+from partitioning import PartitionLeases, SharedChatState, partition_of
+from outbox import TelegramOutbox
+from workers import QueueWorkerPool
+from telegram import TelegramBot
+import tempfile
+from aiohttp import web
 
 
 class TestAvitoBot:
@@ -268,6 +291,732 @@ class TestAvitoBot:
         except Exception as e:
             print(f"❌ Ошибка при отправке в Telegram: {e}")
     
+    async def test_webhook_mode(self):
+        """Тест webhook-режима на локальном сервере с фейковым отправителем событий"""
+        print("\n🪝 Тестирование приема webhook-событий...")
+        
+        received = []
+        
+        async def handler(chat_id, message):
+            received.append((chat_id, message.get("content", {}).get("text")))
+        
+        server = WebhookServer(handler, host="127.0.0.1", port=18080, path="/avito/webhook", secret="test")
+        await server.start()
+        
+        # Событие в формате мессенджера Avito v3
+        event = {
+            "id": "evt-1",
+            "version": "v3.0.0",
+            "timestamp": int(datetime.now().timestamp()),
+            "payload": {
+                "type": "message",
+                "value": {
+                    "id": "msg-1",
+                    "chat_id": "test-chat",
+                    "user_id": AVITO_USER_ID,
+                    "author_id": 42,
+                    "created": int(datetime.now().timestamp()),
+                    "type": "text",
+                    "chat_type": "u2i",
+                    "content": {"text": "Здравствуйте! Квартира свободна?"}
+                }
+            }
+        }
+        
+        try:
+            session = get_session("webhook-test")
+            url = "http://127.0.0.1:18080/avito/webhook"
+            async with session.post(url, params={"token": "test"}, json=event) as res:
+                print(f"📨 Ответ сервера: {res.status}")
+            async with session.post(url, params={"token": "wrong"}, json=event) as res:
+                print(f"🔒 Неверный токен: {res.status}")
+            
+            # Даем фоновой задаче обработать событие
+            await asyncio.sleep(0.1)
+            
+            if received == [("test-chat", "Здравствуйте! Квартира свободна?")]:
+                print("✅ Событие доставлено в обработчик")
+            else:
+                print(f"❌ Неожиданный результат: {received}")
+            print(f"📊 Статистика сервера: {server.stats}")
+        finally:
+            await server.stop()
+    
+    async def test_streaming_reply(self):
+        """Тест потокового ответа на локальном SSE-сервере вместо OpenAI"""
+        print("\n🌊 Тестирование потоковой отправки по абзацам...")
+        
+        # Маркер и граница абзаца специально разорваны между чанками
+        chunks = ["Здравствуйте! Меня зовут Светлана", ".\n", "\nРасскажите, пожалуйста, ",
+                  "кто проживать планирует?", "\n\nСпасибо! [COMP", "LETE]"]
+        
+        requests = []
+        
+        async def completions(request):
+            requests.append(request.path)
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for chunk in chunks:
+                delta = {"choices": [{"index": 0, "delta": {"content": chunk}}]}
+                await response.write(f"data: {json.dumps(delta, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(0.05)
+            usage = {"choices": [], "usage": {"prompt_tokens": 2048, "completion_tokens": 40,
+                                              "prompt_tokens_details": {"cached_tokens": 1792}}}
+            await response.write(f"data: {json.dumps(usage)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 18081).start()
+        
+        original_url = chatgpt_handler.base_url
+        chatgpt_handler.base_url = "http://127.0.0.1:18081/v1/chat/completions"
+        sent = []
+        started = asyncio.get_running_loop().time()
+        
+        async def on_paragraph(paragraph):
+            sent.append((round(asyncio.get_running_loop().time() - started, 2), paragraph))
+        
+        try:
+            turns = [{"role": "user", "content": "Здравствуйте"}]
+            stream = await stream_agent_response(turns, on_paragraph)
+            for elapsed, paragraph in sent:
+                print(f"  +{elapsed:.2f} с: {paragraph}")
+            if stream and stream.completed and len(sent) == 3 and "[COMPLETE]" not in stream.text:
+                print("✅ Абзацы отправлены по мере готовности, маркер вырезан")
+            else:
+                print(f"❌ Неожиданный результат: {sent}")
+            print(f"📊 Кэш промпта: {chatgpt_handler.limiter.stats()['cache_hit_ratio']:.0%}")
+            
+            # Ошибка сети при отправке последнего абзаца не должна повторять запрос к OpenAI
+            requests.clear()
+            delivered = []
+            
+            async def failing_paragraph(paragraph):
+                if len(delivered) == 2:
+                    raise aiohttp.ClientError("Avito недоступен")
+                delivered.append(paragraph)
+            
+            stream = await stream_agent_response(turns, failing_paragraph)
+            if stream is not None and len(requests) == 1 and len(delivered) == 2:
+                print("✅ Ошибка отправки абзаца не приводит к повторной генерации")
+            else:
+                print(f"❌ Запросов к OpenAI: {len(requests)}, доставлено абзацев: {len(delivered)}")
+        finally:
+            chatgpt_handler.base_url = original_url
+            await runner.cleanup()
+    
+    async def test_context_window(self):
+        """Тест бюджета токенов: старые реплики сворачиваются, содержание переиспользуется"""
+        print("\n📏 Тестирование окна контекста по бюджету токенов...")
+        
+        summaries = []
+        
+        async def summarize(previous_summary, turns):
+            summaries.append(len(turns))
+            return f"{previous_summary or ''} +{len(turns)} реплик".strip()
+        
+        window = ContextWindow(TokenCounter("gpt-4o-mini"), 300, summarize, {})
+        lines = []
+        for i in range(60):
+            role = "user" if i % 2 == 0 else "assistant"
+            lines.append((i, 1700000000 + i, role, f"Сообщение номер {i}, " + "текст " * 10))
+            summary, turns = await window.build("test-chat", lines)
+        
+        tokens = sum(window.counter.count(turn["content"]) for turn in turns)
+        print(f"  Реплик в запросе: {len(turns)}, токенов истории: ~{tokens}")
+        print(f"  Сверток за 60 ходов: {len(summaries)}, содержание: {summary}")
+        if tokens <= 300 and 0 < len(summaries) < 30:
+            print("✅ История укладывается в бюджет, содержание пересчитывается редко")
+        else:
+            print("❌ Неожиданный результат")
+    
+    async def test_geocoding_cache(self):
+        """Тест кэша адресов на локальном сервере вместо Nominatim"""
+        print("\n📍 Тестирование кэша адресов объявлений...")
+        
+        requests_seen = []
+        
+        async def reverse(request):
+            requests_seen.append(asyncio.get_running_loop().time())
+            await asyncio.sleep(0.05)
+            return web.json_response({"address": {"road": "Невский проспект", "house_number": "1", "city": "Санкт-Петербург"}})
+        
+        app = web.Application()
+        app.router.add_get("/reverse", reverse)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 18082).start()
+        
+        geocoder = ReverseGeocoder(min_interval=0.2)
+        geocoder.url = "http://127.0.0.1:18082/reverse"
+        try:
+            # Три одновременные заявки по одному объявлению и одна по соседнему
+            addresses = await asyncio.gather(
+                geocoder.address(59.93428, 30.33510),
+                geocoder.address(59.934281, 30.335101),
+                geocoder.address(59.93428, 30.33510),
+                geocoder.address(55.75580, 37.61730)
+            )
+            # Повторная заявка берется из кэша
+            addresses.append(await geocoder.address(59.93428, 30.33510))
+            gaps = [round(b - a, 2) for a, b in zip(requests_seen, requests_seen[1:])]
+            print(f"  Адрес: {addresses[0]}")
+            print(f"  Запросов к серверу: {len(requests_seen)}, интервалы: {gaps}")
+            print(f"📊 Статистика: {geocoder.stats}")
+            if len(requests_seen) == 2 and all(gap >= 0.2 for gap in gaps) and len(set(addresses)) == 1:
+                print("✅ Одинаковые координаты ищутся один раз, запросы разнесены по времени")
+            else:
+                print("❌ Неожиданный результат")
+        finally:
+            await runner.cleanup()
+    
+    async def test_telegram_outbox(self):
+        """Тест очереди Telegram: 429 с retry_after, интервалы и повтор после перезапуска"""
+        print("\n📬 Тестирование очереди заявок в Telegram...")
+        
+        sent = []
+        calls = {"count": 0}
+        
+        async def send_message(request):
+            calls["count"] += 1
+            payload = await request.json()
+            # Первый запрос получает 429, как при всплеске заявок
+            if calls["count"] == 1:
+                return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                          "parameters": {"retry_after": 0.3}}, status=429)
+            sent.append((asyncio.get_running_loop().time(), payload["chat_id"], payload["text"]))
+            return web.json_response({"ok": True, "result": {}})
+        
+        app = web.Application()
+        app.router.add_post("/botTEST/sendMessage", send_message)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 18083).start()
+        
+        bot = TelegramBot("TEST")
+        bot.base_url = "http://127.0.0.1:18083/botTEST"
+        db_path = os.path.join(tempfile.mkdtemp(), "outbox.db")
+        try:
+            # Заявки поставлены в очередь, но процесс "упал" до отправки
+            store = StateStore(db_path)
+            outbox = TelegramOutbox(DurableQueue(store, "telegram"), bot, chat_interval=0.2)
+            for i in range(3):
+                outbox.enqueue("owners", f"Заявка {i}")
+            store.close()
+            
+            # После перезапуска очередь поднимается из базы и отправляется
+            store = StateStore(db_path)
+            outbox = TelegramOutbox(DurableQueue(store, "telegram"), bot, chat_interval=0.2)
+            print(f"  В очереди после перезапуска: {len(outbox.queue)}")
+            worker = asyncio.create_task(outbox.run())
+            for _ in range(50):
+                if not len(outbox.queue):
+                    break
+                await asyncio.sleep(0.1)
+            worker.cancel()
+            
+            gaps = [round(b[0] - a[0], 2) for a, b in zip(sent, sent[1:])]
+            print(f"  Отправлено: {[text for _, _, text in sent]}, интервалы: {gaps}")
+            print(f"📊 Статистика: {outbox.stats()}")
+            if [text for _, _, text in sent] == ["Заявка 0", "Заявка 1", "Заявка 2"] and all(g >= 0.2 for g in gaps):
+                print("✅ Заявки доставлены по порядку после 429 и перезапуска")
+            else:
+                print("❌ Неожиданный результат")
+            store.close()
+        finally:
+            await runner.cleanup()
+    
+    async def test_completion_workers(self):
+        """Тест фоновой обработки завершенных диалогов: параллельно и с повтором ошибок"""
+        print("\n⚙️ Тестирование фоновой обработки завершенных диалогов...")
+        
+        attempts = {}
+        done = []
+        
+        async def handler(job):
+            attempts[job["chat_id"]] = attempts.get(job["chat_id"], 0) + 1
+            await asyncio.sleep(0.2)
+            # Первая попытка для chat-1 падает, как при сбое OpenAI
+            if job["chat_id"] == "chat-1" and attempts["chat-1"] == 1:
+                return False
+            done.append(job["chat_id"])
+            return True
+        
+        store = StateStore(os.path.join(tempfile.mkdtemp(), "workers.db"))
+        pool = QueueWorkerPool(DurableQueue(store, "completions"), handler, workers=3, backoff_base=0.1)
+        pool.start()
+        started = asyncio.get_running_loop().time()
+        try:
+            for i in range(3):
+                pool.enqueue({"chat_id": f"chat-{i}", "final_dialog": "..."})
+            enqueued = asyncio.get_running_loop().time() - started
+            for _ in range(50):
+                if not len(pool.queue):
+                    break
+                await asyncio.sleep(0.05)
+            elapsed = asyncio.get_running_loop().time() - started
+            print(f"  Постановка в очередь: {enqueued * 1000:.1f} мс, обработка: {elapsed:.2f} с")
+            print(f"📊 Статистика: {pool.stats()}")
+            if sorted(done) == ["chat-0", "chat-1", "chat-2"] and attempts["chat-1"] == 2:
+                print("✅ Задания выполнены параллельно, ошибка повторена")
+            else:
+                print(f"❌ Неожиданный результат: {done}, попытки {attempts}")
+        finally:
+            pool.stop()
+            store.close()
+    
+    async def test_local_extraction(self):
+        """Тест локального извлечения полей заявки без запроса к модели"""
+        print("\n🧩 Тестирование локального извлечения данных клиента...")
+        
+        full_dialog = "\n".join([
+            "Клиент: Здравствуйте, квартира свободна?",
+            "Светлана: Здравствуйте, на связи Светлана, АН Skyline. Расскажите, пожалуйста, кто проживать планирует",
+            "Клиент: Парень 27 лет и девушка 24 года, детей нет, животных нет",
+            "Светлана: Как к Вам можно обращаться?",
+            "Клиент: Дмитрий",
+            "Светлана: На какой срок планируете?",
+            "Клиент: Полгода, заехать хотим с 1 ноября",
+            "Светлана: Оставьте, пожалуйста, номер телефона",
+            "Клиент: 8 (921) 555-12-34",
+        ])
+        partial_dialog = "\n".join([
+            "Клиент: Я с сыном, ему 7 лет, и с котом",
+            "Светлана: На какой срок?",
+            "Клиент: надолго, заезд в конце ноября. +7 911 000-11-22",
+        ])
+        
+        started = timeit.default_timer()
+        client_data = await extract_final_client_data(full_dialog)
+        elapsed = (timeit.default_timer() - started) * 1000
+        print(f"  Полный диалог ({elapsed:.1f} мс): {json.dumps(client_data, ensure_ascii=False)}")
+        
+        partial = extract_local(parse_dialog_history(partial_dialog))
+        print(f"  Частичный диалог: {json.dumps(partial, ensure_ascii=False)}")
+        print(f"  Модель спросим только о: {missing_fields(partial)}")
+        print(f"📊 Статистика: {get_extraction_stats()}")
+        
+        # Неоднозначные поля не заполняются локально - их заполнит модель
+        ambiguous = [
+            ("Я и жена 25 лет", "residents_count", None),
+            ("Заселимся вдвоем: мне 25, девушка 23 года", "residents_count", None),
+            ("Хотим на 1.5 года", "move_in_deadline", None),
+            ("Заедем через 2 месяца, на год", "rental_period", "1 год"),
+            ("На 6 месяцев или на год", "rental_period", None),
+            ("Ищем на 2-3 месяца", "rental_period", None),
+            ("Хотим с 10 по 20 ноября", "move_in_deadline", None),
+            ("Могу платить 5 числа каждого месяца", "move_in_deadline", None),
+            ("Собаку не возьмем, не переживайте", "has_pets", None),
+            # Отрицание животного - это ответ "животных нет"
+            ("Собаки нет", "has_pets", False),
+            ("Без собаки, детей нет", "has_pets", False),
+            ("Парень 27 лет и девушка 24 года, детей нет, собаки нет", "has_pets", False),
+        ]
+        wrong = []
+        for text, field, expected in ambiguous:
+            value = extract_local([{"role": "user", "content": text}]).get(field)
+            if value != expected:
+                wrong.append((text, field, value))
+        print(f"  Неоднозначные фразы: {len(ambiguous) - len(wrong)}/{len(ambiguous)} без ошибочных полей {wrong or ''}")
+        
+        if (client_data and client_data["phone"] == "+79215551234" and get_extraction_stats()["llm_skipped"]
+                and not wrong):
+            print("✅ Заполненная заявка собрана без запроса к модели")
+        else:
+            print("❌ Неожиданный результат")
+    
+    def test_fast_replies(self):
+        """Тест готовых ответов на приветствие и частые вопросы (без GPT)"""
+        print("\n⚡ Тестирование быстрых ответов без GPT...")
+        
+        matcher = FastReplyMatcher(
+            FAQ_INTENTS, GREETING_WORDS, GREETING_PHRASE, START_QUESTION, STAGE_QUESTIONS,
+            filler_words=FAST_REPLY_FILLER_WORDS
+        )
+        cases = [
+            (["Здравствуйте, квартира еще сдается?"], True, "greeting", True),
+            (["Добрый день!"], True, "greeting", True),
+            (["Какая комиссия?", "А коммуналка включена?"], False, "pets", True),
+            (["Нас двое, с собакой"], False, "residents", False),
+            (["Хотим заехать 15 ноября"], False, "deadline", False),
+            (["А торг уместен?"], False, "complete", False),
+            # Ответ на вопрос этапа вместе с вопросом: повторять вопрос нельзя
+            (["Двое. Какая комиссия?"], False, "residents", False),
+            (["Кошка. А комиссия?"], False, "pets", False),
+            (["Дети есть, комиссия какая?"], False, "children", False),
+            (["Нет. Коммуналка сколько?"], False, "pets", False),
+            (["Не актуально"], False, "residents", False),
+        ]
+        correct = 0
+        for texts, is_first, stage, expected in cases:
+            reply = matcher.reply(texts, is_first, stage)
+            correct += (reply is not None) == expected
+            print(f"  {' / '.join(texts)!r} -> {reply.replace(chr(10), ' ')[:80] + '...' if reply else 'в GPT'}")
+        
+        print(f"📊 Без GPT: {matcher.stats['hits']}/{matcher.stats['checked']}, по вопросам: {matcher.intent_hits}")
+        if correct == len(cases):
+            print("✅ Быстрые ответы срабатывают только на однозначные сообщения")
+        else:
+            print(f"❌ Совпало {correct} из {len(cases)}")
+    
+    async def test_metrics_endpoint(self):
+        """Тест страницы /metrics (локально)"""
+        print("\n📈 Тестирование метрик...")
+        
+        # Несколько замеров: два удачных запроса и один с ошибкой
+        for delay in (0.01, 0.02):
+            with track("avito", "get_messages"):
+                await asyncio.sleep(delay)
+        try:
+            with track("avito", "get_messages"):
+                raise ConnectionError("тестовая ошибка")
+        except ConnectionError:
+            pass
+        
+        server = MetricsServer(registry, host="127.0.0.1", port=18084)
+        await server.start()
+        try:
+            async with get_session("test").get("http://127.0.0.1:18084/metrics") as response:
+                text = await response.text()
+        finally:
+            await server.stop()
+        
+        for line in text.splitlines():
+            if 'operation="get_messages"' in line and ("_count" in line or "errors" in line):
+                print(f"  {line}")
+        count = upstream_latency.count(upstream="avito", operation="get_messages")
+        errors = upstream_errors.get(upstream="avito", operation="get_messages")
+        if response.status == 200 and count >= 3 and errors >= 1 and "# TYPE avito_bot_upstream_request_seconds histogram" in text:
+            print("✅ Метрики отдаются в формате Prometheus")
+        else:
+            print("❌ Неожиданный ответ /metrics")
+    
+    async def test_turn_tracing(self):
+        """Тест трассировки хода диалога в JSONL (локально)"""
+        print("\n🧵 Тестирование трассировки ходов...")
+        
+        path = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+        writer = TraceWriter(path, max_bytes=2000, backup_count=2)
+        writer.start()
+        
+        async def turn(chat_id):
+            trace = TurnTrace(chat_id)
+            token = current_trace.set(trace)
+            try:
+                with span("fetch_messages"):
+                    await asyncio.sleep(0.01)
+                annotate(message_id=f"msg-{chat_id}", stage="residents")
+                with span("llm", streaming=True):
+                    await asyncio.sleep(0.03)
+                    record_turn_usage({"prompt_tokens": 900, "completion_tokens": 40,
+                                       "prompt_tokens_details": {"cached_tokens": 768}})
+                    with span("avito_send"):
+                        await asyncio.sleep(0.01)
+                annotate(outcome="answered")
+            finally:
+                current_trace.reset(token)
+            writer.write(trace)
+        
+        # Параллельные ходы не смешивают свои трассировки
+        await asyncio.gather(*(turn(f"chat{i}") for i in range(20)))
+        writer.stop()
+        
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        rotated = [name for name in os.listdir(os.path.dirname(path)) if name != "traces.jsonl"]
+        record = records[-1]
+        print(f"  Записей в текущем файле: {len(records)}, в ротированных: {len(rotated)} файл(а)")
+        print(f"  {record['chat_id']}: {record['duration_ms']} мс, "
+              + ", ".join(f"{s['name']} {s['duration_ms']} мс" for s in record["spans"]))
+        print(f"  Токены хода: {record['usage']}")
+        
+        consistent = all(r["message_id"] == f"msg-{r['chat_id']}" and len(r["spans"]) == 3 for r in records)
+        if consistent and rotated and record["spans"][2]["parent"] == "llm" and record["usage"]["cached_tokens"] == 768:
+            print("✅ Этапы хода записаны с длительностями и ротацией файла")
+        else:
+            print("❌ Неожиданные трассировки")
+    
+    def test_queue_logging(self):
+        """Тест логирования через очередь: уровни модулей и выборочный дамп"""
+        print("\n📝 Тестирование логирования через очередь...")
+        
+        path = os.path.join(tempfile.mkdtemp(), "bot.log")
+        setup_logging("INFO", {"chat_gpt": "DEBUG", "main.dialog": "WARNING"}, fmt="json", log_file=path)
+        dialog_logger = logging.getLogger("main.dialog")
+        
+        started = timeit.default_timer()
+        for i in range(2000):
+            logging.getLogger("chat_gpt").debug("Отладка запроса %d", i, extra={"chat_id": f"chat{i % 10}"})
+            if sampled(dialog_logger, 1.0):
+                dialog_logger.debug("Дамп истории %d", i)
+        elapsed = (timeit.default_timer() - started) * 1000
+        dumps_off = sum(sampled(dialog_logger, 1.0) for _ in range(100))
+        
+        dialog_logger.setLevel("DEBUG")
+        dumps_sampled = sum(sampled(dialog_logger, 0.05) for _ in range(2000))
+        shutdown_logging()
+        
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        print(f"  2000 записей поставлены в очередь за {elapsed:.1f} мс, записано в файл: {len(records)}")
+        print(f"  Пример: {records[-1]}")
+        print(f"  Дамп истории: выключен - {dumps_off}/100, доля 5% - {dumps_sampled}/2000")
+        
+        # Дальше тесты снова пишут логи в консоль
+        setup_logging("INFO", {"aiohttp.access": "WARNING"})
+        if len(records) == 2000 and records[-1]["chat_id"] == "chat9" and dumps_off == 0 and 0 < dumps_sampled < 300:
+            print("✅ Уровни модулей и выборка дампа работают")
+        else:
+            print("❌ Неожиданный результат логирования")
+    
+    def legacy_split_messages(self, messages):
+        agent_messages = []
+        client_messages = []
+        for message in messages:
+            if message.get("type") != "text":
+                continue
+            text = message.get("content", {}).get("text", "").strip().lower()
+            if not text:
+                continue
+            if message.get("direction") == "out":
+                agent_messages.append(text)
+            else:
+                client_messages.append(text)
+        return agent_messages, client_messages
+    
+    def legacy_completion_checks(self, messages):
+        """Прежний is_dialog_complete_check: свой проход по сообщениям"""
+        agent_messages, client_messages = self.legacy_split_messages(messages)
+        client_text = " ".join(client_messages).lower()
+        return {
+            "marker": any("[complete]" in msg for msg in agent_messages),
+            "residents": any(word in client_text for word in ["человек", "буду", "планирую", "один", "два", "три", "пара", "семья"]),
+            "period": any(word in client_text for word in ["месяц", "год"]) or any(char.isdigit() for char in client_text if "месяц" in client_text),
+            "date": any(word in client_text for word in ["август", "сентябр", "октябр", "ноябр", "декабр", "январ", "феврал", "март", "апрел", "май", "июн", "июл"]) or ("число" in client_text and any(char.isdigit() for char in client_text)),
+            "phone": any(len([c for c in msg if c.isdigit()]) >= 10 for msg in client_messages),
+        }
+    
+    def legacy_stage_checks(self, messages):
+        """Прежний determine_dialog_stage: еще один проход по сообщениям"""
+        agent_messages, client_messages = self.legacy_split_messages(messages)
+        client_text = " ".join(client_messages).lower()
+        last_agent_msg = agent_messages[-1] if agent_messages else ""
+        return {
+            "greeting": any("здравствуйте" in msg and "светлана" in msg for msg in agent_messages),
+            "residents_info": any(word in client_text for word in ["человек", "буду", "планирую", "один", "два", "три", "семь", "пара", "семья"]),
+            "period_info": any(word in client_text for word in ["месяц", "год", "надолго", "постоянно"]) or any(char.isdigit() for char in client_text if "месяц" in client_text),
+            "children_topic": "дет" in last_agent_msg or "ребен" in last_agent_msg,
+            "contacts_topic": "телефон" in last_agent_msg or "номер" in last_agent_msg,
+        }
+    
+    def legacy_dialog_checks(self, messages):
+        """Прежний путь process_chat: обе проверки, каждая со своим проходом"""
+        return {**self.legacy_completion_checks(messages), **self.legacy_stage_checks(messages)}
+    
+    def compiled_dialog_checks(self, messages):
+        """Те же признаки через однопроходный извлекатель"""
+        features = extract_dialog_features(messages)
+        return {
+            "greeting": features.has_greeting,
+            "marker": features.has_completion_marker,
+            "residents": features.has_residents,
+            "residents_info": features.has_residents_info,
+            "period": features.has_period,
+            "period_info": features.has_period_info,
+            "date": features.has_date,
+            "phone": features.has_phone,
+            "children_topic": "children" in features.last_agent_topics,
+            "contacts_topic": "contacts" in features.last_agent_topics,
+        }
+    
+    async def test_multi_account(self):
+        """Тест нескольких аккаунтов: раздельное состояние и честная очередь ходов"""
+        print("\n👥 Тестирование нескольких аккаунтов Avito...")
+        
+        path = os.path.join(tempfile.mkdtemp(), "state.db")
+        configs = [
+            {"name": "default", "user_id": 1, "client_id": "a", "client_secret": "a"},
+            {"name": "second", "user_id": 2, "client_id": "b", "client_secret": "b"},
+        ]
+        store = StateStore(path)
+        first, second = create_accounts(configs, store)
+        first.processed_messages["chat1"] = 100
+        second.processed_messages["chat1"] = 200
+        second.completed_chats.add("chat1")
+        store.flush()
+        store.close()
+        
+        store = StateStore(path)
+        first, second = create_accounts(configs, store)
+        separated = (first.processed_messages.get("chat1") == 100 and second.processed_messages.get("chat1") == 200
+                     and "chat1" not in first.completed_chats and "chat1" in second.completed_chats)
+        legacy = store.load("processed_messages") == {"chat1": 100}
+        store.close()
+        print(f"  Состояние chat1: default={first.processed_messages.get('chat1')}, second={second.processed_messages.get('chat1')}")
+        
+        # Загруженный аккаунт ставит 30 ходов, второй - 3 чуть позже; OpenAI - один слот
+        scheduler = ChatScheduler({"openai": 1}, account_limit=2)
+        finished = []
+        
+        async def turn(account, chat_id):
+            async with scheduler.chat((account, chat_id)), scheduler.account(account):
+                async with scheduler.upstream("openai"):
+                    await asyncio.sleep(0.005)
+            finished.append(account)
+        
+        busy = [asyncio.create_task(turn("busy", f"chat{i}")) for i in range(30)]
+        await asyncio.sleep(0)
+        quiet = [asyncio.create_task(turn("quiet", f"chat{i}")) for i in range(3)]
+        await asyncio.gather(*busy, *quiet)
+        quiet_done = max(i for i, account in enumerate(finished) if account == "quiet") + 1
+        print(f"  Ходы второго аккаунта завершены к {quiet_done}-му ходу из {len(finished)}")
+        
+        if separated and legacy and quiet_done <= 10:
+            print("✅ Состояние аккаунтов раздельное, занятый аккаунт не вытесняет остальных")
+        else:
+            print("❌ Неожиданное поведение нескольких аккаунтов")
+    
+    async def test_partition_leases(self):
+        """Тест аренды разделов чатов несколькими процессами (локально)"""
+        print("\n🧱 Тестирование разделения чатов между процессами...")
+        
+        path = os.path.join(tempfile.mkdtemp(), "partitions.db")
+        first = PartitionLeases(path, "worker-a", partitions=16, ttl=1.5, clock_margin=0.3)
+        second = PartitionLeases(path, "worker-b", partitions=16, ttl=1.5, clock_margin=0.3)
+        chats = [f"default:chat{i}" for i in range(200)]
+        
+        def owners():
+            return [(first.owns(chat), second.owns(chat)) for chat in chats]
+        
+        first.renew()
+        second.renew()
+        alone = all(a and not b for a, b in owners())
+        # Первый отдает лишнее при продлении, второй забирает освободившееся
+        first.renew()
+        second.renew()
+        split = (first.owned_count(), second.owned_count())
+        exclusive = all(a != b for a, b in owners())
+        print(f"  Разделы после прихода второго процесса: {split[0]} + {split[1]}")
+        
+        # Состояние чатов первого процесса пишется в общую базу
+        first_state = SharedChatState(first)
+        second_state = SharedChatState(second)
+        done = next(chat for chat in chats if first.owns(chat)).split(":", 1)[1]
+        waiting = [chat for chat in chats if first.owns(chat)][1].split(":", 1)[1]
+        first_state.mark_completed("default", done)
+        first_state.save_followup("default", waiting, {"followup_stage": "16h", "next_followup_time": 1})
+        # Устаревшая локальная копия второго процесса не перезаписывает общую
+        second_state.import_local("default", [], {waiting: {"followup_stage": "2h", "next_followup_time": 0}})
+        
+        # Первый процесс "упал": аренда истекает, разделы переходят ко второму
+        await asyncio.sleep(1.6)
+        gained, _ = second.renew()
+        takeover = second.owned_count() == 16 and not any(a for a, _ in owners())
+        print(f"  После остановки первого: у второго {second.owned_count()} разделов")
+        taken = second_state.followups("default", gained)
+        shared = (second_state.is_completed("default", done) and not second_state.is_completed("default", waiting)
+                  and taken.get(waiting, {}).get("followup_stage") == "16h" and done not in taken)
+        second_state.save_followup("default", waiting, None)
+        shared = shared and waiting not in second_state.followups("default", gained)
+        print(f"  Общее состояние после перехода: завершен {done}, follow-up {taken}")
+        first_state.close()
+        second_state.close()
+        first.close()
+        second.close()
+        
+        stable = partition_of("default:chat1", 64) == partition_of("default:chat1", 64) < 64
+        if alone and split == (8, 8) and exclusive and takeover and stable and shared:
+            print("✅ Каждый чат принадлежит ровно одному процессу, разделы и состояние чатов переходят после истечения аренды")
+        else:
+            print("❌ Неожиданное распределение разделов")
+    
+    async def test_chat_listing(self):
+        """Тест постраничного списка чатов с остановкой на временном окне (локально)"""
+        print("\n📚 Тестирование постраничного списка чатов...")
+        
+        now = int(datetime.now().timestamp())
+        # 250 чатов, обновлены раз в минуту: от свежих к старым, как отдает Avito
+        all_chats = [{"id": f"chat{i}", "updated": now - i * 60} for i in range(250)]
+        requests = []
+        
+        async def get_chats(request):
+            requests.append(dict(request.query))
+            limit = int(request.query["limit"])
+            offset = int(request.query["offset"])
+            return web.json_response({"chats": all_chats[offset:offset + limit]})
+        
+        app = web.Application()
+        app.router.add_get("/messenger/v2/accounts/{user_id}/chats", get_chats)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 18085).start()
+        
+        client = AvitoClient(1, "test", "test")
+        client.base_url = "http://127.0.0.1:18085"
+        client.access_token = "test"
+        client.token_expires_at = now + 3600
+        try:
+            await client.start()
+            # Окно ~130 минут: вторая страница обрывается на первом старом чате
+            recent = [chat async for chat in client.iter_chats(now - 130 * 60 + 30, chat_types=["u2i"])]
+            window_requests = list(requests)
+            requests.clear()
+            everything = [chat async for chat in client.iter_chats()]
+            full_requests = len(requests)
+        finally:
+            await client.close()
+            await runner.cleanup()
+        
+        print(f"  В окне: {len(recent)} чатов за {len(window_requests)} запроса, "
+              f"все: {len(everything)} чатов за {full_requests} запроса")
+        if (len(recent) == 130 and len(window_requests) == 2 and window_requests[1]["offset"] == "100"
+                and window_requests[0].get("chat_types") == "u2i" and len(everything) == 250 and full_requests == 3):
+            print("✅ Чаты за окно получены полностью без лишних страниц")
+        else:
+            print("❌ Неожиданный результат постраничного списка")
+    
+    def test_dialog_features_benchmark(self):
+        """Микробенчмарк: прежние проверки диалога против однопроходного извлекателя"""
+        print("\n⏱️ Бенчмарк извлечения признаков диалога...")
+        
+        def message(direction, text, created):
+            return {"type": "text", "direction": direction, "created": created, "content": {"text": text}}
+        
+        dialog = [
+            message("in", "Здравствуйте! Интересует ваша квартира", 1),
+            message("out", "Здравствуйте, на связи Светлана, АН Skyline\n\nРасскажите, пожалуйста, кто проживать планирует", 2),
+            message("in", "Буду жить один, мне 28 лет", 3),
+            message("out", "Дети будут?", 4),
+            message("in", "Нет, но есть кот", 5),
+            message("out", "Люблю животных🥰\n\nНа какой срок планируете снимать?", 6),
+            message("in", "Хотя бы на год, а может и надолго", 7),
+            message("out", "Когда планируете заселиться?", 8),
+            message("in", "До 20 августа", 9),
+            message("out", "Номер телефона для связи?", 10),
+            message("in", "+7 (916) 123-45-67", 11),
+        ]
+        # Диалог длиной в MAX_MESSAGES_HISTORY - типичный размер в process_chat
+        long_dialog = (dialog * 3)[:30]
+        
+        samples = [dialog[:k] for k in range(1, len(dialog) + 1)] + [long_dialog, []]
+        mismatches = [k for k, sample in enumerate(samples)
+                      if self.legacy_dialog_checks(sample) != self.compiled_dialog_checks(sample)]
+        if mismatches:
+            print(f"❌ Расхождения в выборках: {mismatches}")
+        else:
+            print(f"✅ Результаты совпадают на {len(samples)} выборках")
+        
+        runs = 2000
+        for name, sample in [("до телефона", long_dialog[:20]), ("полный", long_dialog)]:
+            legacy = timeit.timeit(lambda: self.legacy_dialog_checks(sample), number=runs)
+            compiled = timeit.timeit(lambda: extract_dialog_features(sample), number=runs)
+            print(f"📊 Диалог {name} ({len(sample)} сообщ.): прежние проверки {legacy / runs * 1e6:.1f} мкс, "
+                  f"однопроходный извлекатель {compiled / runs * 1e6:.1f} мкс, ускорение x{legacy / compiled:.1f}")
+    
     async def test_full_integration(self):
         """Полный интеграционный тест"""
         print("\n🎯 ПОЛНЫЙ ИНТЕГРАЦИОННЫЙ ТЕСТ")
@@ -285,6 +1034,51 @@ class TestAvitoBot:
         # 4. Тест Telegram
         await self.test_telegram_sending()
         
+        # 5. Тест webhook-режима (локально, без сети)
+        await self.test_webhook_mode()
+        
+        # 6. Бенчмарк признаков диалога (локально)
+        self.test_dialog_features_benchmark()
+        
+        # 7. Потоковый ответ (локально)
+        await self.test_streaming_reply()
+        
+        # 8. Окно контекста по бюджету токенов (локально)
+        await self.test_context_window()
+        
+        # 9. Кэш адресов объявлений (локально)
+        await self.test_geocoding_cache()
+        
+        # 10. Очередь заявок в Telegram (локально)
+        await self.test_telegram_outbox()
+        
+        # 11. Фоновая обработка завершенных диалогов (локально)
+        await self.test_completion_workers()
+        
+        # 12. Локальное извлечение данных клиента
+        await self.test_local_extraction()
+        
+        # 13. Быстрые ответы без GPT
+        self.test_fast_replies()
+        
+        # 14. Метрики для Prometheus (локально)
+        await self.test_metrics_endpoint()
+        
+        # 15. Трассировка ходов диалога (локально)
+        await self.test_turn_tracing()
+        
+        # 16. Логирование через очередь (локально)
+        self.test_queue_logging()
+        
+        # 17. Несколько аккаунтов Avito (локально)
+        await self.test_multi_account()
+        
+        # 18. Разделение чатов между процессами (локально)
+        await self.test_partition_leases()
+        
+        # 19. Постраничный список чатов (локально)
+        await self.test_chat_listing()
+        
         print("\n" + "=" * 60)
         print("🎉 ВСЕ ТЕСТЫ ЗАВЕРШЕНЫ!")
         
@@ -297,6 +1091,8 @@ class TestAvitoBot:
 
 
 async def main():
+    # Сообщения модулей (логгеры) выводятся вместе с отчетом теста
+    setup_logging("INFO", {"aiohttp.access": "WARNING"})
     print("🚀 ЗАПУСК РАСШИРЕННОГО ТЕСТИРОВАНИЯ AVITO RENTAL BOT")
     print("=" * 60)
     
@@ -323,6 +1119,9 @@ async def main():
         print(f"\n❌ КРИТИЧЕСКАЯ ОШИБКА: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        await close_all_sessions()
+        shutdown_logging()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Трассировка текущего хода; у каждой задачи asyncio своя копия
+current_trace = ContextVar("current_trace", default=None)
+
+
+def add_usage_to(target, usage):
+    target["prompt_tokens"] = target.get("prompt_tokens", 0) + (usage.get("prompt_tokens") or 0)
+    target["completion_tokens"] = target.get("completion_tokens", 0) + (usage.get("completion_tokens") or 0)
+    details = usage.get("prompt_tokens_details") or {}
+    target["cached_tokens"] = target.get("cached_tokens", 0) + (details.get("cached_tokens") or 0)
+
+
+class TurnTrace:
+    """Замеры одного хода диалога: вложенные этапы со временем и атрибутами"""
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.attributes = {}
+        self.usage = {}
+        self.spans = []
+        self._open = []
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        record = {"name": name, "start_ms": self._elapsed_ms(), "parent": self._open[-1]["name"] if self._open else None}
+        record.update(attributes)
+        self.spans.append(record)
+        self._open.append(record)
+        started = time.monotonic()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            self._open.remove(record)
+
+    def add_usage(self, usage):
+        """Токены ответа OpenAI - в текущий этап и в итог хода"""
+        add_usage_to(self.usage, usage)
+        if self._open:
+            add_usage_to(self._open[-1].setdefault("usage", {}), usage)
+
+    def _elapsed_ms(self):
+        return round((time.monotonic() - self.started) * 1000, 1)
+
+    def to_record(self):
+        return {
+            "time": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "chat_id": self.chat_id,
+            "duration_ms": self._elapsed_ms(),
+            **self.attributes,
+            "usage": self.usage or None,
+            "spans": self.spans,
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """Этап текущего хода; вне трассировки ничего не делает"""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attributes) as record:
+        yield record
+
+
+def annotate(**attributes):
+    """Атрибуты текущего хода (message_id, этап, исход)"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.set(**attributes)
+
+
+def record_turn_usage(usage):
+    trace = current_trace.get()
+    if trace is not None and usage:
+        trace.add_usage(usage)
+
+
+class TraceWriter:
+    """Запись трассировок в JSONL с ротацией по размеру.
+
+    Ход диалога только кладет строку в очередь, а в файл ее пишет
+    отдельный поток (QueueListener), поэтому диск не тормозит ответы.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.logger = logging.getLogger(f"avito_bot.traces.{path}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.handlers = [logging.handlers.QueueHandler(self.queue)]
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.listener = logging.handlers.QueueListener(self.queue, file_handler)
+        self.running = False
+        self.written = 0
+
+    def start(self):
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """Дописать очередь и закрыть файл"""
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def write(self, trace):
+        self.logger.info(json.dumps(trace.to_record(), ensure_ascii=False, default=str))
+        self.written += 1
@@ -0,0 +1,77 @@
+import asyncio
+import hmac
+import logging
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def parse_message_event(data):
+    """Достать (chat_id, сообщение) из webhook-события мессенджера Avito v3"""
+    if not isinstance(data, dict):
+        return None
+    payload = data.get("payload") or {}
+    if payload.get("type") != "message":
+        return None
+    value = payload.get("value") or {}
+    chat_id = value.get("chat_id")
+    if not chat_id:
+        return None
+    return chat_id, value
+
+
+class WebhookServer:
+    """Локальный HTTP-сервер, принимающий webhook-события мессенджера Avito"""
+
+    def __init__(self, handler, host="0.0.0.0", port=8080, path="/avito/webhook", secret=None):
+        # handler(chat_id, message) - корутина обработки события
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.runner = None
+        self._tasks = set()
+        self.stats = {"received": 0, "accepted": 0, "ignored": 0, "rejected": 0}
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Webhook-сервер слушает http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _handle(self, request):
+        self.stats["received"] += 1
+
+        if self.secret and not hmac.compare_digest(request.query.get("token", ""), self.secret):
+            self.stats["rejected"] += 1
+            return web.json_response({"ok": False}, status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            self.stats["rejected"] += 1
+            return web.json_response({"ok": False}, status=400)
+
+        event = parse_message_event(data)
+        if event is None:
+            self.stats["ignored"] += 1
+            return web.json_response({"ok": True})
+
+        # Avito ждет быстрый ответ - обработка идет в отдельной задаче
+        chat_id, message = event
+        task = asyncio.create_task(self.handler(chat_id, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.stats["accepted"] += 1
+        return web.json_response({"ok": True})
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueWorkerPool:
+    """Пул фоновых обработчиков заданий из DurableQueue.
+
+    handler(payload) возвращает True, если задание выполнено; False или
+    исключение - задание откладывается с растущей паузой и выполняется
+    повторно, в том числе после перезапуска процесса.
+    """
+
+    def __init__(self, queue, handler, workers=2, backoff_base=30.0, backoff_max=1800.0, max_attempts=20):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_attempts = max_attempts
+        # Задания, которые сейчас выполняются (чтобы не взять одно дважды)
+        self._claimed = set()
+        self._wakeup = None
+        self._tasks = []
+        self.counters = {"enqueued": 0, "done": 0, "retries": 0, "failed": 0}
+
+    def enqueue(self, payload):
+        """Поставить задание (сразу записывается на диск)"""
+        job_id = self.queue.put(payload)
+        self.counters["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _claim(self):
+        now = time.time()
+        for job in self.queue.due(now, limit=self.workers + len(self._claimed)):
+            if job[0] not in self._claimed:
+                self._claimed.add(job[0])
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            # Сбрасываем до выборки: задание, добавленное после нее, снова разбудит
+            self._wakeup.clear()
+            job = self._claim()
+            if job is None:
+                next_time = self.queue.next_available(after=time.time())
+                timeout = None if next_time is None else max(next_time - time.time(), 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, payload, attempts, _ = job
+            try:
+                done = await self.handler(payload)
+            except Exception as e:
+                logger.error(f"Ошибка фонового задания {job_id}: {e}")
+                done = False
+            finally:
+                self._claimed.discard(job_id)
+
+            if done:
+                self.queue.ack(job_id)
+                self.counters["done"] += 1
+            elif attempts + 1 >= self.max_attempts:
+                self.queue.ack(job_id)
+                self.counters["failed"] += 1
+                logger.error(f"Фоновое задание {job_id} снято после {attempts + 1} попыток: {payload}")
+            else:
+                self.counters["retries"] += 1
+                self.queue.retry(job_id, time.time() + min(self.backoff_max, self.backoff_base * 2 ** attempts))
+
+    def stats(self):
+        return {**self.counters, "depth": len(self.queue), "in_progress": len(self._claimed)}